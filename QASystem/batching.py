@@ -0,0 +1,184 @@
+import random
+import numpy as np
+
+
+def round_up(length, multiple):
+    """ Round a sequence length up to a multiple (keeps the number of distinct batch shapes small) """
+    return length if multiple <= 1 else -(-length // multiple) * multiple
+
+
+class BucketBatcher(object):
+    """ Batch padded input features by token length, trimming every batch to its own longest sequence
+        Inputs must be the padded arrays produced by features.py (input_ids, input_mask, segment_ids, label_ids)
+    """
+
+    def __init__(self, features, batch_size, shuffle=False, rng=None, bucket_batches=50, pad_multiple=8,
+                 sequence_features=None):
+        """ BucketBatcher constructor
+            :parameter features: A dict of padded feature arrays (memory-mapped arrays are fine)
+            :parameter batch_size: The number of examples per batch
+            :parameter shuffle: Shuffle examples (training). Without shuffling, batches are sorted by length
+                                (prediction) & results are restored to input order with the yielded indices
+            :parameter rng: The random generator used when shuffling
+            :parameter bucket_batches: When shuffling, examples are sorted by length within windows of
+                                       bucket_batches * batch_size examples, keeping batch contents random
+            :parameter pad_multiple: Batch lengths are rounded up to this multiple
+            :parameter sequence_features: The names of the arrays trimmed to the batch length along their second
+                                          axis (Default is every 2-D array)
+        """
+        self.features = features
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rng = random.Random(0) if rng is None else rng
+        self.bucket_batches = bucket_batches
+        self.pad_multiple = pad_multiple
+        self.sequence_features = set(name for name, array in features.items() if np.ndim(array) == 2) \
+            if sequence_features is None else set(sequence_features)
+        self.lengths = np.asarray(features['input_mask']).sum(axis=1).astype(np.int64)
+        self.max_sequence_len = np.asarray(features['input_mask']).shape[1] if len(self.lengths) else 0
+
+    def __len__(self):
+        return -(-len(self.lengths) // self.batch_size)
+
+    def _batch_indices(self):
+        """ The example indices of every batch, in the order they should be yielded """
+        if not self.shuffle:
+            order = np.argsort(self.lengths, kind='stable')
+            return [order[start:start + self.batch_size] for start in range(0, len(order), self.batch_size)]
+
+        order = list(range(len(self.lengths)))
+        self.rng.shuffle(order)
+        window = self.batch_size * self.bucket_batches
+        batches = []
+        for start in range(0, len(order), window):
+            chunk = sorted(order[start:start + window], key=lambda idx: self.lengths[idx])
+            batches.extend(np.asarray(chunk[pos:pos + self.batch_size], dtype=np.int64)
+                           for pos in range(0, len(chunk), self.batch_size))
+        self.rng.shuffle(batches)
+        return batches
+
+    def batch_length(self, indices):
+        """ The padded length of a batch: its longest sequence, rounded up to pad_multiple """
+        return min(round_up(int(self.lengths[indices].max()), self.pad_multiple), self.max_sequence_len)
+
+    def __iter__(self):
+        """ Yield (indices, batch) pairs where batch holds the trimmed feature arrays of those examples """
+        for indices in self._batch_indices():
+            batch_len = self.batch_length(indices)
+            batch = {name: np.asarray(array[indices])[:, :batch_len] if name in self.sequence_features
+                     else np.asarray(array[indices])
+                     for name, array in self.features.items()}
+            yield indices, batch
+
+    def iter_epochs(self):
+        """ Endlessly yield ([input_ids, segment_ids], label_ids) training batches, reshuffled every epoch """
+        while True:
+            for _, batch in self:
+                yield [batch['input_ids'], batch['segment_ids']], batch['label_ids']
+
+    def padding_efficiency(self):
+        """ Padding statistics: share of real tokens with bucketing vs with fixed max_sequence_len padding """
+        real_tokens = int(self.lengths.sum())
+        padded_tokens = sum(self.batch_length(indices) * len(indices) for indices in self._batch_indices())
+        fixed_tokens = len(self.lengths) * self.max_sequence_len
+        return {'real_tokens': real_tokens,
+                'bucketed_tokens': padded_tokens,
+                'fixed_tokens': fixed_tokens,
+                'bucketed_efficiency': real_tokens / float(max(padded_tokens, 1)),
+                'fixed_efficiency': real_tokens / float(max(fixed_tokens, 1))}
+
+
+class StreamBatcher(object):
+    """ Tokenize & batch a stream of records as it is read, so training starts before the files are parsed & memory
+        stays bounded by the window below (plus the stream's own shuffle buffer) instead of the dataset size
+        Like BucketBatcher when shuffling, examples are sorted by length within windows of bucket_batches *
+        batch_size examples & every batch is trimmed to its own longest sequence
+    """
+
+    def __init__(self, records_fn, encoder, batch_size, rng=None, bucket_batches=50, pad_multiple=8):
+        """ StreamBatcher constructor
+            :parameter records_fn: A function returning a new (shuffled) iterable of {'question', 'text', 'label'}
+                                   records for every epoch (see ZaloDatasetProcessor.stream_from_path)
+            :parameter encoder: A features.PairEncoder
+        """
+        self.records_fn = records_fn
+        self.encoder = encoder
+        self.batch_size = batch_size
+        self.rng = random.Random(0) if rng is None else rng
+        self.bucket_batches = bucket_batches
+        self.pad_multiple = pad_multiple
+
+    def _batch(self, examples):
+        batch_len = min(round_up(max(len(input_ids) for input_ids, _, _, _ in examples), self.pad_multiple),
+                        self.encoder.max_sequence_len)
+        batch = {name: np.zeros((len(examples), batch_len), dtype=np.int32)
+                 for name in ['input_ids', 'input_mask', 'segment_ids']}
+        for row, (input_ids, input_mask, segment_ids, _) in enumerate(examples):
+            batch['input_ids'][row, :len(input_ids)] = input_ids
+            batch['input_mask'][row, :len(input_ids)] = input_mask
+            batch['segment_ids'][row, :len(input_ids)] = segment_ids
+        batch['label_ids'] = np.asarray([label_id for _, _, _, label_id in examples], dtype=np.int32)
+        return batch
+
+    def _flush(self, window):
+        window.sort(key=lambda example: len(example[0]))
+        batches = [window[start:start + self.batch_size] for start in range(0, len(window), self.batch_size)]
+        self.rng.shuffle(batches)
+        for examples in batches:
+            yield self._batch(examples)
+
+    def __iter__(self):
+        """ Yield one epoch of batches, dicts of 'input_ids', 'input_mask', 'segment_ids' & 'label_ids' arrays """
+        window = []
+        for record in self.records_fn():
+            window.append(self.encoder.encode(self.encoder.token_ids(record['question']),
+                                              self.encoder.token_ids(record['text']), pad_to=0)
+                          + (1 if record['label'] else 0,))
+            if len(window) >= self.batch_size * self.bucket_batches:
+                for batch in self._flush(window):
+                    yield batch
+                window = []
+        for batch in self._flush(window):
+            yield batch
+
+
+def train_on_stream(model, batcher, epochs=1, targets_fn=None, name='Training', log_every=100):
+    """ Train a compiled Keras model batch by batch on a StreamBatcher. Unlike fit_generator, no number of steps is
+        needed, so the stream is never read ahead to count its examples
+        :parameter targets_fn: targets_fn(batch) -> the training targets of a batch (Default is its label ids)
+    """
+    for epoch in range(epochs):
+        num_batches, num_examples, total_loss = 0, 0, 0.
+        for batch in batcher:
+            targets = batch['label_ids'] if targets_fn is None else targets_fn(batch)
+            loss = model.train_on_batch([batch['input_ids'], batch['segment_ids']], targets)
+            total_loss += float(np.ravel(loss)[0])
+            num_batches += 1
+            num_examples += len(batch['label_ids'])
+            if num_batches % log_every == 0:
+                print("[Batching] {} epoch {}/{}: {} batches, loss {:.4f}".format(name, epoch + 1, epochs, num_batches,
+                                                                                 total_loss / num_batches))
+        print("[Batching] {} epoch {}/{} done: {} examples in {} batches, loss {:.4f}"
+              .format(name, epoch + 1, epochs, num_examples, num_batches, total_loss / max(num_batches, 1)))
+
+
+def log_padding_efficiency(batcher, name):
+    """ Print the padding efficiency of a batcher, so the saving is visible in the logs """
+    stats = batcher.padding_efficiency()
+    print("[Batching] {}: {:.1f}% real tokens with length bucketing vs {:.1f}% with fixed padding "
+          "({} vs {} padded tokens)".format(name, stats['bucketed_efficiency'] * 100, stats['fixed_efficiency'] * 100,
+                                            stats['bucketed_tokens'], stats['fixed_tokens']))
+    return stats
+
+
+def predict_bucketed(features, predict_fn, batch_size=64, pad_multiple=8):
+    """ Score padded feature arrays in length-sorted, dynamically padded batches
+        :parameter predict_fn: A function predict_fn(input_ids, input_mask, segment_ids) -> probabilities
+        :returns The probabilities of every example, in the original input order
+    """
+    batcher = BucketBatcher(features, batch_size, shuffle=False, pad_multiple=pad_multiple)
+    log_padding_efficiency(batcher, 'Prediction')
+    probabilities = np.zeros(len(batcher.lengths), dtype=np.float32)
+    for indices, batch in batcher:
+        probabilities[indices] = predict_fn(batch['input_ids'], batch['input_mask'], batch['segment_ids'])
+    return probabilities
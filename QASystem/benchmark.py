@@ -0,0 +1,389 @@
+import argparse
+import copy
+import csv
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from os.path import join, dirname, abspath
+import numpy as np
+
+REPO_PATH = dirname(dirname(abspath(__file__)))
+ULTILITIES_PATH = join(REPO_PATH, 'Ultilities')
+# Printed by a stage process in front of its JSON result
+RESULT_PREFIX = 'BENCHMARK_RESULT '
+STAGE_NAMES = ['load_zalo', 'load_squad', 'convert', 'filter', 'tokenize', 'predict']
+
+parser = argparse.ArgumentParser(description='Time every stage of the data & inference pipeline & record its peak '
+                                             'memory, on synthetic corpora scaled from the Dataset folder')
+parser.add_argument('--stages', nargs='+', default=STAGE_NAMES, choices=STAGE_NAMES,
+                    help='The stages to run')
+parser.add_argument('--scales', nargs='+', type=int, default=[1],
+                    help='The corpus sizes, as multiples of the shipped dataset files')
+parser.add_argument('--output', default='benchmark_results.json',
+                    help='The machine-readable results file')
+parser.add_argument('--compare', nargs='+', default=None,
+                    help='Compare with the results of an earlier run (OLD: compare this run with it; OLD NEW: only '
+                         'compare two results files). The exit code is 1 when a stage regressed')
+parser.add_argument('--tolerance', type=float, default=0.1,
+                    help='The relative slow-down (or memory growth) reported as a regression')
+parser.add_argument('--repeat', type=int, default=1,
+                    help='The number of runs of every stage (the fastest one is kept)')
+parser.add_argument('--work_dir', default=None,
+                    help='Where the synthetic corpora are written (Default is a temporary folder, removed at the end)')
+parser.add_argument('--zalo_file', default=join(REPO_PATH, 'Dataset', 'zalo', 'val.json'),
+                    help='The Zalo-format file the synthetic Zalo corpus is scaled from')
+parser.add_argument('--squad_file', default=join(REPO_PATH, 'Dataset', 'old', 'squad-v2.0-mailong25.json'),
+                    help='The SQuAD-format file the synthetic SQuAD corpus is scaled from')
+parser.add_argument('--convert_modes', nargs='+', default=['full', 'short', 'veryshort'],
+                    help='The convert_squad2zalo_format.py modes')
+parser.add_argument('--vocab_file', default=join(REPO_PATH, 'model', 'vocab.txt'),
+                    help='The BERT vocab used for tokenization')
+parser.add_argument('--do_lowercase', action='store_true', help='Lowercase the input text when tokenizing')
+parser.add_argument('--max_sequence_len', type=int, default=256, help='The sequence length used for tokenization')
+parser.add_argument('--batch_sizes', nargs='+', type=int, default=[1, 8, 32, 64],
+                    help='The prediction batch sizes')
+parser.add_argument('--sequence_lengths', nargs='+', type=int, default=[64, 128, 256],
+                    help='The prediction sequence lengths')
+parser.add_argument('--predict_examples', type=int, default=256,
+                    help='The number of examples scored for every (batch size, sequence length)')
+parser.add_argument('--model_path', default=None,
+                    help='Predict with this fine-tuned Kashgari model (Default is a randomly initialized BERT '
+                         'classifier shaped like bert_config)')
+parser.add_argument('--exported_model_dir', default=None,
+                    help="Predict with this exported model (see run_zalo.py mode 'export')")
+parser.add_argument('--use_quantized_model', action='store_true',
+                    help='Use the int8-quantized model of exported_model_dir')
+parser.add_argument('--bert_config', default=join(REPO_PATH, 'model', 'bert_config.json'),
+                    help='The shape of the randomly initialized BERT classifier')
+parser.add_argument('--seed', type=int, default=0, help='The random seed of the synthetic data')
+parser.add_argument('--run_stage', default=None, help=argparse.SUPPRESS)
+parser.add_argument('--stage_params', default='{}', help=argparse.SUPPRESS)
+
+
+# Synthetic corpora
+def scale_zalo_records(records, scale):
+    """ Repeat Zalo-format records `scale` times. Every copy gets its own ids & texts, so caches keyed by text don't
+        make the copies free, while the texts shared inside a copy stay shared (as in the real data)
+    """
+    for replica in range(scale):
+        for idx, record in enumerate(records):
+            record = dict(record, id='{}-{}'.format(record.get('id', idx), replica))
+            if replica:
+                record['text'] = '{} ({})'.format(record['text'], replica)
+            yield record
+
+
+def scale_squad_articles(articles, scale):
+    """ Repeat SQuAD-format articles `scale` times, with their own titles, contexts & question ids
+        (contexts are only extended at the end, so the answer offsets stay valid)
+    """
+    for replica in range(scale):
+        for article in articles:
+            article = copy.deepcopy(article)
+            if replica:
+                article['title'] = '{}_{}'.format(article.get('title', ''), replica)
+                for paragraph in article['paragraphs']:
+                    paragraph['context'] = '{} ({})'.format(paragraph['context'], replica)
+                    for qas in paragraph['qas']:
+                        qas['id'] = '{}-{}'.format(qas['id'], replica)
+            yield article
+
+
+def write_score_file(records, score_file, rng):
+    """ A filter.py score file with random predictions for the records """
+    with open(score_file, 'w', encoding='utf-8', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['guid', 'label', 'prediction', 'probabilities'])
+        for record in records:
+            writer.writerow([record['id'], int(record['label']), int(rng.rand() < 0.5), rng.rand()])
+
+
+def make_corpora(args, work_dir, scale):
+    """ Write the synthetic corpora of a scale: zalo.json, squad.json & scores.csv in work_dir/x<scale> """
+    corpus_dir = join(work_dir, 'x{}'.format(scale))
+    os.makedirs(corpus_dir, exist_ok=True)
+    with open(args.zalo_file, 'r', encoding='utf-8') as file:
+        records = list(scale_zalo_records(json.load(file), scale))
+    with open(join(corpus_dir, 'zalo.json'), 'w', encoding='utf-8') as file:
+        json.dump(records, file, ensure_ascii=False)
+    write_score_file(records, join(corpus_dir, 'scores.csv'), np.random.RandomState(args.seed))
+
+    with open(args.squad_file, 'r', encoding='utf-8') as file:
+        data = json.load(file)
+    articles = data['data'] if isinstance(data, dict) else data
+    with open(join(corpus_dir, 'squad.json'), 'w', encoding='utf-8') as file:
+        json.dump({'data': list(scale_squad_articles(articles, scale))}, file, ensure_ascii=False)
+    return corpus_dir
+
+
+# Stages, each run in its own process
+def stage_load(dataset_path, file_name, mode):
+    """ ZaloDatasetProcessor.load_from_path """
+    from .preprocess import ZaloDatasetProcessor
+    processor = ZaloDatasetProcessor()
+    start_time = time.perf_counter()
+    processor.load_from_path(dataset_path, mode=mode, file_name=file_name)
+    seconds = time.perf_counter() - start_time
+    return {'seconds': seconds, 'items': len(processor.squad_data if mode == 'squad' else processor.train_data)}
+
+
+def stage_tokenize(dataset_file, mode, vocab_file, do_lowercase, max_sequence_len):
+    """ Reading & tokenizing a dataset file into BERT input arrays (no feature cache) """
+    from bert import tokenization
+    from .feature_cache import build_features_for_file
+    tokenizer = tokenization.FullTokenizer(vocab_file=vocab_file, do_lower_case=do_lowercase)
+    start_time = time.perf_counter()
+    features = build_features_for_file(dataset_file, mode, tokenizer, max_sequence_len)
+    seconds = time.perf_counter() - start_time
+    num_items = len(features['input_ids'])
+    return {'seconds': seconds, 'items': num_items,
+            'tokens_per_second': float(np.sum(features['input_mask'])) / max(seconds, 1e-9)}
+
+
+def build_random_classifier(config_file, sequence_length):
+    """ A 2-label classifier on the [CLS] output of a randomly initialized BERT shaped like config_file
+        It costs as much to run as a fine-tuned model of that shape, without needing one
+        :returns A predict_fn(input_ids, input_mask, segment_ids)
+    """
+    import kashgari  # Makes keras-bert build tf.keras layers
+    import tensorflow as tf
+    from keras_bert import get_model
+    with open(config_file, 'r', encoding='utf-8') as file:
+        config = json.load(file)
+    inputs, outputs = get_model(token_num=config['vocab_size'], pos_num=config['max_position_embeddings'],
+                                seq_len=sequence_length, embed_dim=config['hidden_size'],
+                                transformer_num=config['num_hidden_layers'], head_num=config['num_attention_heads'],
+                                feed_forward_dim=config['intermediate_size'], training=False, trainable=False)
+    first_token = tf.keras.layers.Lambda(lambda sequence: sequence[:, 0])(outputs)
+    model = tf.keras.Model(inputs, tf.keras.layers.Dense(2, activation='softmax')(first_token))
+
+    def predict_fn(input_ids, input_mask, segment_ids):
+        return model.predict([input_ids, segment_ids], batch_size=len(input_ids))[:, 1]
+
+    return predict_fn
+
+
+def stage_predict(batch_size, sequence_length, num_examples, model_path=None, exported_model_dir=None,
+                  use_quantized_model=False, bert_config=None, seed=0):
+    """ Batched prediction throughput on random full-length inputs (the first batch is a warm-up) """
+    if exported_model_dir is not None:
+        from .export import load_exported_predictor
+        predict_fn = load_exported_predictor(exported_model_dir, quantized=use_quantized_model)
+    elif model_path is not None:
+        import kashgari
+        from .predict import make_predict_fn
+        predict_fn = make_predict_fn(kashgari.utils.load_model(model_path), batch_size)
+    else:
+        predict_fn = build_random_classifier(bert_config, sequence_length)
+
+    rng = np.random.RandomState(seed)
+    input_ids = rng.randint(1000, 30000, size=(num_examples, sequence_length)).astype(np.int32)
+    input_mask = np.ones_like(input_ids)
+    segment_ids = np.zeros_like(input_ids)
+    segment_ids[:, sequence_length // 4:] = 1
+    predict_fn(input_ids[:batch_size], input_mask[:batch_size], segment_ids[:batch_size])
+
+    start_time = time.perf_counter()
+    for start in range(0, num_examples, batch_size):
+        batch = slice(start, start + batch_size)
+        predict_fn(input_ids[batch], input_mask[batch], segment_ids[batch])
+    seconds = time.perf_counter() - start_time
+    return {'seconds': seconds, 'items': num_examples,
+            'tokens_per_second': num_examples * sequence_length / max(seconds, 1e-9)}
+
+
+STAGES = {'load': stage_load, 'tokenize': stage_tokenize, 'predict': stage_predict}
+
+
+# Harness
+def stage_key(name, params):
+    return '{}[{}]'.format(name, ','.join('{}={}'.format(key, params[key]) for key in sorted(params)))
+
+
+def run_process(command, cwd):
+    """ Run a command to completion
+        :returns (exit code, wall time in seconds, peak RSS in MB of that process, its output)
+    """
+    with tempfile.TemporaryFile() as log:
+        start_time = time.perf_counter()
+        process = subprocess.Popen(command, cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+        wall_seconds = time.perf_counter() - start_time
+        process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        log.seek(0)
+        output = log.read().decode('utf-8', 'replace')
+    # ru_maxrss is in KB on Linux, in bytes on macOS
+    peak_rss_mb = usage.ru_maxrss / (1024. * 1024 if sys.platform == 'darwin' else 1024.)
+    return process.returncode, wall_seconds, peak_rss_mb, output
+
+
+def run_stage(name, params, command, cwd, items=None, repeat=1):
+    """ Run a stage `repeat` times, each in a new process, & keep its fastest run
+        :parameter command: The command of the stage. In-process stages print their own timing (RESULT_PREFIX)
+        :parameter items: The number of items processed, for commands that don't report it
+    """
+    result = {'key': stage_key(name, params), 'name': name, 'params': params, 'status': 'ok', 'runs': []}
+    for _ in range(max(repeat, 1)):
+        exit_code, wall_seconds, peak_rss_mb, output = run_process(command, cwd)
+        if exit_code != 0:
+            result.update(status='error', error=output.strip().splitlines()[-5:])
+            break
+        run = {'wall_seconds': wall_seconds, 'seconds': wall_seconds, 'peak_rss_mb': peak_rss_mb, 'items': items}
+        for line in output.splitlines():
+            if line.startswith(RESULT_PREFIX):
+                run.update(json.loads(line[len(RESULT_PREFIX):]))
+        result['runs'].append(run)
+
+    if result['runs']:
+        best = min(result['runs'], key=lambda run: run['seconds'])
+        result.update(best)
+        result['peak_rss_mb'] = max(run['peak_rss_mb'] for run in result['runs'])
+        if result['items']:
+            result['items_per_second'] = result['items'] / max(result['seconds'], 1e-9)
+    print("[Benchmark] {}: {}".format(result['key'], format_result(result)))
+    return result
+
+
+def format_result(result):
+    if result['status'] != 'ok':
+        return 'ERROR {}'.format(' | '.join(result.get('error', [])))
+    text = '{:.3f}s (process {:.3f}s), peak RSS {:.1f} MB'.format(result['seconds'], result['wall_seconds'],
+                                                                  result['peak_rss_mb'])
+    if result.get('items_per_second'):
+        text += ', {} items, {:.1f} items/s'.format(result['items'], result['items_per_second'])
+    return text
+
+
+def in_process_command(stage, **params):
+    return [sys.executable, '-m', 'QASystem.benchmark', '--run_stage', stage, '--stage_params', json.dumps(params)]
+
+
+def run_benchmarks(args, work_dir):
+    results = []
+    for scale in args.scales:
+        corpus_dir = make_corpora(args, work_dir, scale)
+        zalo_file, squad_file = join(corpus_dir, 'zalo.json'), join(corpus_dir, 'squad.json')
+        with open(zalo_file, 'r', encoding='utf-8') as file:
+            num_zalo_records = len(json.load(file))
+
+        if 'load_zalo' in args.stages:
+            results.append(run_stage('load_zalo', {'scale': scale}, in_process_command(
+                'load', dataset_path=corpus_dir, file_name='zalo.json', mode='train'), REPO_PATH,
+                repeat=args.repeat))
+        if 'load_squad' in args.stages:
+            results.append(run_stage('load_squad', {'scale': scale}, in_process_command(
+                'load', dataset_path=corpus_dir, file_name='squad.json', mode='squad'), REPO_PATH,
+                repeat=args.repeat))
+        if 'convert' in args.stages:
+            for mode in args.convert_modes:
+                results.append(run_stage('convert', {'scale': scale, 'mode': mode}, [
+                    sys.executable, 'convert_squad2zalo_format.py', '-i', squad_file, '-m', mode,
+                    '-o', join(corpus_dir, 'converted_{}.json'.format(mode))], ULTILITIES_PATH, repeat=args.repeat))
+        if 'filter' in args.stages:
+            results.append(run_stage('filter', {'scale': scale}, [
+                sys.executable, 'filter.py', '-train', zalo_file, '-score', join(corpus_dir, 'scores.csv'),
+                '-output', join(corpus_dir, 'filtered.json')], ULTILITIES_PATH, items=num_zalo_records,
+                repeat=args.repeat))
+        if 'tokenize' in args.stages:
+            for mode, dataset_file in [('train', zalo_file), ('squad', squad_file)]:
+                results.append(run_stage('tokenize', {'scale': scale, 'mode': mode}, in_process_command(
+                    'tokenize', dataset_file=dataset_file, mode=mode, vocab_file=args.vocab_file,
+                    do_lowercase=args.do_lowercase, max_sequence_len=args.max_sequence_len), REPO_PATH,
+                    repeat=args.repeat))
+
+    # Prediction throughput doesn't depend on the corpus size
+    if 'predict' in args.stages:
+        for sequence_length in args.sequence_lengths:
+            for batch_size in args.batch_sizes:
+                results.append(run_stage('predict', {'batch_size': batch_size, 'sequence_length': sequence_length},
+                                         in_process_command('predict', batch_size=batch_size,
+                                                            sequence_length=sequence_length,
+                                                            num_examples=args.predict_examples,
+                                                            model_path=args.model_path,
+                                                            exported_model_dir=args.exported_model_dir,
+                                                            use_quantized_model=args.use_quantized_model,
+                                                            bert_config=args.bert_config, seed=args.seed),
+                                         REPO_PATH, repeat=args.repeat))
+    return results
+
+
+def git_revision():
+    """ The current commit & whether the working tree has uncommitted changes (None outside of a git checkout) """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_PATH,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+        changes = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_PATH,
+                                          stderr=subprocess.DEVNULL).decode().strip()
+        return commit, bool(changes)
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def compare_results(old, new, tolerance=0.1):
+    """ Print the time & peak memory change of every stage found in both results
+        :returns The keys of the stages slower (or bigger) than the old ones by more than tolerance
+    """
+    old_stages = {result['key']: result for result in old['stages'] if result['status'] == 'ok'}
+    regressions = []
+    print("[Benchmark] Comparing {} with {}".format(new['meta'].get('commit'), old['meta'].get('commit')))
+    for result in new['stages']:
+        before = old_stages.get(result['key'])
+        if before is None or result['status'] != 'ok':
+            continue
+        time_change = result['seconds'] / max(before['seconds'], 1e-9) - 1
+        memory_change = result['peak_rss_mb'] / max(before['peak_rss_mb'], 1e-9) - 1
+        regressed = time_change > tolerance or memory_change > tolerance
+        if regressed:
+            regressions.append(result['key'])
+        print("{:<50} {:>9.3f}s -> {:>9.3f}s ({:+6.1f}%)  {:>8.1f} -> {:>8.1f} MB ({:+6.1f}%){}".format(
+            result['key'], before['seconds'], result['seconds'], time_change * 100, before['peak_rss_mb'],
+            result['peak_rss_mb'], memory_change * 100, '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def load_results(results_file):
+    with open(results_file, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def main():
+    args = parser.parse_args()
+    if args.run_stage is not None:
+        result = STAGES[args.run_stage](**json.loads(args.stage_params))
+        print(RESULT_PREFIX + json.dumps(result))
+        return 0
+
+    if args.compare is not None and len(args.compare) == 2:
+        return 1 if compare_results(load_results(args.compare[0]), load_results(args.compare[1]),
+                                    args.tolerance) else 0
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='benchmark_')
+    try:
+        stages = run_benchmarks(args, work_dir)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    commit, dirty = git_revision()
+    results = {'meta': {'commit': commit, 'dirty': dirty, 'timestamp': datetime.now().isoformat(),
+                        'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpu_count': os.cpu_count(), 'scales': args.scales, 'repeat': args.repeat,
+                        'seed': args.seed},
+               'stages': stages}
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json.dump(results, file, indent=2)
+    print("[Benchmark] Results written to {}".format(args.output))
+
+    if args.compare is not None:
+        return 1 if compare_results(load_results(args.compare[0]), results, args.tolerance) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,187 @@
+import json
+import os
+import time
+from os.path import join
+import numpy as np
+import tensorflow as tf
+from .batching import BucketBatcher, log_padding_efficiency, round_up, train_on_stream
+from .predict import predict_features, evaluate_predictions
+
+STUDENT_CONFIG_FILE = 'student_config.json'
+STUDENT_WEIGHTS_FILE = 'student_weights.h5'
+# Teacher logits are cached alongside these, the other 2-D arrays are not trimmed to the batch length
+SEQUENCE_FEATURES = ['input_ids', 'input_mask', 'segment_ids']
+
+
+def student_config(teacher_config_file, num_layers=4, hidden_size=0, num_attention_heads=0, intermediate_size=0):
+    """ A BERT config shaped like the teacher's, with fewer (& optionally narrower) layers
+        :parameter hidden_size: The hidden size of the student (0 keeps the teacher's)
+        :parameter num_attention_heads: The number of attention heads (0 keeps 64-dimensional heads, like BERT)
+        :parameter intermediate_size: The feed-forward size (0 keeps it 4 times the hidden size, like BERT)
+    """
+    with open(teacher_config_file, 'r', encoding='utf-8') as config_file:
+        config = json.load(config_file)
+    hidden_size = hidden_size or config['hidden_size']
+    config.update(num_hidden_layers=num_layers, hidden_size=hidden_size,
+                  num_attention_heads=num_attention_heads or max(hidden_size // 64, 1),
+                  intermediate_size=intermediate_size or 4 * hidden_size)
+    return config
+
+
+def build_student(config, num_labels=2, checkpoint_path=None, dropout_rate=0.1):
+    """ A BERT classifier returning the logits of every label from its pooled [CLS] output
+        :parameter checkpoint_path: Initialize the embeddings, the layers & the pooler from the first layers of this
+                                    pretrained checkpoint. Only possible when the student is as wide as the checkpoint
+    """
+    import kashgari  # Makes bert4keras build tf.keras layers
+    from bert4keras.models import build_transformer_model
+    encoder = build_transformer_model(checkpoint_path=checkpoint_path, model='bert', with_pool=True, **config)
+    tensor = tf.keras.layers.Dropout(dropout_rate)(encoder.output)
+    return tf.keras.Model(encoder.inputs, tf.keras.layers.Dense(num_labels, name='student_logits')(tensor))
+
+
+def save_student(student, config, student_path):
+    os.makedirs(student_path, exist_ok=True)
+    with open(join(student_path, STUDENT_CONFIG_FILE), 'w', encoding='utf-8') as config_file:
+        json.dump(config, config_file, indent=2)
+    student.save_weights(join(student_path, STUDENT_WEIGHTS_FILE))
+
+
+def load_student(student_path):
+    with open(join(student_path, STUDENT_CONFIG_FILE), 'r', encoding='utf-8') as config_file:
+        student = build_student(json.load(config_file))
+    student.load_weights(join(student_path, STUDENT_WEIGHTS_FILE))
+    return student
+
+
+def make_teacher_logits_fn(model, label_index, batch_size=64):
+    """ Wrap a fine-tuned Kashgari classification model into logits_fn(input_ids, input_mask, segment_ids)
+        The model outputs probabilities; their logarithm stands for its logits, as softmax is shift invariant
+        :parameter label_index: The output index of each label id (0 for False, 1 for True)
+        :returns A function returning the (batch, num_labels) logits, in label id order
+    """
+    graph = tf.compat.v1.get_default_graph()
+
+    def logits_fn(input_ids, input_mask, segment_ids):
+        with graph.as_default():
+            probabilities = model.tf_model.predict([input_ids, segment_ids], batch_size=batch_size)
+        return np.log(np.clip(np.asarray(probabilities)[:, label_index], 1e-7, 1.))
+
+    return logits_fn
+
+
+def make_student_predict_fn(student):
+    """ Wrap a student into predict_fn(input_ids, input_mask, segment_ids), returning 'True' probabilities """
+    graph = tf.compat.v1.get_default_graph()
+
+    def predict_fn(input_ids, input_mask, segment_ids):
+        with graph.as_default():
+            logits = np.asarray(student.predict([input_ids, segment_ids], batch_size=len(input_ids)))
+        exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+        return exp[:, 1] / exp.sum(axis=1)
+
+    return predict_fn
+
+
+def distillation_loss(temperature=2., alpha=0.5):
+    """ alpha * T^2 * cross entropy with the teacher's softened distribution + (1 - alpha) * cross entropy with the
+        labels. The T^2 factor keeps the soft gradients on the scale of the hard ones
+        y_true holds the teacher logits followed by the one-hot labels, y_pred the student logits
+    """
+    def loss(y_true, y_pred):
+        num_labels = tf.shape(y_pred)[-1]
+        teacher_logits, labels = y_true[:, :num_labels], y_true[:, num_labels:]
+        soft_loss = tf.nn.softmax_cross_entropy_with_logits(labels=tf.nn.softmax(teacher_logits / temperature),
+                                                            logits=y_pred / temperature)
+        hard_loss = tf.nn.softmax_cross_entropy_with_logits(labels=labels, logits=y_pred)
+        return alpha * temperature ** 2 * soft_loss + (1 - alpha) * hard_loss
+
+    return loss
+
+
+def train_student(student, features, teacher_logits, batch_size=16, epochs=3, learning_rate=5e-5, temperature=2.,
+                  alpha=0.5, pad_multiple=8):
+    """ Train a student on the teacher's soft labels (& the hard labels, see distillation_loss)
+        :parameter features: A dict of padded feature arrays ('input_ids', 'input_mask', 'segment_ids', 'label_ids')
+        :parameter teacher_logits: The (cached) teacher logits of every example, in label id order
+    """
+    batcher = BucketBatcher(dict(features, teacher_logits=teacher_logits), batch_size, shuffle=True,
+                            pad_multiple=pad_multiple, sequence_features=SEQUENCE_FEATURES)
+    log_padding_efficiency(batcher, 'Distillation')
+    one_hot = np.eye(np.shape(teacher_logits)[1], dtype=np.float32)
+
+    def batches():
+        while True:
+            for _, batch in batcher:
+                targets = np.concatenate([batch['teacher_logits'].astype(np.float32), one_hot[batch['label_ids']]],
+                                         axis=1)
+                yield [batch['input_ids'], batch['segment_ids']], targets
+
+    student.compile(optimizer=tf.keras.optimizers.Adam(learning_rate), loss=distillation_loss(temperature, alpha))
+    student.fit_generator(batches(), steps_per_epoch=len(batcher), epochs=epochs)
+    return student
+
+
+def train_student_on_stream(student, batcher, teacher_logits_fn, num_labels=2, epochs=3, learning_rate=5e-5,
+                            temperature=2., alpha=0.5):
+    """ Train a student on a stream of batches, the teacher labelling every batch as it comes (nothing is cached,
+        so the teacher runs once per example & epoch)
+        :parameter batcher: A batching.StreamBatcher over the training records
+        :parameter teacher_logits_fn: The teacher logits, in label id order (see make_teacher_logits_fn)
+    """
+    one_hot = np.eye(num_labels, dtype=np.float32)
+
+    def targets_fn(batch):
+        teacher_logits = teacher_logits_fn(batch['input_ids'], batch['input_mask'], batch['segment_ids'])
+        return np.concatenate([np.asarray(teacher_logits, dtype=np.float32), one_hot[batch['label_ids']]], axis=1)
+
+    student.compile(optimizer=tf.keras.optimizers.Adam(learning_rate), loss=distillation_loss(temperature, alpha))
+    train_on_stream(student, batcher, epochs, targets_fn, name='Distillation')
+    return student
+
+
+def measure_latency(predict_fn, features, num_examples=200, pad_multiple=8):
+    """ Single-request latency: every example is scored alone, padded to its own length (after one warm-up call)
+        :returns The mean, median & 99th percentile latency in milliseconds
+    """
+    input_mask = np.asarray(features['input_mask'])
+    lengths = input_mask.sum(axis=1)
+    num_examples = min(num_examples, len(lengths))
+    timings = []
+    for idx in [0] + list(range(num_examples)):
+        length = min(round_up(int(lengths[idx]), pad_multiple), input_mask.shape[1])
+        row = slice(idx, idx + 1)
+        start_time = time.perf_counter()
+        predict_fn(np.asarray(features['input_ids'][row, :length]), input_mask[row, :length],
+                   np.asarray(features['segment_ids'][row, :length]))
+        timings.append((time.perf_counter() - start_time) * 1000)
+    timings = np.asarray(timings[1:])
+    return {'latency_mean_ms': float(timings.mean()),
+            'latency_p50_ms': float(np.percentile(timings, 50)),
+            'latency_p99_ms': float(np.percentile(timings, 99))}
+
+
+def compare_models(predictors, features, batch_size=64, pad_multiple=8, window_aggregation='max',
+                   latency_examples=200):
+    """ Print the F1 score, batched throughput & single-request latency of every model, the first being the reference
+        :parameter predictors: A list of (name, predict_fn) tuples
+        :returns A list of result dicts, one per model
+    """
+    results = []
+    for name, predict_fn in predictors:
+        start_time = time.time()
+        probabilities, labels = predict_features(features, predict_fn, batch_size=batch_size,
+                                                 pad_multiple=pad_multiple, window_aggregation=window_aggregation)
+        elapsed = time.time() - start_time
+        result = dict(evaluate_predictions(labels, probabilities), name=name,
+                      examples_per_second=len(probabilities) / max(elapsed, 1e-9),
+                      **measure_latency(predict_fn, features, latency_examples, pad_multiple))
+        results.append(result)
+        reference = results[0]
+        print("[Distillation] {}: F1 Score {:.2f} ({:+.2f}), Accuracy {:.2f}%, {:.1f} examples/s, latency "
+              "{:.1f} ms (p50 {:.1f}, p99 {:.1f}, {:.1f}x faster)"
+              .format(name, result['f1_score'] * 100, (result['f1_score'] - reference['f1_score']) * 100,
+                      result['accuracy'] * 100, result['examples_per_second'], result['latency_mean_ms'],
+                      result['latency_p50_ms'], result['latency_p99_ms'],
+                      reference['latency_mean_ms'] / max(result['latency_mean_ms'], 1e-9)))
+    return results
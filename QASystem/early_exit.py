@@ -0,0 +1,176 @@
+import re
+from os.path import join
+import numpy as np
+import tensorflow as tf
+from .predict import evaluate_predictions
+
+EXIT_HEADS_FILE = 'exit_heads.npz'
+# The entropy thresholds (in nats, ln 2 ~ 0.69 is the maximum with 2 labels) reported after training the exit heads
+SWEEP_THRESHOLDS = [0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6]
+
+
+def layer_output_name(num_layers):
+    """ The name of the (bert4keras) layer whose output is the hidden states after num_layers transformer layers """
+    return 'Transformer-{}-FeedForward-Norm'.format(num_layers - 1)
+
+
+def count_transformer_layers(model):
+    """ The number of transformer layers of the BERT inside a Kashgari model """
+    return sum(1 for layer in model.tf_model.layers if re.match(r'^Transformer-\d+-FeedForward-Norm$', layer.name))
+
+
+def parse_exit_layers(text):
+    """ Parse a comma separated list of exit layers (e.g. '2,4,6,8,10'), each exit following that many layers """
+    return sorted(set(int(layer) for layer in text.split(',') if layer.strip()))
+
+
+def entropy(probabilities):
+    probabilities = np.clip(probabilities, 1e-12, 1.)
+    return -(probabilities * np.log(probabilities)).sum(axis=-1)
+
+
+def softmax(logits):
+    exp = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+
+def make_exit_outputs_fn(model, exit_layers):
+    """ Wrap the BERT of a Kashgari model into outputs_fn(input_ids, input_mask, segment_ids), returning the [CLS]
+        hidden states after every exit layer as a (batch, num_exits, hidden_size) array (one forward pass)
+    """
+    session = tf.compat.v1.keras.backend.get_session()
+    with session.graph.as_default():
+        outputs = tf.stack([model.tf_model.get_layer(layer_output_name(layer)).output[:, 0]
+                            for layer in exit_layers], axis=1)
+    token_input, segment_input = model.tf_model.inputs
+
+    def outputs_fn(input_ids, input_mask, segment_ids):
+        return session.run(outputs, feed_dict={token_input: input_ids, segment_input: segment_ids})
+
+    return outputs_fn
+
+
+def save_exit_heads(model_path, exit_layers, heads):
+    """ Store the Dense weights of the trained exit heads (see frozen_features.build_pooled_head) with the model """
+    weights = [head.layers[-1].get_weights() for head in heads]
+    np.savez(join(model_path, EXIT_HEADS_FILE), layers=np.asarray(exit_layers),
+             kernels=np.stack([kernel for kernel, _ in weights]), biases=np.stack([bias for _, bias in weights]))
+
+
+def load_exit_heads(model_path):
+    """ The exit heads saved with a model: {'layers': (num_exits,), 'kernels': (num_exits, hidden_size, num_labels),
+        'biases': (num_exits, num_labels)}
+    """
+    with np.load(join(model_path, EXIT_HEADS_FILE)) as exit_heads:
+        return {name: exit_heads[name] for name in ['layers', 'kernels', 'biases']}
+
+
+def exit_probabilities(exit_heads, cls_outputs, exit_idx):
+    """ The label probabilities of one exit head over [CLS] hidden states; the heads are small enough for numpy """
+    return softmax(np.asarray(cls_outputs, dtype=np.float32).dot(exit_heads['kernels'][exit_idx]) +
+                   exit_heads['biases'][exit_idx])
+
+
+class EarlyExitPredictor(object):
+    """ predict_fn(input_ids, input_mask, segment_ids) over a Kashgari model with exit heads
+        The batch runs through the BERT layers one segment (up to the next exit) at a time: the examples whose exit
+        prediction has an entropy below the threshold stop there, the others carry on from their hidden states (fed
+        back into the graph) up to the model's own head. The number of layers executed per example is recorded
+    """
+
+    def __init__(self, model, exit_heads, threshold=0.2):
+        """ EarlyExitPredictor constructor
+            :parameter model: The fine-tuned Kashgari model
+            :parameter exit_heads: Its exit heads (see load_exit_heads)
+            :parameter threshold: The maximum entropy (in nats) of an exit prediction for an example to stop there
+        """
+        self.exit_heads = exit_heads
+        self.threshold = threshold
+        self.num_layers = count_transformer_layers(model)
+        self.exit_layers = [int(layer) for layer in exit_heads['layers']]
+        assert all(0 < layer < self.num_layers for layer in self.exit_layers), \
+            "[EarlyExit] Exit layers must be between 1 & {}".format(self.num_layers - 1)
+        label2idx = model.embedding.processor.label2idx
+        self.positive_idx = next((label2idx[label] for label in (True, 'True', '1') if label in label2idx), 1)
+        self.session = tf.compat.v1.keras.backend.get_session()
+        self.token_input, self.segment_input = model.tf_model.inputs
+        self.hidden_outputs = [model.tf_model.get_layer(layer_output_name(layer)).output
+                               for layer in self.exit_layers]
+        self.final_output = model.tf_model.outputs[0]
+        self.num_examples = 0
+        self.num_layers_executed = 0
+        self.exit_counts = np.zeros(len(self.exit_layers) + 1, dtype=np.int64)
+
+    def __call__(self, input_ids, input_mask, segment_ids):
+        probabilities = np.zeros(len(input_ids), dtype=np.float32)
+        remaining = np.arange(len(input_ids))
+        hidden, hidden_output = None, None
+        for exit_idx, (layer, output) in enumerate(zip(self.exit_layers, self.hidden_outputs)):
+            feed_dict = {self.token_input: input_ids[remaining], self.segment_input: segment_ids[remaining]}
+            if hidden is not None:
+                # Resume from the hidden states of the previous exit instead of recomputing the first layers
+                feed_dict[hidden_output] = hidden
+            hidden, hidden_output = self.session.run(output, feed_dict=feed_dict), output
+            label_probabilities = exit_probabilities(self.exit_heads, hidden[:, 0], exit_idx)
+            exits = entropy(label_probabilities) < self.threshold
+            probabilities[remaining[exits]] = label_probabilities[exits, self.positive_idx]
+            self.num_layers_executed += layer * int(exits.sum())
+            self.exit_counts[exit_idx] += int(exits.sum())
+            remaining, hidden = remaining[~exits], hidden[~exits]
+            if not len(remaining):
+                break
+        if len(remaining):
+            final = self.session.run(self.final_output, feed_dict={self.token_input: input_ids[remaining],
+                                                                   self.segment_input: segment_ids[remaining],
+                                                                   hidden_output: hidden})
+            probabilities[remaining] = np.asarray(final)[:, self.positive_idx]
+            self.num_layers_executed += self.num_layers * len(remaining)
+            self.exit_counts[-1] += len(remaining)
+        self.num_examples += len(input_ids)
+        return probabilities
+
+    def average_layers(self):
+        return self.num_layers_executed / float(max(self.num_examples, 1))
+
+    def log_stats(self):
+        exits = ', '.join('{}: {}'.format(layer, count) for layer, count
+                          in zip(self.exit_layers + [self.num_layers], self.exit_counts))
+        print("[EarlyExit] {:.2f} of {} layers executed on average over {} examples (threshold {}, exits per layer "
+              "{})".format(self.average_layers(), self.num_layers, self.num_examples, self.threshold, exits))
+
+
+def simulate_early_exit(exit_label_probabilities, final_probabilities, exit_layers, num_layers, threshold,
+                        positive_idx=1):
+    """ What early exit at a threshold would predict, from the predictions of every exit & of the full model
+        :parameter exit_label_probabilities: The (num_examples, num_exits, num_labels) exit head probabilities
+        :parameter final_probabilities: The 'True' probabilities of the full model
+        :returns The 'True' probabilities & the number of layers executed of every example
+    """
+    probabilities = np.array(final_probabilities, dtype=np.float32)
+    layers = np.full(len(probabilities), num_layers, dtype=np.int64)
+    done = np.zeros(len(probabilities), dtype=bool)
+    for exit_idx, layer in enumerate(exit_layers):
+        exits = ~done & (entropy(exit_label_probabilities[:, exit_idx]) < threshold)
+        probabilities[exits] = exit_label_probabilities[exits, exit_idx, positive_idx]
+        layers[exits] = layer
+        done |= exits
+    return probabilities, layers
+
+
+def sweep_thresholds(exit_label_probabilities, final_probabilities, labels, exit_layers, num_layers,
+                     thresholds=SWEEP_THRESHOLDS, positive_idx=1):
+    """ Print the F1 score & average number of layers executed at every threshold, to choose one """
+    reference = evaluate_predictions(labels, final_probabilities)
+    print("[EarlyExit] Without early exit: F1 Score {:.2f}, {} layers".format(reference['f1_score'] * 100,
+                                                                              num_layers))
+    results = []
+    for threshold in thresholds:
+        probabilities, layers = simulate_early_exit(exit_label_probabilities, final_probabilities, exit_layers,
+                                                    num_layers, threshold, positive_idx)
+        result = dict(evaluate_predictions(labels, probabilities), threshold=threshold,
+                      average_layers=float(layers.mean()))
+        results.append(result)
+        print("[EarlyExit] Threshold {}: F1 Score {:.2f} ({:+.2f}), {:.2f} layers on average ({:.1f}x fewer)"
+              .format(threshold, result['f1_score'] * 100, (result['f1_score'] - reference['f1_score']) * 100,
+                      result['average_layers'], num_layers / max(result['average_layers'], 1e-9)))
+    return results
@@ -0,0 +1,122 @@
+import json
+import os
+import threading
+from os.path import join, exists
+import numpy as np
+import tensorflow as tf
+
+FROZEN_GRAPH_FILE = 'frozen_model.pb'
+QUANTIZED_MODEL_FILE = 'model_int8.tflite'
+EXPORT_INFO_FILE = 'export_info.json'
+
+
+def export_model(model, export_dir, max_sequence_len, quantize=True):
+    """ Freeze a fine-tuned Kashgari classification model into a CPU inference artifact
+        The variables are folded into constants & training-only nodes are stripped (frozen_model.pb).
+        With quantize, a TFLite model with dynamic int8 (weight) quantization is written as well
+        :parameter model: The fine-tuned Kashgari model
+        :parameter export_dir: The directory where the artifacts are written
+        :parameter max_sequence_len: The sequence length used for the static shapes of the quantized model
+        :returns The export information (input/output tensor names, positive label index, artifact files)
+    """
+    os.makedirs(export_dir, exist_ok=True)
+    session = tf.compat.v1.keras.backend.get_session()
+    input_names = [tensor.op.name for tensor in model.tf_model.inputs]
+    output_name = model.tf_model.outputs[0].op.name
+
+    frozen_graph = tf.compat.v1.graph_util.convert_variables_to_constants(
+        session, session.graph.as_graph_def(), [output_name])
+    frozen_graph = tf.compat.v1.graph_util.remove_training_nodes(frozen_graph, protected_nodes=input_names)
+    with tf.io.gfile.GFile(join(export_dir, FROZEN_GRAPH_FILE), 'wb') as graph_file:
+        graph_file.write(frozen_graph.SerializeToString())
+
+    label2idx = model.embedding.processor.label2idx
+    export_info = {'input_names': input_names,
+                   'output_name': output_name,
+                   'positive_idx': next((label2idx[label] for label in (True, 'True', '1') if label in label2idx), 1),
+                   'max_sequence_len': max_sequence_len,
+                   'frozen_graph': FROZEN_GRAPH_FILE,
+                   'quantized_model': None}
+
+    if quantize:
+        converter = tf.compat.v1.lite.TFLiteConverter.from_frozen_graph(
+            join(export_dir, FROZEN_GRAPH_FILE), input_names, [output_name],
+            input_shapes={name: [1, max_sequence_len] for name in input_names})
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        with open(join(export_dir, QUANTIZED_MODEL_FILE), 'wb') as quantized_file:
+            quantized_file.write(converter.convert())
+        export_info['quantized_model'] = QUANTIZED_MODEL_FILE
+
+    with open(join(export_dir, EXPORT_INFO_FILE), 'w', encoding='utf-8') as info_file:
+        json.dump(export_info, info_file, indent=2)
+    return export_info
+
+
+class FrozenGraphPredictor(object):
+    """ predict_fn(input_ids, input_mask, segment_ids) over an exported frozen float32 graph """
+
+    def __init__(self, export_dir, num_threads=0):
+        with open(join(export_dir, EXPORT_INFO_FILE), 'r', encoding='utf-8') as info_file:
+            self.export_info = json.load(info_file)
+        graph_def = tf.compat.v1.GraphDef()
+        with tf.io.gfile.GFile(join(export_dir, self.export_info['frozen_graph']), 'rb') as graph_file:
+            graph_def.ParseFromString(graph_file.read())
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        config = tf.compat.v1.ConfigProto(intra_op_parallelism_threads=num_threads,
+                                          inter_op_parallelism_threads=num_threads)
+        self.session = tf.compat.v1.Session(graph=self.graph, config=config)
+        self.inputs = [self.graph.get_tensor_by_name(name + ':0') for name in self.export_info['input_names']]
+        self.output = self.graph.get_tensor_by_name(self.export_info['output_name'] + ':0')
+
+    def __call__(self, input_ids, input_mask, segment_ids):
+        probabilities = self.session.run(self.output, feed_dict=dict(zip(self.inputs, [input_ids, segment_ids])))
+        return np.asarray(probabilities)[:, self.export_info['positive_idx']]
+
+
+class QuantizedPredictor(object):
+    """ predict_fn(input_ids, input_mask, segment_ids) over an exported int8-quantized TFLite model
+        Calls are serialized, as a TFLite interpreter is not thread-safe
+    """
+
+    def __init__(self, export_dir, num_threads=None):
+        with open(join(export_dir, EXPORT_INFO_FILE), 'r', encoding='utf-8') as info_file:
+            self.export_info = json.load(info_file)
+        model_path = join(export_dir, self.export_info['quantized_model'])
+        try:
+            self.interpreter = tf.lite.Interpreter(model_path=model_path, num_threads=num_threads)
+        except TypeError:
+            # Older TFLite interpreters don't take a thread count
+            self.interpreter = tf.lite.Interpreter(model_path=model_path)
+        self.input_details = {detail['name']: detail for detail in self.interpreter.get_input_details()}
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.input_shape = None
+        self._lock = threading.Lock()
+
+    def __call__(self, input_ids, input_mask, segment_ids):
+        with self._lock:
+            return self._predict(input_ids, segment_ids)
+
+    def _predict(self, input_ids, segment_ids):
+        if self.input_shape != input_ids.shape:
+            for name in self.export_info['input_names']:
+                self.interpreter.resize_tensor_input(self.input_details[name]['index'], list(input_ids.shape))
+            self.interpreter.allocate_tensors()
+            self.input_shape = input_ids.shape
+        for name, values in zip(self.export_info['input_names'], [input_ids, segment_ids]):
+            detail = self.input_details[name]
+            self.interpreter.set_tensor(detail['index'], np.asarray(values, dtype=detail['dtype']))
+        self.interpreter.invoke()
+        probabilities = self.interpreter.get_tensor(self.output_index)
+        return np.asarray(probabilities)[:, self.export_info['positive_idx']]
+
+
+def load_exported_predictor(export_dir, quantized=True, num_threads=None):
+    """ Load an exported model as a predict_fn, preferring the quantized model when it exists """
+    with open(join(export_dir, EXPORT_INFO_FILE), 'r', encoding='utf-8') as info_file:
+        export_info = json.load(info_file)
+    if quantized and export_info.get('quantized_model') and exists(join(export_dir, export_info['quantized_model'])):
+        return QuantizedPredictor(export_dir, num_threads=num_threads)
+    return FrozenGraphPredictor(export_dir, num_threads=num_threads or 0)
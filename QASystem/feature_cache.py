@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+import shutil
+from os.path import join, exists
+import numpy as np
+from .preprocess import iter_records, read_squad_to_store
+from .features import convert_records_to_features, convert_store_to_features, convert_records_to_windows
+
+# Bump whenever the layout of the cached features changes, so stale caches are never reused
+CACHE_FORMAT_VERSION = 2
+
+
+def file_sha256(filepath, chunk_size=1 << 20):
+    """ Content hash of a file, read in chunks """
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def feature_cache_key(dataset_file, vocab_file, do_lowercase, max_sequence_len, mode, window_stride=0):
+    """ Content-addressed cache key: dataset & vocab hashes plus every setting that changes the features """
+    key_info = {'dataset': file_sha256(dataset_file),
+                'vocab': file_sha256(vocab_file),
+                'do_lowercase': bool(do_lowercase),
+                'max_sequence_len': int(max_sequence_len),
+                'mode': 'squad' if mode == 'squad' else 'zalo',
+                'window_stride': int(window_stride),
+                'version': CACHE_FORMAT_VERSION}
+    return hashlib.sha256(json.dumps(key_info, sort_keys=True).encode('utf-8')).hexdigest(), key_info
+
+
+def build_features_for_file(dataset_file, mode, tokenizer, max_sequence_len, encode='utf-8', window_stride=0):
+    """ Read & tokenize a whole dataset file (file order preserved, no shuffling)
+        :parameter window_stride: When positive, long texts are split into overlapping windows with this stride
+                                  (see features.convert_records_to_windows) instead of being truncated
+        :returns A dict of 'input_ids', 'input_mask', 'segment_ids' & 'label_ids' arrays
+                 (plus 'example_index' with windows)
+    """
+    if window_stride > 0:
+        return convert_records_to_windows(list(iter_records(dataset_file, encode=encode, mode=mode)), tokenizer,
+                                          max_sequence_len, window_stride)
+    if mode == 'squad':
+        return convert_store_to_features(read_squad_to_store(dataset_file, encode=encode), tokenizer,
+                                         max_sequence_len)
+    return convert_records_to_features(list(iter_records(dataset_file, encode=encode, mode=mode)), tokenizer,
+                                       max_sequence_len)
+
+
+class FeatureCache(object):
+    """ On-disk cache of tokenized input features, stored as .npy files & opened as read-only memory maps
+        so that several processes share a single copy through the page cache
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def path(self, key):
+        return join(self.cache_dir, key)
+
+    def load(self, key):
+        """ Return the cached features as read-only memory-mapped arrays, or None on a cache miss """
+        path = self.path(key)
+        if not exists(join(path, 'meta.json')):
+            return None
+        with open(join(path, 'meta.json'), 'r', encoding='utf-8') as meta_file:
+            names = json.load(meta_file)['features']
+        return {name: np.load(join(path, name + '.npy'), mmap_mode='r') for name in names}
+
+    def save(self, key, features, key_info=None):
+        """ Write features to the cache; the entry only becomes visible once it is complete """
+        path = self.path(key)
+        tmp_path = '{}.tmp-{}'.format(path, os.getpid())
+        os.makedirs(tmp_path, exist_ok=True)
+        for name, array in features.items():
+            np.save(join(tmp_path, name + '.npy'), np.ascontiguousarray(array))
+        with open(join(tmp_path, 'meta.json'), 'w', encoding='utf-8') as meta_file:
+            json.dump({'key_info': key_info, 'features': sorted(features),
+                       'num_examples': int(len(features['input_ids']))}, meta_file)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another process finished the same entry first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def load_or_build(self, dataset_file, vocab_file, do_lowercase, max_sequence_len, mode, build_fn,
+                      window_stride=0):
+        """ Return the cached features for this dataset/vocab/settings, building & storing them on a miss
+            :parameter build_fn: A function without arguments that returns the features dict
+        """
+        key, key_info = feature_cache_key(dataset_file, vocab_file, do_lowercase, max_sequence_len, mode,
+                                          window_stride)
+        features = self.load(key)
+        if features is not None:
+            print("[FeatureCache] Loaded cached features for {} ({})".format(dataset_file, key[:12]))
+            return features
+        print("[FeatureCache] No cached features for {}, tokenizing...".format(dataset_file))
+        self.save(key, build_fn(), key_info)
+        return self.load(key)
+
+
+def load_features(dataset_file, mode, tokenizer, vocab_file, do_lowercase, max_sequence_len, encode='utf-8',
+                  cache_dir=None, window_stride=0):
+    """ Tokenize a dataset file into BERT input arrays, reusing the on-disk feature cache when cache_dir is set
+        (None or empty disables it). A missing dataset file gives empty features, as in iter_records, & is not cached
+        :parameter mode: The dataset mode ('train', 'val', 'test' or 'squad')
+        :parameter window_stride: Split long texts into overlapping windows with this stride (0 to truncate)
+    """
+    def build_fn():
+        return build_features_for_file(dataset_file, mode, tokenizer, max_sequence_len, encode=encode,
+                                       window_stride=window_stride)
+
+    if not cache_dir or not exists(dataset_file):
+        return build_fn()
+    return FeatureCache(cache_dir).load_or_build(dataset_file, vocab_file, do_lowercase, max_sequence_len, mode,
+                                                 build_fn, window_stride=window_stride)
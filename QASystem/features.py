@@ -0,0 +1,144 @@
+import numpy as np
+from tqdm import tqdm
+
+
+def truncate_pair_lengths(len_a, len_b, max_length):
+    """ Lengths of a (question, text) token pair after BERT-style truncation
+        The longer sequence is shortened one token at a time until the pair fits into `max_length`
+    """
+    while len_a + len_b > max_length:
+        if len_a > len_b:
+            len_a -= 1
+        else:
+            len_b -= 1
+    return len_a, len_b
+
+
+class PairEncoder(object):
+    """ Build BERT inputs ([CLS] question [SEP] text [SEP]) from already tokenized (id) sequences """
+
+    def __init__(self, tokenizer, max_sequence_len):
+        """ PairEncoder constructor
+            :parameter tokenizer: A BERT FullTokenizer (tokenize & convert_tokens_to_ids)
+            :parameter max_sequence_len: The maximum input sequence length (special tokens included)
+        """
+        self.tokenizer = tokenizer
+        self.max_sequence_len = max_sequence_len
+        self.cls_id, self.sep_id = tokenizer.convert_tokens_to_ids(['[CLS]', '[SEP]'])
+
+    def token_ids(self, text):
+        """ Tokenize a text & return its wordpiece ids (no special tokens) """
+        return self.tokenizer.convert_tokens_to_ids(self.tokenizer.tokenize(text))
+
+    def encode(self, question_ids, text_ids, pad_to=None):
+        """ Combine the question & text ids into (input_ids, input_mask, segment_ids)
+            :parameter pad_to: The padded length (max_sequence_len if None, no padding if 0)
+        """
+        len_a, len_b = truncate_pair_lengths(len(question_ids), len(text_ids), self.max_sequence_len - 3)
+        input_ids = [self.cls_id] + list(question_ids[:len_a]) + [self.sep_id] \
+            + list(text_ids[:len_b]) + [self.sep_id]
+        segment_ids = [0] * (len_a + 2) + [1] * (len_b + 1)
+        input_mask = [1] * len(input_ids)
+
+        pad_to = self.max_sequence_len if pad_to is None else pad_to
+        padding = [0] * max(pad_to - len(input_ids), 0)
+        return input_ids + padding, input_mask + padding, segment_ids + padding
+
+    def encode_windows(self, question_ids, text_ids, stride):
+        """ Split a pair whose text doesn't fit into max_sequence_len into overlapping text windows
+            Each window repeats the question (capped at half of max_sequence_len) & the windows start every
+            `stride` text tokens, the last one ending at the end of the text. Short pairs give a single window
+            :returns A list of unpadded (input_ids, input_mask, segment_ids), one per window
+        """
+        question_ids = question_ids[:self.max_sequence_len // 2]
+        window_len = self.max_sequence_len - 3 - len(question_ids)
+        if not 0 < stride <= window_len:
+            # A larger stride would skip the text tokens between two windows
+            raise ValueError("[Features] Window stride must be between 1 & {} (the text tokens of a window with this "
+                             "question), got {}".format(window_len, stride))
+        if len(text_ids) <= window_len:
+            return [self.encode(question_ids, text_ids, pad_to=0)]
+        starts = list(range(0, len(text_ids) - window_len, stride)) + [len(text_ids) - window_len]
+        return [self.encode(question_ids, text_ids[start:start + window_len], pad_to=0) for start in starts]
+
+
+def pad_feature(feature, length):
+    """ Pad an unpadded (input_ids, input_mask, segment_ids) triple with zeros up to length """
+    return tuple(column + [0] * (length - len(column)) for column in feature)
+
+
+def aggregate_windows(probabilities, example_index, num_examples, method='max'):
+    """ Combine per-window probabilities into one probability per example
+        :parameter example_index: The example each window belongs to
+        :parameter method: 'max' (any window contains the answer) or 'mean'
+    """
+    probabilities = np.asarray(probabilities, dtype=np.float64)
+    example_index = np.asarray(example_index, dtype=np.int64)
+    if method == 'mean':
+        totals = np.bincount(example_index, weights=probabilities, minlength=num_examples)
+        counts = np.bincount(example_index, minlength=num_examples)
+        return (totals / np.maximum(counts, 1)).astype(np.float32)
+    result = np.zeros(num_examples, dtype=np.float64)
+    np.maximum.at(result, example_index, probabilities)
+    return result.astype(np.float32)
+
+
+def _to_feature_arrays(features, labels, example_index=None):
+    """ Stack (input_ids, input_mask, segment_ids) triples & labels (& window owners) into numpy arrays """
+    input_ids, input_mask, segment_ids = zip(*features) if features else ((), (), ())
+    arrays = {'input_ids': np.asarray(input_ids, dtype=np.int32),
+              'input_mask': np.asarray(input_mask, dtype=np.int32),
+              'segment_ids': np.asarray(segment_ids, dtype=np.int32),
+              'label_ids': np.asarray([1 if label else 0 for label in labels], dtype=np.int32)}
+    if example_index is not None:
+        arrays['example_index'] = np.asarray(example_index, dtype=np.int64)
+    return arrays
+
+
+def convert_records_to_features(records, tokenizer, max_sequence_len):
+    """ Convert a list of {'question', 'text', 'label'} records into padded BERT input arrays
+        Identical texts are tokenized only once
+        :returns A dict of 'input_ids', 'input_mask', 'segment_ids' & 'label_ids' arrays, order preserved
+    """
+    encoder = PairEncoder(tokenizer, max_sequence_len)
+    text_ids_cache = {}
+    features, labels = [], []
+    for record in tqdm(records):
+        text_ids = text_ids_cache.get(record['text'])
+        if text_ids is None:
+            text_ids = text_ids_cache[record['text']] = encoder.token_ids(record['text'])
+        features.append(encoder.encode(encoder.token_ids(record['question']), text_ids))
+        labels.append(record['label'])
+    return _to_feature_arrays(features, labels)
+
+
+def convert_store_to_features(store, tokenizer, max_sequence_len):
+    """ Convert a RecordStore into padded BERT input arrays
+        Every stored context is tokenized exactly once & its ids reused for all of its questions
+        :returns A dict of 'input_ids', 'input_mask', 'segment_ids' & 'label_ids' arrays, record order preserved
+    """
+    encoder = PairEncoder(tokenizer, max_sequence_len)
+    context_token_ids = [encoder.token_ids(context) for context in tqdm(store.contexts)]
+    features = [encoder.encode(encoder.token_ids(question), context_token_ids[context_id])
+                for question, context_id in tqdm(zip(store.questions, store.context_ids), total=len(store))]
+    return _to_feature_arrays(features, store.labels)
+
+
+def convert_records_to_windows(records, tokenizer, max_sequence_len, stride):
+    """ Convert {'question', 'text', 'label'} records into sliding-window BERT input arrays
+        Texts longer than max_sequence_len are split into overlapping windows instead of being truncated
+        :returns A dict of padded 'input_ids', 'input_mask', 'segment_ids' & 'label_ids' arrays (one row per
+                 window) plus 'example_index', the record each window belongs to
+    """
+    encoder = PairEncoder(tokenizer, max_sequence_len)
+    text_ids_cache = {}
+    features, labels, example_index = [], [], []
+    for idx, record in enumerate(tqdm(records)):
+        text_ids = text_ids_cache.get(record['text'])
+        if text_ids is None:
+            text_ids = text_ids_cache[record['text']] = encoder.token_ids(record['text'])
+        for window in encoder.encode_windows(encoder.token_ids(record['question']), text_ids, stride):
+            features.append(pad_feature(window, max_sequence_len))
+            labels.append(record['label'])
+            example_index.append(idx)
+    return _to_feature_arrays(features, labels, example_index)
@@ -0,0 +1,244 @@
+import hashlib
+import json
+import os
+import shutil
+from os.path import join, exists
+import numpy as np
+import tensorflow as tf
+from tqdm import tqdm
+from .batching import BucketBatcher, log_padding_efficiency
+from .feature_cache import file_sha256, feature_cache_key
+
+# Bump whenever the layout of the cached outputs changes, so stale caches are never reused
+FROZEN_CACHE_FORMAT_VERSION = 1
+# 'sequence': every token output (for the CNN-LSTM / BiGRU heads), 'cls': the [CLS] output, 'mean': the masked mean,
+# 'logits': the outputs of a fine-tuned teacher classifier (see distillation.py), stored as they are
+OUTPUT_TYPES = ['sequence', 'cls', 'mean', 'logits']
+# The files of a saved Kashgari model
+SAVED_MODEL_FILES = ['model_info.json', 'model_weights.h5']
+# The classifier trained on pooled frozen outputs & the settings needed to predict with it
+FROZEN_HEAD_FILE = 'frozen_head.h5'
+FROZEN_HEAD_INFO_FILE = 'frozen_head.json'
+
+
+def checkpoint_id(checkpoint_path, config_path):
+    """ Identify pretrained weights without reading them: the checkpoint index holds a checksum of every tensor """
+    digest = hashlib.sha256()
+    for filepath in [checkpoint_path + '.index', config_path]:
+        digest.update(file_sha256(filepath).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def saved_model_id(model_path):
+    """ Identify a saved Kashgari model (e.g. a fine-tuned teacher) by the content of its files """
+    digest = hashlib.sha256()
+    for file_name in SAVED_MODEL_FILES:
+        digest.update(file_sha256(join(model_path, file_name)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def frozen_cache_key(dataset_files, vocab_file, do_lowercase, max_sequence_len, checkpoint, output):
+    """ Content-addressed cache key of the encoder outputs over one or more (concatenated) dataset files
+        :parameter dataset_files: A list of (dataset file, mode) tuples
+        :parameter checkpoint: The id of the encoder weights (see checkpoint_id & saved_model_id)
+    """
+    key_info = {'datasets': [feature_cache_key(dataset_file, vocab_file, do_lowercase, max_sequence_len, mode)[1]
+                             for dataset_file, mode in dataset_files],
+                'checkpoint': checkpoint,
+                'output': output,
+                'version': FROZEN_CACHE_FORMAT_VERSION}
+    return hashlib.sha256(json.dumps(key_info, sort_keys=True).encode('utf-8')).hexdigest(), key_info
+
+
+def pool_outputs(outputs, input_mask, output='sequence'):
+    """ Reduce a batch of sequence outputs (batch, length, hidden) to the cached output type """
+    if output == 'cls':
+        return outputs[:, 0]
+    if output == 'mean':
+        mask = input_mask[:, :, None].astype(np.float32)
+        return (outputs * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1)
+    return outputs
+
+
+def make_embed_fn(embed_model):
+    """ Wrap a Keras encoder (e.g. a Kashgari embed_model) into embed_fn(input_ids, input_mask, segment_ids) """
+    graph = tf.compat.v1.get_default_graph()
+
+    def embed_fn(input_ids, input_mask, segment_ids):
+        with graph.as_default():
+            return embed_model.predict([input_ids, segment_ids], batch_size=len(input_ids))
+
+    return embed_fn
+
+
+class FrozenOutputCache(object):
+    """ On-disk cache of the outputs of a frozen encoder over tokenized features, stored as float16 .npy files &
+        opened as read-only memory maps. Sequence outputs take max_sequence_len * hidden_size * 2 bytes per example,
+        pooled ones hidden_size * 2 bytes
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def path(self, key):
+        return join(self.cache_dir, key)
+
+    def load(self, key):
+        """ Return the cached 'outputs', 'input_mask' & 'label_ids' as read-only memory maps, or None on a miss """
+        path = self.path(key)
+        if not exists(join(path, 'meta.json')):
+            return None
+        return {name: np.load(join(path, name + '.npy'), mmap_mode='r')
+                for name in ['outputs', 'input_mask', 'label_ids']}
+
+    def save(self, key, features, embed_fn, output='sequence', batch_size=64, key_info=None):
+        """ Run the encoder once over the features, writing each batch straight into a memory-mapped float16 file
+            The entry only becomes visible once it is complete
+            :parameter features: A dict of padded feature arrays ('input_ids', 'input_mask', 'segment_ids',
+                                 'label_ids'), every example is encoded at its full length
+        """
+        num_examples = len(features['input_ids'])
+        assert num_examples > 0, "[FrozenOutputCache] Nothing to encode"
+        path = self.path(key)
+        tmp_path = '{}.tmp-{}'.format(path, os.getpid())
+        os.makedirs(tmp_path, exist_ok=True)
+        outputs = None
+        for start in tqdm(range(0, num_examples, batch_size)):
+            batch = slice(start, start + batch_size)
+            input_mask = np.asarray(features['input_mask'][batch])
+            encoded = embed_fn(np.asarray(features['input_ids'][batch]), input_mask,
+                               np.asarray(features['segment_ids'][batch]))
+            encoded = pool_outputs(np.asarray(encoded), input_mask, output)
+            if outputs is None:
+                outputs = np.lib.format.open_memmap(join(tmp_path, 'outputs.npy'), mode='w+', dtype=np.float16,
+                                                    shape=(num_examples,) + encoded.shape[1:])
+            outputs[batch] = encoded
+        outputs.flush()
+        shape = outputs.shape
+        del outputs
+        for name in ['input_mask', 'label_ids']:
+            np.save(join(tmp_path, name + '.npy'), np.ascontiguousarray(features[name]))
+        with open(join(tmp_path, 'meta.json'), 'w', encoding='utf-8') as meta_file:
+            json.dump({'key_info': key_info, 'output': output, 'shape': list(shape)}, meta_file)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another process finished the same entry first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def load_or_build(self, key, features, embed_fn, output='sequence', batch_size=64, key_info=None):
+        """ Return the cached encoder outputs, running the encoder over the features & storing them on a miss """
+        cached = self.load(key)
+        if cached is not None:
+            print("[FrozenOutputCache] Loaded cached {} outputs ({})".format(output, key[:12]))
+            return cached
+        print("[FrozenOutputCache] No cached {} outputs, encoding {} examples...".format(
+            output, len(features['input_ids'])))
+        self.save(key, features, embed_fn, output, batch_size, key_info)
+        return self.load(key)
+
+
+def extract_head(model):
+    """ The classification head of a Kashgari model (every layer after its embedding), applied to a new input that
+        takes the embedding outputs. The layers are shared, so training this head trains the Kashgari model
+        Only heads made of a chain of layers (CNNLSTMModel, BiGRU_Model...) are supported
+    """
+    embed_layers = set(id(layer) for layer in model.embedding.embed_model.layers)
+    inputs = tf.keras.layers.Input(shape=(None, model.embedding.embedding_size), name='frozen_outputs')
+    tensor = inputs
+    for layer in model.tf_model.layers:
+        if id(layer) not in embed_layers:
+            tensor = layer(tensor)
+    return tf.keras.Model(inputs, tensor)
+
+
+def build_pooled_head(hidden_size, num_labels, dropout_rate=0.1):
+    """ A dropout & softmax classifier over pooled encoder outputs """
+    inputs = tf.keras.layers.Input(shape=(hidden_size,), name='frozen_outputs')
+    tensor = tf.keras.layers.Dropout(dropout_rate)(inputs)
+    return tf.keras.Model(inputs, tf.keras.layers.Dense(num_labels, activation='softmax')(tensor))
+
+
+def save_pooled_head(head, model_path, output, label_index):
+    """ Store a pooled head with its output type ('cls' or 'mean') & the output index of each label id """
+    os.makedirs(model_path, exist_ok=True)
+    head.save(join(model_path, FROZEN_HEAD_FILE))
+    with open(join(model_path, FROZEN_HEAD_INFO_FILE), 'w', encoding='utf-8') as info_file:
+        json.dump({'output': output, 'label_index': [int(idx) for idx in label_index]}, info_file)
+
+
+def load_pooled_head(model_path):
+    """ The pooled head saved with save_pooled_head & its settings """
+    with open(join(model_path, FROZEN_HEAD_INFO_FILE), 'r', encoding='utf-8') as info_file:
+        info = json.load(info_file)
+    return tf.keras.models.load_model(join(model_path, FROZEN_HEAD_FILE)), info
+
+
+def make_pooled_head_predict_fn(embed_fn, head, output, positive_idx):
+    """ Wrap a frozen encoder (see make_embed_fn) & a pooled head into predict_fn(input_ids, input_mask,
+        segment_ids), returning 'True' probabilities
+    """
+    graph = tf.compat.v1.get_default_graph()
+
+    def predict_fn(input_ids, input_mask, segment_ids):
+        pooled = pool_outputs(np.asarray(embed_fn(input_ids, input_mask, segment_ids)), np.asarray(input_mask), output)
+        with graph.as_default():
+            return head.predict(pooled, batch_size=len(input_ids))[:, positive_idx]
+
+    return predict_fn
+
+
+def make_loss(loss_type='cross_entropy', label_smoothing=0., focal_gamma=2.):
+    """ The Keras loss of a loss_type flag ('cross_entropy', 'focal_loss', 'kld', 'hinge' or 'squared_hinge') """
+    if loss_type == 'cross_entropy':
+        return tf.keras.losses.CategoricalCrossentropy(label_smoothing=label_smoothing)
+    if loss_type == 'kld':
+        return tf.keras.losses.KLDivergence()
+    if loss_type == 'hinge':
+        return tf.keras.losses.CategoricalHinge()
+    if loss_type == 'squared_hinge':
+        return tf.keras.losses.SquaredHinge()
+
+    def focal_loss(y_true, y_pred):
+        num_labels = tf.cast(tf.shape(y_true)[-1], y_pred.dtype)
+        y_true = y_true * (1 - label_smoothing) + label_smoothing / num_labels
+        y_pred = tf.clip_by_value(y_pred, 1e-7, 1 - 1e-7)
+        return -tf.reduce_sum(y_true * tf.pow(1 - y_pred, focal_gamma) * tf.math.log(y_pred), axis=-1)
+
+    return focal_loss
+
+
+def _head_batcher(cached, batch_size, shuffle, pad_multiple):
+    """ Batch cached outputs; sequence outputs are trimmed to each batch's longest input, like token ids are """
+    sequence_features = ['outputs', 'input_mask'] if np.ndim(cached['outputs']) == 3 else ['input_mask']
+    return BucketBatcher(cached, batch_size, shuffle=shuffle, pad_multiple=pad_multiple,
+                         sequence_features=sequence_features)
+
+
+def train_head(head, cached, label_index, batch_size=16, epochs=3, loss='categorical_crossentropy', pad_multiple=8):
+    """ Train a head on cached encoder outputs
+        :parameter cached: The cached 'outputs', 'input_mask' & 'label_ids' (see FrozenOutputCache)
+        :parameter label_index: The output index of each label id (0 for False, 1 for True)
+    """
+    batcher = _head_batcher(cached, batch_size, shuffle=True, pad_multiple=pad_multiple)
+    log_padding_efficiency(batcher, 'Head training')
+    one_hot = np.eye(len(label_index))[label_index]
+
+    def batches():
+        while True:
+            for _, batch in batcher:
+                yield batch['outputs'].astype(np.float32), one_hot[batch['label_ids']]
+
+    head.compile(optimizer='adam', loss=loss, metrics=['accuracy'])
+    head.fit_generator(batches(), steps_per_epoch=len(batcher), epochs=epochs)
+    return head
+
+
+def predict_head(head, cached, positive_idx, batch_size=64, pad_multiple=8):
+    """ The probability of the 'True' label for every cached example, in the original order """
+    batcher = _head_batcher(cached, batch_size, shuffle=False, pad_multiple=pad_multiple)
+    probabilities = np.zeros(len(batcher.lengths), dtype=np.float32)
+    for indices, batch in batcher:
+        probabilities[indices] = head.predict(batch['outputs'].astype(np.float32),
+                                              batch_size=len(indices))[:, positive_idx]
+    return probabilities
@@ -0,0 +1,123 @@
+import csv
+import numpy as np
+import tensorflow as tf
+from tqdm import tqdm
+from .features import PairEncoder, pad_feature, aggregate_windows
+from .batching import predict_bucketed
+
+
+def make_predict_fn(model, batch_size=64):
+    """ Wrap a fine-tuned Kashgari classification model into predict_fn(input_ids, input_mask, segment_ids)
+        The returned function can be called from any thread (the model's graph is captured here)
+        :returns A function returning the probability of the 'True' label for every input row
+    """
+    label2idx = model.embedding.processor.label2idx
+    positive_idx = next((label2idx[label] for label in (True, 'True', '1') if label in label2idx), 1)
+    graph = tf.compat.v1.get_default_graph()
+
+    def predict_fn(input_ids, input_mask, segment_ids):
+        with graph.as_default():
+            probabilities = model.tf_model.predict([input_ids, segment_ids], batch_size=batch_size)
+        return np.asarray(probabilities)[:, positive_idx]
+
+    return predict_fn
+
+
+def predict_question_groups(groups, tokenizer, max_sequence_len, predict_fn, max_batch_size=64,
+                            dynamic_padding=False, window_stride=0, window_aggregation='max', retriever=None,
+                            default_probability=0.):
+    """ Score question groups (see preprocess.iter_question_groups) paragraph by paragraph
+        Each question is tokenized once, & all of its paragraphs are scored together in one batch
+        (split into several batches only when there are more than max_batch_size paragraphs)
+        :parameter dynamic_padding: Pad each question's batch to its longest paragraph instead of max_sequence_len
+        :parameter window_stride: When positive, paragraphs longer than max_sequence_len are scored as overlapping
+                                  windows with this stride instead of being truncated
+        :parameter window_aggregation: How window probabilities are combined per paragraph ('max' or 'mean')
+        :parameter retriever: When given (see retrieval.ParagraphRetriever), only the paragraphs it selects are scored
+                              by the model, the others get default_probability
+        :returns A generator of (group, probabilities) tuples, one probability per paragraph, order preserved
+    """
+    encoder = PairEncoder(tokenizer, max_sequence_len)
+    for group in groups:
+        selected = retriever.select(group) if retriever is not None else np.arange(len(group['paragraphs']))
+        question_ids = encoder.token_ids(group['question'])
+        encoded, example_index = [], []
+        for idx, paragraph_idx in enumerate(selected):
+            text_ids = encoder.token_ids(group['paragraphs'][paragraph_idx]['text'])
+            windows = encoder.encode_windows(question_ids, text_ids, window_stride) if window_stride > 0 \
+                else [encoder.encode(question_ids, text_ids, pad_to=0)]
+            encoded.extend(windows)
+            example_index.extend([idx] * len(windows))
+        pad_to = max(len(input_ids) for input_ids, _, _ in encoded) if dynamic_padding and encoded \
+            else max_sequence_len
+        features = [pad_feature(feature, pad_to) for feature in encoded]
+        probabilities = []
+        for start in range(0, len(features), max_batch_size):
+            input_ids, input_mask, segment_ids = (np.asarray(column, dtype=np.int32)
+                                                  for column in zip(*features[start:start + max_batch_size]))
+            probabilities.extend(predict_fn(input_ids, input_mask, segment_ids))
+        group_probabilities = np.full(len(group['paragraphs']), default_probability, dtype=np.float32)
+        group_probabilities[selected] = aggregate_windows(probabilities, example_index, len(selected),
+                                                          window_aggregation)
+        yield group, group_probabilities
+
+
+def predict_features(features, predict_fn, batch_size=64, pad_multiple=8, window_aggregation='max'):
+    """ Score cached feature arrays in length-bucketed batches
+        Window features (with 'example_index', see features.convert_records_to_windows) are aggregated per example
+        :returns (probabilities, labels), one entry per example in the original order
+    """
+    probabilities = predict_bucketed(features, predict_fn, batch_size=batch_size, pad_multiple=pad_multiple)
+    labels = np.asarray(features['label_ids'])
+    if 'example_index' not in features:
+        return probabilities, labels
+    example_index = np.asarray(features['example_index'])
+    num_examples = int(example_index.max()) + 1 if len(example_index) else 0
+    example_labels = np.zeros(num_examples, dtype=labels.dtype)
+    example_labels[example_index] = labels
+    return aggregate_windows(probabilities, example_index, num_examples, window_aggregation), example_labels
+
+
+def write_predictions(results, output_file, output_mode='zalo', threshold=0.5, encode='utf-8'):
+    """ Write scored question groups to a CSV file as soon as each group is scored
+        :parameter results: An iterable of (group, probabilities) tuples
+        :parameter output_mode: 'zalo' for the submission format (test_id,answer of every positive paragraph),
+                                'full' for one row per paragraph (guid,question,text,label,prediction,probabilities)
+        :parameter threshold: The minimum probability for a paragraph to be predicted as True
+        :returns The number of positive predictions written
+    """
+    num_positive = 0
+    with open(output_file, 'w', encoding=encode, newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        if output_mode == 'zalo':
+            writer.writerow(['test_id', 'answer'])
+        else:
+            writer.writerow(['guid', 'question', 'text', 'label', 'prediction', 'probabilities'])
+        for group, probabilities in tqdm(results):
+            for paragraph, probability in zip(group['paragraphs'], probabilities):
+                prediction = probability >= threshold
+                num_positive += int(prediction)
+                if output_mode == 'zalo':
+                    if prediction:
+                        writer.writerow([group['__id__'], paragraph['id']])
+                else:
+                    writer.writerow([paragraph['guid'], group['question'], paragraph['text'],
+                                     int(bool(paragraph['label'])), int(prediction),
+                                     probability if prediction else 1 - probability])
+    return num_positive
+
+
+def evaluate_predictions(labels, probabilities, threshold=0.5):
+    """ Accuracy, precision, recall & F1 score of the 'True' label
+        :parameter labels: Ground truth labels (0/1 or booleans)
+        :parameter probabilities: Predicted probabilities of the 'True' label
+    """
+    labels = np.asarray(labels).astype(bool)
+    predictions = np.asarray(probabilities) >= threshold
+    true_positive = float(np.sum(predictions & labels))
+    precision = true_positive / max(np.sum(predictions), 1)
+    recall = true_positive / max(np.sum(labels), 1)
+    return {'accuracy': float(np.mean(predictions == labels)) if len(labels) else 0.,
+            'precision': precision,
+            'recall': recall,
+            'f1_score': 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.}
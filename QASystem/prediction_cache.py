@@ -0,0 +1,125 @@
+import hashlib
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+import numpy as np
+from .feature_cache import file_sha256
+
+
+def model_files_id(filepaths, settings=None):
+    """ Identify the weights a predict_fn uses by the content of their files (& the settings changing its outputs) """
+    digest = hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8'))
+    for filepath in filepaths:
+        digest.update(file_sha256(filepath).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class PredictionCache(object):
+    """ Persistent cache of predicted probabilities: an in-memory LRU in front of an SQLite key-value file
+        Every stored batch is committed, so an interrupted run keeps all the predictions it paid for
+    """
+
+    def __init__(self, path, capacity=100000):
+        """ PredictionCache constructor
+            :parameter path: The SQLite file (':memory:' for a cache living as long as the process)
+            :parameter capacity: The number of predictions kept in memory
+        """
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS predictions (key TEXT PRIMARY KEY, probability REAL)')
+        self.connection.commit()
+        self.capacity = capacity
+        self.memory = OrderedDict()
+        self.lookups = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self._lock = threading.Lock()
+
+    def _remember(self, key, probability):
+        self.memory[key] = probability
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    def get_many(self, keys, chunk_size=500):
+        """ The cached probabilities of the keys that are in the cache, as a {key: probability} dict """
+        keys = list(keys)
+        found = {}
+        with self._lock:
+            memory_hits = 0
+            for key in keys:
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    found[key] = self.memory[key]
+                    memory_hits += 1
+            missing = [key for key in set(keys) if key not in found]
+            for start in range(0, len(missing), chunk_size):
+                chunk = missing[start:start + chunk_size]
+                rows = self.connection.execute('SELECT key, probability FROM predictions WHERE key IN ({})'
+                                               .format(','.join('?' * len(chunk))), chunk)
+                for key, probability in rows:
+                    found[key] = probability
+                    self._remember(key, probability)
+            self.lookups += len(keys)
+            self.memory_hits += memory_hits
+            self.disk_hits += sum(1 for key in keys if key in found) - memory_hits
+        return found
+
+    def put_many(self, items):
+        """ Store (key, probability) pairs """
+        items = [(key, float(probability)) for key, probability in items]
+        with self._lock:
+            for key, probability in items:
+                self._remember(key, probability)
+            self.connection.executemany('INSERT OR REPLACE INTO predictions (key, probability) VALUES (?, ?)', items)
+            self.connection.commit()
+
+    def stats(self):
+        with self._lock:
+            misses = self.lookups - self.memory_hits - self.disk_hits
+            return {'lookups': self.lookups, 'memory_hits': self.memory_hits, 'disk_hits': self.disk_hits,
+                    'misses': misses, 'hit_rate': (self.memory_hits + self.disk_hits) / float(max(self.lookups, 1))}
+
+    def log_stats(self):
+        stats = self.stats()
+        print("[PredictionCache] {} lookups: {:.1f}% hits ({} in memory, {} on disk), {} pairs scored by the model"
+              .format(stats['lookups'], stats['hit_rate'] * 100, stats['memory_hits'], stats['disk_hits'],
+                      stats['misses']))
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+
+class CachedPredictor(object):
+    """ predict_fn(input_ids, input_mask, segment_ids) answering from a PredictionCache, the wrapped predict_fn
+        only scores the rows missing from it
+        A row is keyed by its (unpadded) token & segment ids, i.e. the (question, text) pair normalized by the
+        model's tokenizer, & by the model id. Pairs differing only in spacing or Unicode form share an entry
+    """
+
+    def __init__(self, predict_fn, cache, model_id):
+        """ CachedPredictor constructor
+            :parameter model_id: Identifies the weights of predict_fn (see model_files_id), so cached
+                                 predictions are never reused for another model
+        """
+        self.predict_fn = predict_fn
+        self.cache = cache
+        self.model_id = model_id.encode('utf-8')
+
+    def keys(self, input_ids, input_mask, segment_ids):
+        lengths = np.asarray(input_mask).sum(axis=1)
+        return [hashlib.sha256(self.model_id + np.asarray(input_ids[idx, :length], dtype='<i4').tobytes() +
+                               np.asarray(segment_ids[idx, :length], dtype=np.int8).tobytes()).hexdigest()
+                for idx, length in enumerate(lengths)]
+
+    def __call__(self, input_ids, input_mask, segment_ids):
+        keys = self.keys(input_ids, input_mask, segment_ids)
+        found = self.cache.get_many(keys)
+        probabilities = np.asarray([found.get(key, 0.) for key in keys], dtype=np.float32)
+        missing = np.asarray([idx for idx, key in enumerate(keys) if key not in found], dtype=np.int64)
+        if len(missing):
+            scored = np.asarray(self.predict_fn(input_ids[missing], input_mask[missing], segment_ids[missing]))
+            probabilities[missing] = scored
+            self.cache.put_many((keys[idx], probability) for idx, probability in zip(missing, scored))
+        return probabilities
@@ -2,11 +2,428 @@ from tqdm import tqdm
 from os.path import join, exists
 import json
 import collections
+import collections.abc
 import tensorflow as tf
 import random
+import re
+from array import array
 
 random.seed(0)
 
+_JSON_DECODER = json.JSONDecoder()
+_READ_CHUNK_SIZE = 1 << 16
+# The characters changing the bracket & string state of a JSON text, outside & inside strings
+_JSON_STRUCTURE = re.compile(r'[\[\]{}"]')
+_JSON_STRING_SPECIAL = re.compile(r'["\\]')
+
+
+class _JsonStream(object):
+    """ Incremental reader over a JSON text file, decoding one value at a time
+        Only the currently decoded value (plus one read chunk) is ever held in memory
+    """
+    def __init__(self, file, chunk_size=_READ_CHUNK_SIZE):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        """ Append the next chunk of the file to the buffer, return False on EOF """
+        if self.eof:
+            return False
+        chunk = self.file.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """ Return the next non-whitespace character without consuming it ('' at EOF) """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, char):
+        """ Consume the next non-whitespace character, which must be `char` """
+        found = self.peek()
+        if found != char:
+            raise ValueError("[Preprocess] Malformed JSON: expected '{}' but found '{}'".format(char, found))
+        self.pos += 1
+
+    def _read_value(self):
+        """ Buffer the whole container or string starting at the current position
+            The text is scanned once, chunk by chunk, keeping the bracket & string state, & the chunks are joined
+            once, so a value spanning many chunks is read in linear time
+            :returns False if the file ends before the value does
+        """
+        depth, in_string, end = 0, False, None
+        piece, idx = self.buffer, self.pos
+        pieces = None   # Only built when the value goes past the buffer
+        while True:
+            while end is None:
+                match = (_JSON_STRING_SPECIAL if in_string else _JSON_STRUCTURE).search(piece, idx)
+                if match is None:
+                    break
+                char, idx = match.group(), match.end()
+                if in_string:
+                    if char == '\\':
+                        idx += 1    # Skip the escaped character
+                        continue
+                    in_string = False
+                    end = idx if depth == 0 else None
+                elif char == '"':
+                    in_string = True
+                elif char in '[{':
+                    depth += 1
+                else:
+                    depth -= 1
+                    end = idx if depth == 0 else None
+            if end is not None:
+                break
+            # An escaped character may be the first one of the next chunk
+            idx = max(idx - len(piece), 0)
+            if pieces is None:
+                pieces = [self.buffer[self.pos:]]
+            piece = self.file.read(self.chunk_size)
+            if not piece:
+                self.eof = True
+                break
+            pieces.append(piece)
+        if pieces is not None:
+            self.buffer = ''.join(pieces)
+            self.pos = 0
+        return end is not None
+
+    def decode(self):
+        """ Decode & consume the next complete JSON value """
+        if self.peek() in ('[', '{', '"'):
+            self._read_value()
+            value, self.pos = _JSON_DECODER.raw_decode(self.buffer, self.pos)
+            return value
+        while True:
+            try:
+                value, end = _JSON_DECODER.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if not self._fill():
+                    raise
+                continue
+            # A number cut at the buffer end (e.g. '2.5' of '2.5e3') may continue in the next chunk
+            if not isinstance(value, (dict, list, str)) \
+                    and (end == len(self.buffer) or self.buffer[end] in '.eE+-0123456789') and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def iter_array(self):
+        """ Yield each element of the JSON array starting at the current position """
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.decode()
+            if self.peek() == ',':
+                self.pos += 1
+            else:
+                self.expect(']')
+                return
+
+    def iter_object_keys(self):
+        """ Yield each key of the JSON object starting at the current position
+            The caller must consume the key's value (decode/iter_array) before resuming iteration
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.decode()
+            self.expect(':')
+            yield key
+            if self.peek() == ',':
+                self.pos += 1
+            else:
+                self.expect('}')
+                return
+
+
+def _iter_json_lines(file):
+    """ Yield the JSON value of every non-empty line of a JSON Lines file """
+    for line in file:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def _is_json_lines(filepath):
+    return filepath.endswith('.jsonl')
+
+
+def _iter_instances(file, filepath):
+    """ Yield the Zalo-format instances of a JSON array file, or of a JSON Lines file (one instance per line) """
+    if _is_json_lines(filepath):
+        return _iter_json_lines(file)
+    return _JsonStream(file).iter_array()
+
+
+def _iter_squad_articles(file, filepath):
+    """ Yield the articles of a SQuAD-format file ({'data': [...]}, or a bare list of articles), or of a JSON Lines
+        file (one article per line), one article decoded at a time
+    """
+    if _is_json_lines(filepath):
+        for article in _iter_json_lines(file):
+            yield article
+        return
+    stream = _JsonStream(file)
+    if stream.peek() == '[':
+        for article in stream.iter_array():
+            yield article
+        return
+    for key in stream.iter_object_keys():
+        if key != 'data':
+            stream.decode()
+            continue
+        for article in stream.iter_array():
+            yield article
+
+
+def _iter_squad_paragraphs(articles):
+    """ Yield (context, qas list) for every paragraph of a stream of SQuAD articles """
+    for article in articles:
+        for par in article.get('paragraphs'):
+            yield par.get('context'), par.get('qas')
+
+
+def iter_records(filepath, encode='utf-8', mode='train'):
+    """ Incrementally read a dataset file & yield one input record at a time
+        Zalo-format files (a JSON array of question/text pairs) are decoded one instance at a time,
+        SQuAD-format files (data/paragraphs/qas) one article at a time. JSON Lines files (*.jsonl) hold one
+        Zalo instance (or one SQuAD article in 'squad' mode) per line
+        Grouped Zalo test instances (one question with many 'paragraphs') are flattened into one record per paragraph
+        :parameter filepath: The source file path
+        :parameter encode: The encoding of the source file
+        :parameter mode: 'squad' for SQuAD-format files, any other mode for Zalo-format files
+        :returns A generator of {'question', 'text', 'label'} dicts, file order preserved
+    """
+    try:
+        file = open(filepath, 'r', encoding=encode)
+    except FileNotFoundError:
+        return
+    with file:
+        if mode == 'squad':
+            for context, qas_list in _iter_squad_paragraphs(_iter_squad_articles(file, filepath)):
+                for qas in qas_list:
+                    yield {'question': qas.get('question'),
+                           'text': context,
+                           'label': qas.get('is_impossible')}
+        else:
+            for data_instance in _iter_instances(file, filepath):
+                if 'paragraphs' in data_instance:
+                    for paragraph in data_instance['paragraphs']:
+                        yield {'question': data_instance['question'],
+                               'text': paragraph['text'],
+                               'label': paragraph.get('label', False)}
+                    continue
+                yield {'question': data_instance['question'],
+                       'text': data_instance['text'],
+                       'label': data_instance.get('label', False)}
+
+
+def iter_question_groups(filepath, encode='utf-8'):
+    """ Incrementally read a Zalo-format file & yield one question with all of its paragraphs at a time
+        Grouped test files ('__id__', 'question', 'paragraphs') are yielded as they are, while consecutive
+        flat instances sharing the same question are merged into a single group. JSON Lines files (*.jsonl) hold one
+        instance per line
+        :parameter filepath: The source file path
+        :parameter encode: The encoding of the source file
+        :returns A generator of {'__id__', 'question', 'title', 'paragraphs': [{'id', 'guid', 'text', 'label'}]} dicts
+    """
+    try:
+        file = open(filepath, 'r', encoding=encode)
+    except FileNotFoundError:
+        return
+    with file:
+        group = None
+        for idx, data_instance in enumerate(_iter_instances(file, filepath)):
+            if 'paragraphs' in data_instance:
+                if group is not None:
+                    yield group
+                    group = None
+                yield {'__id__': data_instance['__id__'],
+                       'question': data_instance['question'],
+                       'title': data_instance.get('title'),
+                       'paragraphs': [{'id': paragraph['id'],
+                                       'guid': '{}_{}'.format(data_instance['__id__'], paragraph['id']),
+                                       'text': paragraph['text'],
+                                       'label': paragraph.get('label', False)}
+                                      for paragraph in data_instance['paragraphs']]}
+                continue
+
+            if group is None or group['question'] != data_instance['question']:
+                if group is not None:
+                    yield group
+                group = {'__id__': data_instance.get('__id__', 'q{}'.format(idx)),
+                         'question': data_instance['question'],
+                         'title': data_instance.get('title'),
+                         'paragraphs': []}
+            guid = data_instance.get('id', str(idx))
+            group['paragraphs'].append({'id': guid,
+                                        'guid': guid,
+                                        'text': data_instance['text'],
+                                        'label': data_instance.get('label', False)})
+        if group is not None:
+            yield group
+
+
+def merge_question_groups(groups):
+    """ Merge the question groups sharing the same question text across a whole file, in first-seen order
+        iter_question_groups only merges consecutive flat instances, while flat files like val.json & test_full.json
+        spread the paragraphs of a question over the file. The groups are held in memory
+        :parameter groups: An iterable of question groups (see iter_question_groups)
+        :returns A list of question groups, the paragraphs of each one in file order
+    """
+    merged = collections.OrderedDict()
+    for group in groups:
+        if group['question'] not in merged:
+            merged[group['question']] = dict(group, paragraphs=list(group['paragraphs']))
+        else:
+            merged[group['question']]['paragraphs'].extend(group['paragraphs'])
+    return list(merged.values())
+
+
+def shuffle_buffer(records, buffer_size, rng=random):
+    """ Approximately shuffle a stream of records while holding at most `buffer_size` of them in memory
+        :parameter records: Any iterable of records
+        :parameter buffer_size: The number of records kept in the shuffle buffer (<= 1 disables shuffling)
+        :parameter rng: The random generator used (the module-level, seeded generator by default)
+        :returns A generator yielding every record exactly once
+    """
+    if buffer_size is None or buffer_size <= 1:
+        for record in records:
+            yield record
+        return
+
+    buffer = []
+    for record in records:
+        if len(buffer) < buffer_size:
+            buffer.append(record)
+            continue
+        idx = rng.randrange(buffer_size)
+        yield buffer[idx]
+        buffer[idx] = record
+    rng.shuffle(buffer)
+    for record in buffer:
+        yield record
+
+
+class RecordStore(object):
+    """ Compact storage for question/text records where many questions share the same text (SQuAD paragraphs)
+        Every distinct text is stored once in `contexts`, each record only keeps an integer context id
+    """
+
+    def __init__(self):
+        self.contexts = []
+        self.questions = []
+        self.context_ids = array('l')
+        self.labels = []
+        self._context_index = {}
+
+    def add_context(self, text):
+        """ Store a text (if not seen before) & return its context id """
+        context_id = self._context_index.get(text)
+        if context_id is None:
+            context_id = len(self.contexts)
+            self._context_index[text] = context_id
+            self.contexts.append(text)
+        return context_id
+
+    def add(self, question, context_id, label):
+        """ Add a record referring to an already stored context """
+        self.questions.append(question)
+        self.context_ids.append(context_id)
+        self.labels.append(label)
+
+    def shuffle(self, rng=random):
+        """ Shuffle the records in place (contexts are left untouched)
+            RecordViews refer to record indices, so they see other records afterwards
+        """
+        order = list(range(len(self.questions)))
+        rng.shuffle(order)
+        self.questions = [self.questions[idx] for idx in order]
+        self.context_ids = array('l', (self.context_ids[idx] for idx in order))
+        self.labels = [self.labels[idx] for idx in order]
+
+    def __len__(self):
+        return len(self.questions)
+
+    def __getitem__(self, idx):
+        context_id = self.context_ids[idx]
+        return {'question': self.questions[idx],
+                'text': self.contexts[context_id],
+                'label': self.labels[idx],
+                'context_id': context_id}
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
+class RecordView(collections.abc.Mapping):
+    """ Read-only dict-like view of one RecordStore record ('question', 'text', 'label' & 'context_id'), so a list of
+        records can refer to the store instead of holding a dict per record
+    """
+    __slots__ = ('store', 'idx')
+
+    def __init__(self, store, idx):
+        self.store = store
+        self.idx = idx
+
+    def __getitem__(self, key):
+        if key == 'question':
+            return self.store.questions[self.idx]
+        if key == 'text':
+            return self.store.contexts[self.store.context_ids[self.idx]]
+        if key == 'label':
+            return self.store.labels[self.idx]
+        if key == 'context_id':
+            return self.store.context_ids[self.idx]
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(('question', 'text', 'label', 'context_id'))
+
+    def __len__(self):
+        return 4
+
+
+def read_squad_to_store(filepath, encode='utf-8', store=None):
+    """ Read a SQuAD-format file (or a JSON Lines file of SQuAD articles) into a RecordStore, keeping each paragraph
+        context once
+        :parameter filepath: The source file path
+        :parameter encode: The encoding of the source file
+        :parameter store: An existing RecordStore to extend (a new one is created if None)
+        :returns The filled RecordStore
+    """
+    store = RecordStore() if store is None else store
+    try:
+        file = open(filepath, 'r', encoding=encode)
+    except FileNotFoundError:
+        return store
+    with file:
+        for context, qas_list in tqdm(_iter_squad_paragraphs(_iter_squad_articles(file, filepath))):
+            context_id = store.add_context(context)
+            for qas in qas_list:
+                store.add(qas.get('question'), context_id, qas.get('is_impossible'))
+    return store
+
+
 class ZaloDatasetProcessor(object):
     """ Base class to process & store input data for the Zalo AI Challenge dataset"""
     label_list = ['False', 'True']
@@ -18,79 +435,57 @@ class ZaloDatasetProcessor(object):
         self.train_data = []
         self.val_data = []
         self.test_data = []
+        self.squad_data = RecordStore()
 
     def load_from_path(self, dataset_path, mode='train', file_name='train.json', encode='utf-8'):
         """ Load data from file & store into memory
             Need to be called before preprocess(before write_all_to_tfrecords) is called
+            Every record is held in memory & shuffled in full: use stream_from_path for constant memory
+            SQuAD-format files ('squad' mode) are stored in `squad_data` (a RecordStore keeping every paragraph
+            context once, for convert_store_to_features) & added to `train_data` like other training records, as
+            RecordViews into that store. JSON Lines files (*.jsonl) are accepted in every mode
             :parameter dataset_path: The path to the directory where the dataset is stored
             :parameter encode: The encoding of every dataset file
         """
         mode = mode.lower()
         assert mode in ['train', 'test', 'val', 'squad'], "[Preprocess] Test file mode must be 'zalo' or 'normal'"
 
-        def read_to_inputs(filepath, encode='utf-8', mode='train'):
-            """ A helper function that read a json file (Zalo-format) & return a list of input
-                :parameter filepath The source file path
-                :parameter encode The encoding of the source file
-                :parameter mode Return data for training ('normal') or for submission ('zalo')
-                :returns A list of input for each data instance, order preserved
-            """
-            try:
-                with open(filepath, 'r', encoding=encode) as file:
-                    data = json.load(file)
-                    if mode == 'squad':
-                        data = data.get('data')
-                        res = []
-                        for d in data:
-                            for par in d.get('paragraphs'):
-                                context = par.get('context')
-                                for qas in par.get('qas'):
-                                    try:
-                                        ques = qas.get('question')
-                                        # answer = qas.get('answers')
-                                        label = qas.get('is_impossible')
-                                        # if label:
-                                        #     answer_start = qas.get('plausible_answers')[0]['answer_start']
-                                        #     answer = ' '.join(context.split(' ')[answer_start:])
-                                        # else:
-                                        #     answer = ''
-                                        res.append({'question': ques,
-                                                     'text': context,
-                                                     'label': label})
-                                    except:
-                                        pass
-                        return res
-
-                    else:
-                        return [{'question': data_instance['question'],
-                                 'text': data_instance['text'],
-                                 'label': data_instance.get('label', False)}
-                                for data_instance in tqdm(data)]
-            except FileNotFoundError:
-                return []
-
+        if mode == "squad":
+            num_stored = len(self.squad_data)
+            read_squad_to_store(filepath=join(dataset_path, file_name), encode=encode, store=self.squad_data)
+            self.train_data.extend(RecordView(self.squad_data, idx) for idx in range(num_stored, len(self.squad_data)))
+        else:
+            records = tqdm(iter_records(filepath=join(dataset_path, file_name), encode=encode, mode=mode))
         # Get train data, convert to input
         if mode == "train":
-            train_data = read_to_inputs(filepath=join(dataset_path, file_name),
-                                        encode=encode, mode="train")
-            self.train_data.extend(train_data)
+            self.train_data.extend(records)
         # Get val data, convert to input
         if mode == "val":
-            val_data = read_to_inputs(filepath=join(dataset_path, file_name),
-                                      encode=encode, mode="val")
-            self.val_data.extend(val_data)
+            self.val_data.extend(records)
 
         if mode == "test":
-            test_data = read_to_inputs(filepath=join(dataset_path, file_name),
-                                       encode=encode, mode="test")
-            self.test_data.extend(test_data)
-
-        if mode == "squad":
-            train_data = read_to_inputs(filepath=join(dataset_path, file_name),
-                                        encode=encode, mode="squad")
-            self.train_data.extend(train_data)
+            self.test_data.extend(records)
 
         # Shuffle training data
         random.shuffle(self.train_data)
         # Shuffle validate data
         random.shuffle(self.val_data)
+
+    @staticmethod
+    def stream_from_path(dataset_path, mode='train', file_name='train.json', encode='utf-8',
+                         shuffle_buffer_size=10000):
+        """ Lazily read data from file without storing it, so training can start before the file is fully parsed
+            Memory usage is bounded by the shuffle buffer instead of the dataset size
+            :parameter dataset_path: The path to the directory where the dataset is stored
+            :parameter mode: The dataset mode ('train', 'val', 'test' or 'squad')
+            :parameter encode: The encoding of the dataset file
+            :parameter shuffle_buffer_size: The number of records held for shuffling (None or 0 keeps file order)
+            :returns A generator of {'question', 'text', 'label'} dicts
+        """
+        mode = mode.lower()
+        assert mode in ['train', 'test', 'val', 'squad'], "[Preprocess] Mode must be 'train', 'val', 'test' " \
+                                                         "or 'squad'"
+        records = iter_records(filepath=join(dataset_path, file_name), encode=encode, mode=mode)
+        if mode == 'test':
+            return records
+        return shuffle_buffer(records, shuffle_buffer_size)
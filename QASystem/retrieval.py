@@ -0,0 +1,225 @@
+import argparse
+import json
+import math
+import re
+import unicodedata
+from collections import Counter, defaultdict
+import numpy as np
+from .preprocess import iter_question_groups, merge_question_groups
+
+SCORERS = ['bm25', 'tfidf']
+# The paragraphs the term statistics (document frequencies, average length) are computed over
+SCOPES = ['group', 'title', 'file']
+
+
+def tokenize_syllables(text):
+    """ The lowercase syllables of a Vietnamese text (its whitespace-separated words), punctuation dropped """
+    return re.findall(r'\w+', unicodedata.normalize('NFC', text).lower())
+
+
+class TermStatistics(object):
+    """ Document frequencies & average length of a collection of tokenized paragraphs """
+
+    def __init__(self, documents=()):
+        self.num_documents = 0
+        self.total_length = 0
+        self.document_frequency = Counter()
+        for tokens in documents:
+            self.add(tokens)
+
+    def add(self, tokens):
+        self.num_documents += 1
+        self.total_length += len(tokens)
+        self.document_frequency.update(set(tokens))
+
+    @property
+    def average_length(self):
+        return self.total_length / float(max(self.num_documents, 1))
+
+    def bm25_idf(self, term):
+        df = self.document_frequency[term]
+        return math.log(1 + (self.num_documents - df + 0.5) / (df + 0.5))
+
+    def tfidf_idf(self, term):
+        return math.log((1. + self.num_documents) / (1. + self.document_frequency[term])) + 1
+
+
+class ParagraphIndex(object):
+    """ Inverted index (syllable -> [(paragraph, term frequency)]) of the candidate paragraphs of a question """
+
+    def __init__(self, documents, statistics=None):
+        """ ParagraphIndex constructor
+            :parameter documents: The tokenized paragraphs
+            :parameter statistics: The TermStatistics of a collection holding these paragraphs (Default is the
+                                   paragraphs themselves)
+        """
+        self.statistics = TermStatistics(documents) if statistics is None else statistics
+        self.lengths = np.asarray([len(tokens) for tokens in documents], dtype=np.float64)
+        self.postings = defaultdict(list)
+        for doc, tokens in enumerate(documents):
+            for term, count in Counter(tokens).items():
+                self.postings[term].append((doc, count))
+
+    def bm25(self, query, k1=1.2, b=0.75):
+        """ The Okapi BM25 score of every paragraph for the tokenized query """
+        scores = np.zeros(len(self.lengths))
+        norms = k1 * (1 - b + b * self.lengths / max(self.statistics.average_length, 1e-9))
+        for term in set(query):
+            idf = self.statistics.bm25_idf(term)
+            for doc, count in self.postings.get(term, ()):
+                scores[doc] += idf * count * (k1 + 1) / (count + norms[doc])
+        return scores
+
+    def tfidf(self, query):
+        """ The cosine similarity of the (1 + log tf) * idf vectors of every paragraph & the tokenized query """
+        scores = np.zeros(len(self.lengths))
+        norms = np.zeros(len(self.lengths))
+        query_counts = Counter(query)
+        query_norm = 0.
+        for term, postings in self.postings.items():
+            idf = self.statistics.tfidf_idf(term)
+            query_weight = (1 + math.log(query_counts[term])) * idf if term in query_counts else 0.
+            for doc, count in postings:
+                weight = (1 + math.log(count)) * idf
+                norms[doc] += weight ** 2
+                scores[doc] += weight * query_weight
+        for term, count in query_counts.items():
+            query_norm += ((1 + math.log(count)) * self.statistics.tfidf_idf(term)) ** 2
+        return scores / np.maximum(np.sqrt(norms * query_norm), 1e-9)
+
+    def score(self, query, scorer='bm25'):
+        return self.bm25(query) if scorer == 'bm25' else self.tfidf(query)
+
+
+def collect_statistics(groups, scope='title'):
+    """ The TermStatistics of every title ('title' scope) or of the whole file ('file' scope, key None)
+        A paragraph shared by several questions is counted once
+    """
+    statistics, seen = defaultdict(TermStatistics), defaultdict(set)
+    for group in groups:
+        key = group.get('title') if scope == 'title' else None
+        for paragraph in group['paragraphs']:
+            if paragraph['text'] not in seen[key]:
+                seen[key].add(paragraph['text'])
+                statistics[key].add(tokenize_syllables(paragraph['text']))
+    return dict(statistics)
+
+
+class ParagraphRetriever(object):
+    """ First stage of the prediction cascade: rank the paragraphs of a question lexically & keep only the top_k
+        ones scoring at least threshold; the model scores those, the others are predicted negative
+    """
+
+    def __init__(self, scorer='bm25', top_k=0, threshold=None, scope='group', statistics=None):
+        """ ParagraphRetriever constructor
+            :parameter top_k: The number of paragraphs kept per question (0 keeps them all)
+            :parameter threshold: The minimum lexical score of a kept paragraph (None for no minimum)
+            :parameter scope: The paragraphs the term statistics come from: the question's ('group'), the ones
+                              sharing its title ('title') or the whole file ('file')
+            :parameter statistics: The statistics of the 'title' & 'file' scopes (see collect_statistics)
+        """
+        assert scorer in SCORERS, "[Retrieval] Scorer must be one of {}".format(SCORERS)
+        assert scope in SCOPES, "[Retrieval] Scope must be one of {}".format(SCOPES)
+        assert scope == 'group' or statistics is not None, "[Retrieval] The {} scope needs statistics".format(scope)
+        self.scorer = scorer
+        self.top_k = top_k
+        self.threshold = threshold
+        self.scope = scope
+        self.statistics = statistics
+        self.num_paragraphs = 0
+        self.num_kept = 0
+
+    @classmethod
+    def from_file(cls, filepath, encode='utf-8', scope='group', **kwargs):
+        """ A retriever for the question groups of a file, reading it once first for the 'title' & 'file' scopes """
+        statistics = None if scope == 'group' else collect_statistics(iter_question_groups(filepath, encode), scope)
+        return cls(scope=scope, statistics=statistics, **kwargs)
+
+    def scores(self, group):
+        """ The lexical score of every paragraph of a question group """
+        statistics = None
+        if self.scope != 'group':
+            statistics = self.statistics.get(group.get('title') if self.scope == 'title' else None)
+        index = ParagraphIndex([tokenize_syllables(paragraph['text']) for paragraph in group['paragraphs']],
+                               statistics)
+        return index.score(tokenize_syllables(group['question']), self.scorer)
+
+    def select(self, group):
+        """ The (sorted) indices of the paragraphs of a question group the model should score """
+        scores = self.scores(group)
+        kept = np.argsort(-scores, kind='stable')
+        if self.top_k > 0:
+            kept = kept[:self.top_k]
+        if self.threshold is not None:
+            kept = kept[scores[kept] >= self.threshold]
+        self.num_paragraphs += len(scores)
+        self.num_kept += len(kept)
+        return np.sort(kept)
+
+    def log_stats(self):
+        print("[Retrieval] {} of {} paragraphs scored by the model ({:.1f}%), the others are predicted negative"
+              .format(self.num_kept, self.num_paragraphs, self.num_kept * 100. / max(self.num_paragraphs, 1)))
+
+
+def evaluate_retrieval(groups, retriever):
+    """ The recall of the positive paragraphs kept by the retriever & the share of paragraphs left to the model
+        The groups should hold every paragraph of their question (see preprocess.merge_question_groups)
+        Since the model can only find the kept positives, the recall is an upper bound of the cascade's recall
+    """
+    positives = kept_positives = covered_questions = answerable_questions = 0
+    for group in groups:
+        kept = set(retriever.select(group).tolist())
+        labels = [bool(paragraph['label']) for paragraph in group['paragraphs']]
+        group_kept_positives = sum(1 for idx, label in enumerate(labels) if label and idx in kept)
+        positives += sum(labels)
+        kept_positives += group_kept_positives
+        if any(labels):
+            answerable_questions += 1
+            covered_questions += int(group_kept_positives == sum(labels))
+    return {'recall': kept_positives / float(max(positives, 1)),
+            'question_recall': covered_questions / float(max(answerable_questions, 1)),
+            'compute': retriever.num_kept / float(max(retriever.num_paragraphs, 1)),
+            'paragraphs': retriever.num_paragraphs,
+            'kept_paragraphs': retriever.num_kept}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report the recall/compute trade-off of the lexical retrieval '
+                                                 'cascade on labelled Zalo-format files')
+    parser.add_argument('-i', '--input_files', nargs='+', required=True,
+                        help='Labelled Zalo-format files (flat like val.json & test_full.json, or grouped)')
+    parser.add_argument('--scorers', nargs='+', default=SCORERS, choices=SCORERS, help='The lexical scorers')
+    parser.add_argument('--scopes', nargs='+', default=['group', 'title'], choices=SCOPES,
+                        help='The scopes of the term statistics')
+    parser.add_argument('--top_k', nargs='+', type=int, default=[1, 2, 3, 4, 5],
+                        help='The numbers of paragraphs kept per question')
+    parser.add_argument('--thresholds', nargs='*', type=float, default=[],
+                        help='The minimum scores of a kept paragraph (tried without a top_k limit)')
+    parser.add_argument('-o', '--output_file', default=None, help='Write the results as JSON to this file')
+    parser.add_argument('-e', '--encoding', default='utf-8', help='The encoding of the input files')
+    args = parser.parse_args()
+
+    settings = [(top_k, None) for top_k in args.top_k] + [(0, threshold) for threshold in args.thresholds]
+    results = []
+    for input_file in args.input_files:
+        # Flat files spread the paragraphs of a question over the file, rank them all together
+        groups = merge_question_groups(iter_question_groups(input_file, args.encoding))
+        for scope in args.scopes:
+            statistics = None if scope == 'group' else collect_statistics(groups, scope)
+            for scorer in args.scorers:
+                for top_k, threshold in settings:
+                    retriever = ParagraphRetriever(scorer, top_k, threshold, scope, statistics)
+                    result = dict(file=input_file, scope=scope, scorer=scorer, top_k=top_k, threshold=threshold,
+                                  **evaluate_retrieval(groups, retriever))
+                    results.append(result)
+                    print("{file} {scope:>5} {scorer:>5} top_k={top_k} threshold={threshold}: recall {recall:.2%} "
+                          "(all positives of {question_recall:.2%} of the questions) for {compute:.2%} of the "
+                          "paragraphs".format(**result))
+
+    if args.output_file is not None:
+        with open(args.output_file, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
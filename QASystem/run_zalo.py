@@ -1,6 +1,24 @@
 import tensorflow as tf
 from os.path import join, exists
-from .preprocess import ZaloDatasetProcessor
+from .preprocess import ZaloDatasetProcessor, iter_question_groups, merge_question_groups, shuffle_buffer
+from .predict import make_predict_fn, predict_question_groups, write_predictions, evaluate_predictions, \
+    predict_features
+from .batching import BucketBatcher, StreamBatcher, log_padding_efficiency, train_on_stream
+from .features import PairEncoder
+from .server import MicroBatcher, serve
+from .export import export_model, load_exported_predictor, FrozenGraphPredictor, QuantizedPredictor
+import numpy as np
+from .feature_cache import load_features
+from .frozen_features import FrozenOutputCache, frozen_cache_key, checkpoint_id, saved_model_id, make_embed_fn, \
+    extract_head, build_pooled_head, make_loss, train_head, predict_head, save_pooled_head, load_pooled_head, \
+    make_pooled_head_predict_fn, FROZEN_HEAD_FILE, FROZEN_HEAD_INFO_FILE
+from .distillation import student_config, build_student, save_student, load_student, make_teacher_logits_fn, \
+    make_student_predict_fn, train_student, train_student_on_stream, compare_models, STUDENT_CONFIG_FILE, \
+    STUDENT_WEIGHTS_FILE
+from .early_exit import EarlyExitPredictor, parse_exit_layers, count_transformer_layers, make_exit_outputs_fn, \
+    save_exit_heads, load_exit_heads, exit_probabilities, sweep_thresholds, EXIT_HEADS_FILE
+from .prediction_cache import PredictionCache, CachedPredictor, model_files_id
+from .retrieval import ParagraphRetriever
 from .modeling import BertClassifierModel
 from bert import tokenization
 import kashgari
@@ -9,6 +27,10 @@ from kashgari.embeddings import BERTEmbedding, TransformerEmbedding
 from kashgari.tokenizer import BertTokenizer
 from kashgari.tasks.classification import CNNLSTMModel
 
+import os
+import json
+import itertools
+import time
 import logging
 logging.basicConfig(level='DEBUG')
 
@@ -37,6 +59,14 @@ flags.DEFINE_string("test_predict_outputmode", "zalo",
 
 flags.DEFINE_integer("max_sequence_len", 256,
                      "The maximum input sequence length for embeddings")
+flags.DEFINE_bool("dynamic_padding", False,
+                  "Group inputs of similar length & pad every batch only to its own longest input. "
+                  "The model must be trained with a variable sequence length")
+flags.DEFINE_integer("window_stride", 0,
+                     "When positive, texts longer than max_sequence_len are scored as overlapping windows "
+                     "starting every window_stride tokens instead of being truncated (eval & predict modes)")
+flags.DEFINE_string("window_aggregation", "max",
+                    "How window probabilities are combined into one prediction ('max' or 'mean')")
 flags.DEFINE_bool("do_lowercase", False,
                   "Whether to lower case the input text. Should be True for uncased "
                   "models and False for cased models.")
@@ -44,6 +74,8 @@ flags.DEFINE_float("model_learning_rate", 1e-5,
                    "The default model learning rate")
 flags.DEFINE_integer("model_batch_size", 16,
                      "Training input batch size")
+flags.DEFINE_integer("predict_batch_size", 64,
+                     "The maximum number of paragraphs scored in one prediction batch")
 flags.DEFINE_integer("train_epochs", 3,
                      "Number of loops to train the whole dataset")
 flags.DEFINE_float("train_dropout_rate", 0.1,
@@ -77,21 +109,441 @@ flags.DEFINE_string("eval_predict_csv_file", None,
 flags.DEFINE_float("dev_size", 0.2,
                    "The size of the development set taken from the training set"
                    "If dev_filename exists, this is ignored")
+flags.DEFINE_string("serve_host", "127.0.0.1",
+                    "The host the prediction server (mode 'serve') listens on")
+flags.DEFINE_integer("serve_port", 8000,
+                     "The port the prediction server (mode 'serve') listens on")
+flags.DEFINE_integer("serve_max_batch_size", 32,
+                     "The maximum number of requests the prediction server scores in one micro-batch")
+flags.DEFINE_integer("serve_max_wait_ms", 5,
+                     "The maximum time (ms) a request waits for others to fill its micro-batch")
+flags.DEFINE_string("export_dir", "./exported",
+                    "Destination of the frozen, CPU-optimized model written in mode 'export'")
+flags.DEFINE_bool("export_quantize", True,
+                  "Also write a TFLite model with dynamic int8 quantization in mode 'export'")
+flags.DEFINE_string("exported_model_dir", None,
+                    "Predict with an exported model (see mode 'export') instead of the Kashgari model in model_path")
+flags.DEFINE_bool("use_quantized_model", True,
+                  "Use the int8-quantized model when predicting from exported_model_dir (if it was exported)")
+flags.DEFINE_string("feature_cache_dir", "./feature_cache",
+                    "Directory of the on-disk tokenized feature cache (empty to always re-tokenize)")
+flags.DEFINE_integer("shuffle_buffer_size", 0,
+                     "When positive, train & distill read the training files as a stream, tokenized batch by batch & "
+                     "shuffled through a buffer of this many records, instead of tokenizing them all first (0 to "
+                     "load them into the feature cache)")
+flags.DEFINE_string("prediction_cache_file", "./prediction_cache.sqlite",
+                    "SQLite file caching the predicted probability of every scored pair, keyed by its tokens & the "
+                    "model, consulted by eval, predict_test & serve (empty to always run the model)")
+flags.DEFINE_integer("prediction_cache_size", 100000,
+                     "The number of cached predictions also kept in memory (least recently used ones are dropped)")
+flags.DEFINE_string("head_model", "cnn_lstm",
+                    "The classification head on top of BERT ('cnn_lstm' or 'bigru')")
+flags.DEFINE_string("frozen_features", None,
+                    "Run the frozen BERT once over the training & development sets, cache its 'sequence' or "
+                    "'pooled' outputs & train the head from that cache (None to train end to end)")
+flags.DEFINE_string("frozen_cache_dir", "./frozen_cache",
+                    "Directory of the on-disk cache of frozen BERT outputs (memory-mapped float16 arrays)")
+flags.DEFINE_bool("use_frozen_head", False,
+                  "Predict (eval, predict_test, serve) with the head trained on 'pooled' frozen features, on top of "
+                  "the pretrained BERT, instead of the Kashgari model in model_path")
+flags.DEFINE_string("student_path", None,
+                    "Directory of the distilled student (Default is model_path/student)")
+flags.DEFINE_bool("use_student", False,
+                  "Predict (eval, predict_test, serve) with the distilled student instead of the fine-tuned model")
+flags.DEFINE_bool("distill_train", True,
+                  "In distill mode, train the student (False only compares an already distilled one to the teacher)")
+flags.DEFINE_string("distill_squad_filename", None,
+                    "SQuAD-format file added to the distillation data (train_filename & train_augmented_filename)")
+flags.DEFINE_integer("student_num_layers", 4,
+                     "The number of transformer layers of the student")
+flags.DEFINE_integer("student_hidden_size", 0,
+                     "The hidden size of the student (0 keeps the teacher's, & initializes the student from the first "
+                     "layers of the pretrained BERT checkpoint)")
+flags.DEFINE_integer("student_num_heads", 0,
+                     "The number of attention heads of the student (0 for student_hidden_size / 64)")
+flags.DEFINE_float("student_learning_rate", 5e-5,
+                   "The learning rate of the student")
+flags.DEFINE_float("distill_temperature", 2.0,
+                   "The temperature softening the teacher & student distributions")
+flags.DEFINE_float("distill_alpha", 0.5,
+                   "The weight of the teacher soft labels in the student loss (the labels get 1 - alpha)")
+flags.DEFINE_integer("latency_examples", 200,
+                     "The number of development examples scored one at a time to measure the latency")
+flags.DEFINE_string("exit_layers", "2,4,6,8,10",
+                    "The BERT layers followed by an exit head, trained in train_exits mode (comma separated)")
+flags.DEFINE_float("early_exit_threshold", None,
+                   "Predict (eval, predict_test, serve) with early exit: an example stops at the first exit head whose "
+                   "prediction entropy is below this (in nats, at most ln 2 ~ 0.69) (None runs every layer)")
+flags.DEFINE_integer("retrieval_top_k", 0,
+                     "When predicting test questions, only score the top k paragraphs of each question (ranked "
+                     "lexically) with BERT & predict the others as negative (0 to score every paragraph)")
+flags.DEFINE_float("retrieval_threshold", None,
+                   "When predicting test questions, predict paragraphs whose lexical score is below this as negative "
+                   "without running BERT (None for no threshold)")
+flags.DEFINE_string("retrieval_scorer", "bm25",
+                    "The lexical scorer of the retrieval stage ('bm25' or 'tfidf')")
+flags.DEFINE_string("retrieval_scope", "group",
+                    "The paragraphs the retrieval term statistics come from: the question's ('group'), the ones "
+                    "sharing its title ('title') or the whole test file ('file')")
 
 
 def main(_):
     print("[Main] Starting....")
+    vocab_path = join(FLAGS.bert_model_path, 'vocab.txt')
+    config_path = join(FLAGS.bert_model_path, 'bert_config.json')
+    checkpoint_path = join(FLAGS.bert_model_path, 'bert_model.ckpt')
+    student_path = FLAGS.student_path or join(FLAGS.model_path, 'student')
 
     # Tokenizer initialzation
-    tokenizer = BertTokenizer.load_from_vacob_file(vocab_path)
-    embed = TransformerEmbedding(vocab_path, config_path, checkpoint_path,
-                                 bert_type='bert',
-                                 task=kashgari.CLASSIFICATION,
-                                 sequence_length=FLAGS.max_sequence_len)
-    processor = ZaloDatasetProcessor()
-    processor.load_from_path("")
-    model = CNNLSTMModel(embed)
-    model.evaluate()
+    tokenizer = tokenization.FullTokenizer(vocab_file=vocab_path, do_lower_case=FLAGS.do_lowercase)
+
+    def load_split_features(file_name, mode, window_stride=0):
+        """ Tokenized input arrays of a dataset file, served from the feature cache after the first run """
+        return load_features(join(FLAGS.dataset_path, file_name), mode, tokenizer, vocab_path,
+                             FLAGS.do_lowercase, FLAGS.max_sequence_len, encode=FLAGS.encoding,
+                             cache_dir=FLAGS.feature_cache_dir, window_stride=window_stride)
+
+    def stream_batcher(dataset_files, batch_size):
+        """ Training batches read from a stream of the records of dataset files (a list of (file name, mode)),
+            shuffled together through a buffer of shuffle_buffer_size records. Nothing is cached, memory is bounded
+            by the buffer & the batcher window instead of the dataset size
+        """
+        def records_fn():
+            return shuffle_buffer(itertools.chain.from_iterable(
+                ZaloDatasetProcessor.stream_from_path(FLAGS.dataset_path, mode, file_name, FLAGS.encoding,
+                                                      shuffle_buffer_size=0) for file_name, mode in dataset_files),
+                FLAGS.shuffle_buffer_size)
+
+        return StreamBatcher(records_fn, PairEncoder(tokenizer, FLAGS.max_sequence_len), batch_size,
+                             pad_multiple=pad_multiple)
+
+    def load_predict_fn(batch_size):
+        """ The fine-tuned model as predict_fn, from the CPU export if exported_model_dir is set
+            Wrapped into a CachedPredictor when prediction_cache_file is set
+        """
+        predict_fn = load_model_predict_fn(batch_size)
+        if not FLAGS.prediction_cache_file:
+            return predict_fn
+        return CachedPredictor(predict_fn, PredictionCache(FLAGS.prediction_cache_file, FLAGS.prediction_cache_size),
+                               predictor_id())
+
+    def load_model_predict_fn(batch_size):
+        if FLAGS.use_student:
+            return make_student_predict_fn(load_student(student_path))
+        if FLAGS.use_frozen_head:
+            head, info = load_pooled_head(FLAGS.model_path)
+            # Same frozen BERT as in training, its embed_model takes inputs of any length
+            embed = TransformerEmbedding(vocab_path, config_path, checkpoint_path, bert_type='bert',
+                                         task=kashgari.CLASSIFICATION, sequence_length=FLAGS.max_sequence_len)
+            return make_pooled_head_predict_fn(make_embed_fn(embed.embed_model), head, info['output'],
+                                               info['label_index'][1])
+        if FLAGS.exported_model_dir is not None:
+            return load_exported_predictor(FLAGS.exported_model_dir, quantized=FLAGS.use_quantized_model)
+        model = kashgari.utils.load_model(FLAGS.model_path)
+        if FLAGS.early_exit_threshold is not None:
+            return EarlyExitPredictor(model, load_exit_heads(FLAGS.model_path), FLAGS.early_exit_threshold)
+        return make_predict_fn(model, batch_size)
+
+    def predictor_id():
+        """ Identify the model load_predict_fn predicts with, for the prediction cache """
+        if FLAGS.use_student:
+            return model_files_id([join(student_path, STUDENT_CONFIG_FILE), join(student_path, STUDENT_WEIGHTS_FILE)])
+        if FLAGS.use_frozen_head:
+            return model_files_id([join(FLAGS.model_path, FROZEN_HEAD_FILE),
+                                   join(FLAGS.model_path, FROZEN_HEAD_INFO_FILE)],
+                                  {'bert': checkpoint_id(checkpoint_path, config_path)})
+        if FLAGS.exported_model_dir is not None:
+            return model_files_id([join(FLAGS.exported_model_dir, file_name)
+                                   for file_name in sorted(os.listdir(FLAGS.exported_model_dir))],
+                                  {'quantized': FLAGS.use_quantized_model})
+        if FLAGS.early_exit_threshold is not None:
+            return model_files_id([join(FLAGS.model_path, EXIT_HEADS_FILE)],
+                                  {'model': saved_model_id(FLAGS.model_path), 'threshold': FLAGS.early_exit_threshold})
+        return saved_model_id(FLAGS.model_path)
+
+    def log_predict_stats(predict_fn):
+        """ Log the cache hit rates & early exit statistics of a predict_fn from load_predict_fn """
+        if isinstance(predict_fn, CachedPredictor):
+            predict_fn.cache.log_stats()
+            predict_fn = predict_fn.predict_fn
+        if isinstance(predict_fn, EarlyExitPredictor):
+            predict_fn.log_stats()
+
+    # Without dynamic padding, every batch is rounded up to the full max_sequence_len
+    pad_multiple = 8 if FLAGS.dynamic_padding else FLAGS.max_sequence_len
+
+    if FLAGS.mode.lower() == 'predict_test':
+        # Test files are read one question at a time, all paragraphs of a question are scored in one batch
+        print("[Main] Begin Predict based on Test file")
+        test_path = join(FLAGS.dataset_path, FLAGS.test_filename)
+        retriever = None
+        if FLAGS.retrieval_top_k > 0 or FLAGS.retrieval_threshold is not None:
+            # Cheap lexical first stage: BERT only scores the paragraphs sharing the most terms with the question
+            retriever = ParagraphRetriever.from_file(test_path, encode=FLAGS.encoding,
+                                                     scope=FLAGS.retrieval_scope.lower(),
+                                                     scorer=FLAGS.retrieval_scorer.lower(),
+                                                     top_k=FLAGS.retrieval_top_k,
+                                                     threshold=FLAGS.retrieval_threshold)
+        groups = iter_question_groups(test_path, encode=FLAGS.encoding)
+        if retriever is not None:
+            # A question is ranked against all of its paragraphs, even when a flat file spreads them out
+            groups = merge_question_groups(groups)
+        predict_fn = load_predict_fn(FLAGS.predict_batch_size)
+        results = predict_question_groups(groups, tokenizer, FLAGS.max_sequence_len, predict_fn,
+                                          max_batch_size=FLAGS.predict_batch_size,
+                                          dynamic_padding=FLAGS.dynamic_padding,
+                                          window_stride=FLAGS.window_stride,
+                                          window_aggregation=FLAGS.window_aggregation,
+                                          retriever=retriever)
+        num_positive = write_predictions(results, FLAGS.zalo_predict_csv_file,
+                                         output_mode=FLAGS.test_predict_outputmode.lower(), encode=FLAGS.encoding)
+        print('[Main] {} positive paragraphs written to {}'.format(num_positive, FLAGS.zalo_predict_csv_file))
+        if retriever is not None:
+            retriever.log_stats()
+        log_predict_stats(predict_fn)
+        print('[Main] Finished')
+        return
+
+    if FLAGS.mode.lower() == 'serve':
+        # The model is loaded once, concurrent requests are coalesced into micro-batches
+        batcher = MicroBatcher(load_predict_fn(FLAGS.serve_max_batch_size), tokenizer,
+                               FLAGS.max_sequence_len, max_batch_size=FLAGS.serve_max_batch_size,
+                               max_wait_ms=FLAGS.serve_max_wait_ms, dynamic_padding=FLAGS.dynamic_padding)
+        serve(batcher, host=FLAGS.serve_host, port=FLAGS.serve_port)
+        print('[Main] Finished')
+        return
+
+    if FLAGS.mode.lower() == 'export':
+        print('[Main] Exporting the fine-tuned model to {}'.format(FLAGS.export_dir))
+        model = kashgari.utils.load_model(FLAGS.model_path)
+        export_model(model, FLAGS.export_dir, FLAGS.max_sequence_len, quantize=FLAGS.export_quantize)
+
+        # Compare the exported artifacts against the original float32 model on the development set
+        dev_features = load_split_features(FLAGS.dev_filename or 'val.json', 'val', FLAGS.window_stride)
+        predictors = [('float32', make_predict_fn(model, FLAGS.predict_batch_size)),
+                      ('frozen float32', FrozenGraphPredictor(FLAGS.export_dir))]
+        if FLAGS.export_quantize:
+            predictors.append(('int8', QuantizedPredictor(FLAGS.export_dir)))
+        reference = None
+        for name, predict_fn in predictors:
+            start_time = time.time()
+            probabilities, labels = predict_features(dev_features, predict_fn, batch_size=FLAGS.predict_batch_size,
+                                                     pad_multiple=pad_multiple,
+                                                     window_aggregation=FLAGS.window_aggregation)
+            elapsed = time.time() - start_time
+            result = evaluate_predictions(labels, probabilities)
+            reference = result if reference is None else reference
+            print("[Main] {}: Accuracy {:.2f}% ({:+.2f}), F1 Score {:.2f} ({:+.2f}), {:.1f} examples/s"
+                  .format(name, result['accuracy'] * 100, (result['accuracy'] - reference['accuracy']) * 100,
+                          result['f1_score'] * 100, (result['f1_score'] - reference['f1_score']) * 100,
+                          len(probabilities) / max(elapsed, 1e-9)))
+        print('[Main] Finished')
+        return
+
+    if FLAGS.mode.lower() == 'distill':
+        # The fine-tuned teacher labels the training data once, its logits are cached like frozen BERT outputs
+        teacher = kashgari.utils.load_model(FLAGS.model_path)
+        label2idx = teacher.embedding.processor.label2idx
+        label_index = np.asarray([label2idx[label] for label in ZaloDatasetProcessor.label_list])
+        if FLAGS.distill_train:
+            print('[Main] Distilling {} into a {}-layer student'.format(FLAGS.model_path, FLAGS.student_num_layers))
+            train_files = [(FLAGS.train_filename, 'train')]
+            if FLAGS.train_augmented_filename is not None:
+                train_files.append((FLAGS.train_augmented_filename, 'train'))
+            if FLAGS.distill_squad_filename is not None:
+                train_files.append((FLAGS.distill_squad_filename, 'squad'))
+            config = student_config(config_path, FLAGS.student_num_layers, FLAGS.student_hidden_size,
+                                    FLAGS.student_num_heads)
+            with open(config_path, 'r', encoding='utf-8') as config_file:
+                same_width = config['hidden_size'] == json.load(config_file)['hidden_size']
+            student = build_student(config, len(label_index), checkpoint_path if same_width else None,
+                                    FLAGS.train_dropout_rate)
+            teacher_logits_fn = make_teacher_logits_fn(teacher, label_index, FLAGS.predict_batch_size)
+            if FLAGS.shuffle_buffer_size > 0:
+                # The teacher labels every streamed batch as it comes instead of the whole cached dataset
+                train_student_on_stream(student, stream_batcher(train_files, FLAGS.model_batch_size),
+                                        teacher_logits_fn, len(label_index), epochs=FLAGS.train_epochs,
+                                        learning_rate=FLAGS.student_learning_rate,
+                                        temperature=FLAGS.distill_temperature, alpha=FLAGS.distill_alpha)
+            else:
+                train_features = [load_split_features(file_name, mode) for file_name, mode in train_files]
+                train_features = {name: np.concatenate([features[name] for features in train_features])
+                                  for name in train_features[0]}
+                key, key_info = frozen_cache_key([(join(FLAGS.dataset_path, file_name), mode)
+                                                  for file_name, mode in train_files], vocab_path,
+                                                 FLAGS.do_lowercase, FLAGS.max_sequence_len,
+                                                 saved_model_id(FLAGS.model_path), 'logits')
+                teacher_logits = FrozenOutputCache(FLAGS.frozen_cache_dir).load_or_build(
+                    key, train_features, teacher_logits_fn, 'logits', batch_size=FLAGS.predict_batch_size,
+                    key_info=key_info)['outputs']
+                train_student(student, train_features, teacher_logits, batch_size=FLAGS.model_batch_size,
+                              epochs=FLAGS.train_epochs, learning_rate=FLAGS.student_learning_rate,
+                              temperature=FLAGS.distill_temperature, alpha=FLAGS.distill_alpha,
+                              pad_multiple=pad_multiple)
+            save_student(student, config, student_path)
+            print('[Main] Student saved to {}'.format(student_path))
+        else:
+            student = load_student(student_path)
+
+        # Latencies are measured on the device TensorFlow runs on (hide the GPUs for CPU serving numbers)
+        dev_features = load_split_features(FLAGS.dev_filename or 'val.json', 'val', FLAGS.window_stride)
+        compare_models([('teacher', make_predict_fn(teacher, FLAGS.predict_batch_size)),
+                        ('student', make_student_predict_fn(student))], dev_features,
+                       batch_size=FLAGS.predict_batch_size, pad_multiple=pad_multiple,
+                       window_aggregation=FLAGS.window_aggregation, latency_examples=FLAGS.latency_examples)
+        print('[Main] Finished')
+        return
+
+    if FLAGS.mode.lower() == 'train_exits':
+        # BERT is frozen, so the exit heads are trained on cached [CLS] outputs of its intermediate layers
+        print('[Main] Training exit heads after layers {}'.format(FLAGS.exit_layers))
+        model = kashgari.utils.load_model(FLAGS.model_path)
+        exit_layers = parse_exit_layers(FLAGS.exit_layers)
+        label2idx = model.embedding.processor.label2idx
+        label_index = np.asarray([label2idx[label] for label in ZaloDatasetProcessor.label_list])
+        frozen_cache = FrozenOutputCache(FLAGS.frozen_cache_dir)
+        outputs_fn = make_exit_outputs_fn(model, exit_layers)
+        output_type = 'exits-{}'.format('-'.join(str(layer) for layer in exit_layers))
+        model_id = saved_model_id(FLAGS.model_path)
+
+        def load_exit_outputs(dataset_files, features):
+            key, key_info = frozen_cache_key([(join(FLAGS.dataset_path, file_name), mode)
+                                              for file_name, mode in dataset_files], vocab_path,
+                                             FLAGS.do_lowercase, FLAGS.max_sequence_len, model_id, output_type)
+            return frozen_cache.load_or_build(key, features, outputs_fn, output_type,
+                                              batch_size=FLAGS.predict_batch_size, key_info=key_info)
+
+        train_files = [(FLAGS.train_filename, 'train')]
+        if FLAGS.train_augmented_filename is not None:
+            train_files.append((FLAGS.train_augmented_filename, 'train'))
+        train_features = [load_split_features(file_name, mode) for file_name, mode in train_files]
+        train_features = {name: np.concatenate([features[name] for features in train_features])
+                          for name in train_features[0]}
+        train_outputs = load_exit_outputs(train_files, train_features)
+        heads = []
+        for exit_idx, layer in enumerate(exit_layers):
+            print('[Main] Training the exit head after layer {}'.format(layer))
+            head = build_pooled_head(train_outputs['outputs'].shape[-1], len(label_index), FLAGS.train_dropout_rate)
+            heads.append(train_head(head, dict(train_outputs, outputs=train_outputs['outputs'][:, exit_idx]),
+                                    label_index, batch_size=FLAGS.model_batch_size, epochs=FLAGS.train_epochs,
+                                    loss=make_loss(FLAGS.loss_type.lower(), FLAGS.loss_label_smooth),
+                                    pad_multiple=pad_multiple))
+        save_exit_heads(FLAGS.model_path, exit_layers, heads)
+        print('[Main] Exit heads saved to {}'.format(FLAGS.model_path))
+
+        if FLAGS.dev_filename is not None:
+            # Every exit is scored once, the early exit decisions of each threshold are replayed from those scores
+            dev_features = load_split_features(FLAGS.dev_filename, 'val')
+            dev_outputs = load_exit_outputs([(FLAGS.dev_filename, 'val')], dev_features)
+            exit_heads = load_exit_heads(FLAGS.model_path)
+            exit_label_probabilities = np.stack([exit_probabilities(exit_heads, dev_outputs['outputs'][:, exit_idx],
+                                                                    exit_idx)
+                                                 for exit_idx in range(len(exit_layers))], axis=1)
+            final_probabilities, labels = predict_features(dev_features,
+                                                           make_predict_fn(model, FLAGS.predict_batch_size),
+                                                           batch_size=FLAGS.predict_batch_size,
+                                                           pad_multiple=pad_multiple)
+            sweep_thresholds(exit_label_probabilities, final_probabilities, labels, exit_layers,
+                             count_transformer_layers(model), positive_idx=label_index[1])
+        print('[Main] Finished')
+        return
+
+    if FLAGS.mode.lower() == 'train':
+        print('[Main] Begin training')
+        train_files = [(FLAGS.train_filename, 'train')]
+        if FLAGS.train_augmented_filename is not None:
+            train_files.append((FLAGS.train_augmented_filename, 'train'))
+        train_features = None
+        if FLAGS.shuffle_buffer_size <= 0:
+            train_features = [load_split_features(file_name, mode) for file_name, mode in train_files]
+            train_features = {name: np.concatenate([features[name] for features in train_features])
+                              for name in train_features[0]}
+
+        embed = TransformerEmbedding(vocab_path, config_path, checkpoint_path,
+                                     bert_type='bert',
+                                     task=kashgari.CLASSIFICATION,
+                                     sequence_length='variable' if FLAGS.dynamic_padding
+                                     else FLAGS.max_sequence_len)
+        model = {'cnn_lstm': CNNLSTMModel, 'bigru': BiGRU_Model}[FLAGS.head_model.lower()](embed)
+        # Build the graph & label dict from the label names only, inputs are fed as (cached) token ids below
+        model.build_model([[label] for label in ZaloDatasetProcessor.label_list], ZaloDatasetProcessor.label_list)
+        label2idx = model.embedding.processor.label2idx
+        label_index = np.asarray([label2idx[label] for label in ZaloDatasetProcessor.label_list])
+
+        if FLAGS.frozen_features is not None:
+            # TransformerEmbedding freezes BERT, so its outputs are computed once & only the head is trained
+            output_type = 'sequence' if FLAGS.frozen_features.lower() == 'sequence' \
+                else 'cls' if FLAGS.use_pooled_output else 'mean'
+            frozen_cache = FrozenOutputCache(FLAGS.frozen_cache_dir)
+            embed_fn = make_embed_fn(model.embedding.embed_model)
+            bert_checkpoint = checkpoint_id(checkpoint_path, config_path)
+
+            def load_frozen_outputs(dataset_files, features):
+                key, key_info = frozen_cache_key([(join(FLAGS.dataset_path, file_name), mode)
+                                                  for file_name, mode in dataset_files], vocab_path,
+                                                 FLAGS.do_lowercase, FLAGS.max_sequence_len, bert_checkpoint,
+                                                 output_type)
+                return frozen_cache.load_or_build(key, features, embed_fn, output_type,
+                                                  batch_size=FLAGS.predict_batch_size, key_info=key_info)
+
+            head = extract_head(model) if output_type == 'sequence' \
+                else build_pooled_head(model.embedding.embedding_size, len(label_index), FLAGS.train_dropout_rate)
+            train_head(head, load_frozen_outputs(train_files, train_features), label_index,
+                       batch_size=FLAGS.model_batch_size, epochs=FLAGS.train_epochs,
+                       loss=make_loss(FLAGS.loss_type.lower(), FLAGS.loss_label_smooth), pad_multiple=pad_multiple)
+            if output_type == 'sequence':
+                # The head layers are shared with the Kashgari model, which every predict mode can load
+                model.save(FLAGS.model_path)
+            else:
+                # Not a Kashgari model: a single Dense layer over the pooled output, loaded by use_frozen_head
+                save_pooled_head(head, FLAGS.model_path, output_type, label_index)
+            print('[Main] Head training complete.')
+
+            if FLAGS.dev_filename is not None:
+                dev_outputs = load_frozen_outputs([(FLAGS.dev_filename, 'val')],
+                                                  load_split_features(FLAGS.dev_filename, 'val'))
+                probabilities = predict_head(head, dev_outputs, positive_idx=label_index[1],
+                                             batch_size=FLAGS.predict_batch_size, pad_multiple=pad_multiple)
+                eval_result = evaluate_predictions(dev_outputs['label_ids'], probabilities)
+                print('[Main] Evaluation complete')
+                print("Accuracy: {}%".format(eval_result['accuracy'] * 100))
+                print("F1 Score: {}".format(eval_result['f1_score'] * 100))
+                print("Recall: {}%".format(eval_result['recall'] * 100))
+                print("Precision: {}%".format(eval_result['precision'] * 100))
+            print('[Main] Finished')
+            return
+
+        if FLAGS.shuffle_buffer_size > 0:
+            # Training starts with the first batches read, the files are parsed along the way
+            train_on_stream(model.tf_model, stream_batcher(train_files, FLAGS.model_batch_size),
+                            epochs=FLAGS.train_epochs,
+                            targets_fn=lambda batch: np.eye(len(label_index))[label_index[batch['label_ids']]])
+        else:
+            train_batches = BucketBatcher(train_features, FLAGS.model_batch_size, shuffle=True,
+                                          pad_multiple=pad_multiple)
+            log_padding_efficiency(train_batches, 'Training')
+            one_hot_batches = ((inputs, np.eye(len(label_index))[label_index[label_ids]])
+                               for inputs, label_ids in train_batches.iter_epochs())
+            model.tf_model.fit_generator(one_hot_batches, steps_per_epoch=len(train_batches),
+                                         epochs=FLAGS.train_epochs)
+        model.save(FLAGS.model_path)
+        print('[Main] Training complete.')
+        predict_fn = make_predict_fn(model, FLAGS.predict_batch_size)
+    else:
+        predict_fn = load_predict_fn(FLAGS.predict_batch_size)
+
+    if FLAGS.mode.lower() in ['train', 'eval'] and FLAGS.dev_filename is not None:
+        dev_features = load_split_features(FLAGS.dev_filename, 'val', FLAGS.window_stride)
+        probabilities, labels = predict_features(dev_features, predict_fn, batch_size=FLAGS.predict_batch_size,
+                                                 pad_multiple=pad_multiple,
+                                                 window_aggregation=FLAGS.window_aggregation)
+        eval_result = evaluate_predictions(labels, probabilities)
+        print('[Main] Evaluation complete')
+        print("Accuracy: {}%".format(eval_result['accuracy'] * 100))
+        print("F1 Score: {}".format(eval_result['f1_score'] * 100))
+        print("Recall: {}%".format(eval_result['recall'] * 100))
+        print("Precision: {}%".format(eval_result['precision'] * 100))
+        log_predict_stats(predict_fn)
 
     # Training/Testing
     # if FLAGS.mode.lower() == 'train':
@@ -142,13 +594,35 @@ def main(_):
 
 if __name__ == "__main__":
     """ Sanity flags check """
-    assert FLAGS.mode.lower() in ['train', 'eval', 'predict_test', 'predict_manual'], \
-        "[FlagsCheck] Mode can only be 'train', 'eval', 'predict_test' or 'predict_manual'"
+    assert FLAGS.mode.lower() in ['train', 'eval', 'predict_test', 'predict_manual', 'serve', 'export', 'distill',
+                                  'train_exits'], \
+        "[FlagsCheck] Mode can only be 'train', 'eval', 'predict_test', 'predict_manual', 'serve', 'export', " \
+        "'distill' or 'train_exits'"
     assert exists(FLAGS.dataset_path), "[FlagsCheck] Dataset path doesn't exist"
     assert exists(FLAGS.bert_model_path), "[FlagsCheck] BERT pretrained model path doesn't exist"
     assert FLAGS.test_predict_outputmode.lower() in ['full', 'zalo'], "[FlagsCheck] Test file output mode " \
                                                                       "can only be 'full' or 'zalo'"
     assert FLAGS.model_path is not None, "[FlagsCheck] BERT finetuned model location must be set"
+    assert 0 <= FLAGS.window_stride <= FLAGS.max_sequence_len - 3 - FLAGS.max_sequence_len // 2, \
+        "[FlagsCheck] Window stride must be between 0 & {} (the text tokens of a window with the longest question)" \
+        .format(FLAGS.max_sequence_len - 3 - FLAGS.max_sequence_len // 2)
+    assert FLAGS.window_aggregation.lower() in ['max', 'mean'], "[FlagsCheck] Window aggregation can only be " \
+                                                                 "'max' or 'mean'"
+    assert FLAGS.head_model.lower() in ['cnn_lstm', 'bigru'], "[FlagsCheck] Head model can only be 'cnn_lstm' or " \
+                                                              "'bigru'"
+    assert FLAGS.frozen_features is None or FLAGS.frozen_features.lower() in ['sequence', 'pooled'], \
+        "[FlagsCheck] Frozen features can only be 'sequence' or 'pooled'"
     assert FLAGS.loss_type.lower() in ['cross_entropy', 'focal_loss', 'kld', 'squared_hinge', 'hinge'],\
         "[FlagsCheck] Incorrect loss function used"
+    assert FLAGS.retrieval_scorer.lower() in ['bm25', 'tfidf'], "[FlagsCheck] Retrieval scorer can only be 'bm25' " \
+                                                                "or 'tfidf'"
+    assert FLAGS.retrieval_scope.lower() in ['group', 'title', 'file'], "[FlagsCheck] Retrieval scope can only be " \
+                                                                        "'group', 'title' or 'file'"
+    assert FLAGS.early_exit_threshold is None or (not FLAGS.use_student and FLAGS.exported_model_dir is None), \
+        "[FlagsCheck] Early exit needs the fine-tuned Kashgari model (not the student or an exported model)"
+    assert FLAGS.shuffle_buffer_size <= 0 or FLAGS.frozen_features is None, \
+        "[FlagsCheck] Frozen features are cached for the whole training set, they can't be read as a stream"
+    assert not FLAGS.use_frozen_head or (not FLAGS.use_student and FLAGS.exported_model_dir is None and
+                                         FLAGS.early_exit_threshold is None), \
+        "[FlagsCheck] The frozen head can't be combined with the student, an exported model or early exit"
     tf.compat.v1.app.run()
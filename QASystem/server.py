@@ -0,0 +1,171 @@
+import json
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+import numpy as np
+from .features import PairEncoder
+
+
+class MicroBatcher(object):
+    """ Coalesce concurrent (question, paragraph) requests into micro-batches scored by a single worker thread
+        A batch is run as soon as max_batch_size pairs are waiting, or max_wait_ms after its first pair arrived
+    """
+
+    def __init__(self, predict_fn, tokenizer, max_sequence_len, max_batch_size=32, max_wait_ms=5,
+                 dynamic_padding=False, latency_window=10000):
+        """ MicroBatcher constructor
+            :parameter predict_fn: A function predict_fn(input_ids, input_mask, segment_ids) -> probabilities
+            :parameter max_batch_size: The maximum number of pairs scored together
+            :parameter max_wait_ms: The maximum time a pair waits for others before its batch is run
+            :parameter dynamic_padding: Pad each batch to its longest input instead of max_sequence_len
+            :parameter latency_window: The number of most recent requests used for the latency percentiles
+        """
+        self.predict_fn = predict_fn
+        self.encoder = PairEncoder(tokenizer, max_sequence_len)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.dynamic_padding = dynamic_padding
+        self.requests = queue.Queue()
+        self.latencies = deque(maxlen=latency_window)
+        self.num_requests = 0
+        self.num_batches = 0
+        self._lock = threading.Lock()
+        self._worker = threading.Thread(target=self._run, name='MicroBatcher')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def submit(self, question, paragraph):
+        """ Queue a pair for scoring & return a Future of its 'True' probability """
+        future = Future()
+        self.requests.put((question, paragraph, future, time.time()))
+        return future
+
+    def predict(self, pairs):
+        """ Score (question, paragraph) pairs, blocking until all of them are done """
+        futures = [self.submit(question, paragraph) for question, paragraph in pairs]
+        return [future.result() for future in futures]
+
+    def _next_batch(self):
+        """ Block for the first pair, then gather more until the batch is full or its wait time is over """
+        batch = [self.requests.get()]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            try:
+                batch.append(self.requests.get(timeout=timeout) if timeout > 0 else self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                encoded = [self.encoder.encode(self.encoder.token_ids(question), self.encoder.token_ids(paragraph),
+                                               pad_to=0)
+                           for question, paragraph, _, _ in batch]
+                pad_to = max(len(feature[0]) for feature in encoded) if self.dynamic_padding \
+                    else self.encoder.max_sequence_len
+                input_ids, input_mask, segment_ids = (
+                    np.asarray([column + [0] * (pad_to - len(column)) for column in columns], dtype=np.int32)
+                    for columns in zip(*encoded))
+                probabilities = self.predict_fn(input_ids, input_mask, segment_ids)
+            except Exception as e:
+                for _, _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            finished = time.time()
+            with self._lock:
+                self.num_batches += 1
+                self.num_requests += len(batch)
+                self.latencies.extend(finished - submitted for _, _, _, submitted in batch)
+            for (_, _, future, _), probability in zip(batch, probabilities):
+                future.set_result(float(probability))
+
+    def metrics(self):
+        """ Queue depth, request/batch counters & p50/p99 latency (ms) over the latency window
+            (& the prediction cache hit rates when predict_fn is a CachedPredictor)
+        """
+        with self._lock:
+            latencies = np.asarray(self.latencies) * 1000
+            num_requests, num_batches = self.num_requests, self.num_batches
+        metrics = {'queue_depth': self.requests.qsize(),
+                   'requests': num_requests,
+                   'batches': num_batches,
+                   'mean_batch_size': num_requests / float(num_batches) if num_batches else 0.,
+                   'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else 0.,
+                   'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else 0.}
+        if hasattr(self.predict_fn, 'cache'):
+            metrics['prediction_cache'] = self.predict_fn.cache.stats()
+        return metrics
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # Listen backlog, large enough for bursts of concurrent clients
+    request_queue_size = 1024
+
+
+def _make_handler(batcher):
+    class PredictionHandler(BaseHTTPRequestHandler):
+        """ POST /predict with {"question", "paragraph"} or {"pairs": [{"question", "paragraph"}, ...]}
+            GET /metrics for the batcher metrics
+        """
+
+        def _send_json(self, status, body):
+            payload = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self._send_json(200, batcher.metrics())
+            else:
+                self._send_json(404, {'error': 'Unknown path'})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._send_json(404, {'error': 'Unknown path'})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+                pairs = body['pairs'] if 'pairs' in body else [body]
+                pairs = [(pair['question'], pair['paragraph']) for pair in pairs]
+                # Checked here, a bad pair would otherwise fail the whole micro-batch it joins
+                for question, paragraph in pairs:
+                    if not isinstance(question, str) or not isinstance(paragraph, str):
+                        raise TypeError("'question' & 'paragraph' must be strings")
+            except (ValueError, KeyError, TypeError) as e:
+                self._send_json(400, {'error': 'Invalid request: {}'.format(e)})
+                return
+            try:
+                probabilities = batcher.predict(pairs)
+            except Exception as e:
+                self._send_json(500, {'error': str(e)})
+                return
+            self._send_json(200, {'probabilities': probabilities})
+
+        def log_message(self, format, *args):
+            pass
+
+    return PredictionHandler
+
+
+def serve(batcher, host='127.0.0.1', port=8000):
+    """ Serve a MicroBatcher over HTTP until interrupted """
+    server = _ThreadingHTTPServer((host, port), _make_handler(batcher))
+    print("[Server] Listening on http://{}:{} (POST /predict, GET /metrics)".format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -1,20 +1,32 @@
 import argparse
 import json
+from bisect import bisect_left
+from functools import partial
+from multiprocessing import Pool
 from os.path import exists
 from tqdm import tqdm
 from underthesea import sent_tokenize
+from record_io import RecordWriter, iter_squad_articles
 import random
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-i', '--input_file', default=None,
-                    help='The input dataset file (json) with SQuAD v2.0 format', required=True)
+                    help='The input dataset file (json) with SQuAD v2.0 format, or a JSON Lines file (jsonl) with one '
+                         'SQuAD article per line', required=True)
 parser.add_argument('-o', '--output_file', default="./out_zalo.json",
-                    help='The desired output file (json) with Zalo format', required=False)
+                    help='The desired output file with Zalo format: a json array, or one record per line if the '
+                         'file name ends with .jsonl', required=False)
 parser.add_argument('-e', '--encoding', default="utf-8",
                     help='The default encoding of the input/output dataset', required=False)
 parser.add_argument('-m', '--mode', default=None, help="The conversion mode (see Readme)", required=True)
 parser.add_argument('-s', '--size', default=180, required=False,
                     help="The maximum combined length of 'question' & 'text' allowed (used in mode 'short)")
+parser.add_argument('-w', '--workers', default=1, type=int, required=False,
+                    help="The number of worker processes used to convert the articles (output is identical to 1)")
+parser.add_argument('--seed', default=0, type=int, required=False,
+                    help="The random seed (used in mode 'veryshort', combined with the index of each article)")
+parser.add_argument('--flush_every', default=1000, type=int, required=False,
+                    help="The number of records written between two flushes of the output file")
 
 
 def get_word_count(text):
@@ -30,193 +42,212 @@ def get_word_count(text):
     return text_len
 
 
-def convert_mode_full(input_file, output_file, encoding):
-    convertedData = []
-
-    # Read data
-    with open(input_file, 'r', encoding=encoding) as stream:
-        squad = json.load(stream)
-
-    # Remove _ in title
-    for data in squad['data']:
+class SentenceIndex(object):
+    """ Per-paragraph sentence index: character offsets & word counts (with prefix sums) of every sentence
+        Built once per paragraph, so answers are located by binary search & text windows are measured in O(1)
+    """
+
+    def __init__(self, sentences, starts):
+        self.sentences = sentences
+        self.starts = starts
+        self.ends = [start + len(sentence) for start, sentence in zip(starts, sentences)]
+        self.word_counts = [get_word_count(sentence) for sentence in sentences]
+        self.prefix_counts = [0]
+        for word_count in self.word_counts:
+            self.prefix_counts.append(self.prefix_counts[-1] + word_count)
+
+    def __len__(self):
+        return len(self.sentences)
+
+    def sentence_at(self, offset):
+        """ The index of the sentence whose [start, end] span contains the character offset, or None """
+        idx = bisect_left(self.ends, offset)
+        if idx < len(self.sentences) and self.starts[idx] <= offset:
+            return idx
+        return None
+
+    def word_count(self, start_idx, end_idx):
+        """ The word count of the sentences [start_idx, end_idx) """
+        return self.prefix_counts[end_idx] - self.prefix_counts[start_idx]
+
+    def text(self, start_idx, end_idx):
+        return "".join(self.sentences[start_idx:end_idx])
+
+
+def sentence_starts(context, sentences):
+    """ The start offset of each sentence in the context, scanning forward from the previous sentence
+        (repeated sentences get their own offsets)
+        A sentence not found after the previous one (e.g. re-spaced by the sentence splitter) is placed right after it,
+        so the starts stay sorted
+    """
+    starts = []
+    position = 0
+    for sentence in sentences:
+        start = context.find(sentence, position)
+        if start == -1:
+            start = position
+        starts.append(start)
+        position = start + len(sentence)
+    return starts
+
+
+def convert_articles(convert_article, articles, workers=1):
+    """ Apply convert_article to every (article index, article) & yield the results one record at a time,
+        in article order
+        With several workers, the articles are sharded across a process pool (the output order stays the same)
+    """
+    articles = enumerate(articles)
+    if workers <= 1:
+        for result in map(convert_article, tqdm(articles)):
+            for record in result:
+                yield record
+        return
+
+    with Pool(workers) as pool:
+        for result in tqdm(pool.imap(convert_article, articles, chunksize=4)):
+            for record in result:
+                yield record
+
+
+def iter_articles(input_file, encoding):
+    """ Read the SQuAD articles & remove the _ symbol in their titles """
+    for data in iter_squad_articles(input_file, encoding):
         data['title'] = " ".join(data['title'].split('_'))
+        yield data
 
-    # Converting
-    for data in squad['data']:
-        for paragraph in tqdm(data['paragraphs']):
-            for qas in paragraph['qas']:
-                convertedData.append({
-                    'id': qas['id'],
-                    'question': qas['question'],
-                    'title': data['title'],
-                    'text': paragraph['context'],
-                    'label': False if qas['is_impossible'] else True
-                })
-
-    # Export converted data
-    with open(output_file, 'w', encoding=encoding) as stream:
-        stream.write(json.dumps(convertedData, ensure_ascii=False))
-
-
-def convert_mode_short(input_file, output_file, encoding):
-    with open(input_file, 'r', encoding=encoding) as stream:
-        squad = json.load(stream)
-
-    convertedData = []
-
-    # Remove _ symbol in title
-    for data in squad['data']:
-        data['title'] = " ".join(data['title'].split('_'))
 
-    # Format 2: Sentence as Text
-    for data in tqdm(squad['data']):
-        for paragraph in data['paragraphs']:
-            # Get paragraph split by sentences & determine its start index for easier processing
-            para_context = sent_tokenize(paragraph['context'])  # Context split into list of sentences
-            para_sent_startidxs = [0]   # Start index of each sentence in the paragraph
-            for idx, sentence in enumerate(para_context[:-1]):
-                para_sent_startidxs.append(para_sent_startidxs[idx] + len(sentence) + 1)
-
-            # Process question-answer pairs
-            for qas in paragraph['qas']:
-                # Prepare data to save
-                zaloQAS = {
-                    'id': qas['id'],
-                    'question': qas['question'],
-                    'title': data['title'],
-                    'label': False if qas['is_impossible'] else True
-                }
-                _question_len = get_word_count(qas['question'])
-
-                # Loop & get answer text for each qa pair
-                if len(qas['answers']) != 0 and qas['is_impossible'] is False \
-                        and qas['answers'][0]['answer_start'] != -1:
-                    # Only 1 answer, but rephrased
-                    answer_start = qas['answers'][0]['answer_start']
-
-                    # Find the sentence & sentence index that contains the answer
-                    _text = None
-                    _ans_sent_idx = None
-                    for idx in range(len(para_context)):
-                        curr_start_idx = para_sent_startidxs[idx]
-                        curr_end_idx = curr_start_idx + len(para_context[idx])
-                        if curr_start_idx <= answer_start <= curr_end_idx:
-                            _text = para_context[idx]
-                            _ans_sent_idx = idx
-                            break
-                        elif answer_start < curr_start_idx:
-                            break
+def convert_mode_full(input_file, output_file, encoding, flush_every=1000):
+    # Converting
+    with RecordWriter(output_file, encoding, flush_every=flush_every) as writer:
+        for data in iter_articles(input_file, encoding):
+            for paragraph in tqdm(data['paragraphs']):
+                for qas in paragraph['qas']:
+                    writer.write({
+                        'id': qas['id'],
+                        'question': qas['question'],
+                        'title': data['title'],
+                        'text': paragraph['context'],
+                        'label': False if qas['is_impossible'] else True
+                    })
+
+
+def convert_article_short(article, size):
+    """ Convert one SQuAD article (format 2: sentences around the answer as text) """
+    _, data = article
+    size = int(size)
+    converted_data = []
+    for paragraph in data['paragraphs']:
+        # Get paragraph split by sentences & determine its start index for easier processing
+        para_context = sent_tokenize(paragraph['context'])  # Context split into list of sentences
+        para_sent_startidxs = [0]   # Start index of each sentence in the paragraph
+        for idx, sentence in enumerate(para_context[:-1]):
+            para_sent_startidxs.append(para_sent_startidxs[idx] + len(sentence) + 1)
+        sentences = SentenceIndex(para_context, para_sent_startidxs)
+
+        # Process question-answer pairs
+        for qas in paragraph['qas']:
+            # Prepare data to save
+            zaloQAS = {
+                'id': qas['id'],
+                'question': qas['question'],
+                'title': data['title'],
+                'label': False if qas['is_impossible'] else True
+            }
+            _question_len = get_word_count(qas['question'])
+
+            # Loop & get answer text for each qa pair
+            if len(qas['answers']) != 0 and qas['is_impossible'] is False \
+                    and qas['answers'][0]['answer_start'] != -1:
+                # Only 1 answer, but rephrased
+                answer_start = qas['answers'][0]['answer_start']
+
+                # Find the sentence index that contains the answer
+                _ans_sent_idx = sentences.sentence_at(answer_start)
+                if _ans_sent_idx is None:
+                    # Problem with data --> Ignore & continue
+                    print("Skip due to error")
+                    continue
+
+                # Try to expand the answer text (sentences [_start, _end)) to reach the threshold
+                _start, _end = _ans_sent_idx, _ans_sent_idx + 1
+                while True:
+                    if _start > 0:
+                        if sentences.word_count(_start - 1, _end) + _question_len <= size:
+                            _start -= 1
                         else:
-                            continue
-
-                    if _text is None or _ans_sent_idx is None:
-                        # Problem with data --> Ignore & continue
-                        print("Skip due to error")
-                        continue
-
-                    # Try to expand the answer text to reach the threshold
-                    _text_len = get_word_count(_text)
-                    _ans_sent_idx_before = _ans_sent_idx - 1
-                    _ans_sent_idx_after = _ans_sent_idx + 1
-                    while True:
-                        if _ans_sent_idx_before >= 0:
-                            _text_before = para_context[_ans_sent_idx_before]
-                            _text_before_len = get_word_count(_text_before)
-                            if _text_len + _text_before_len + _question_len <= int(args.size):
-                                _text = _text_before + _text
-                                _text_len += _text_before_len
-                            else:
-                                break
-                            _ans_sent_idx_before -= 1
-                        if _ans_sent_idx_after < len(para_context):
-                            _text_after = para_context[_ans_sent_idx_after]
-                            _text_after_len = get_word_count(_text_after)
-                            if _text_len + _text_after_len + _question_len <= int(args.size):
-                                _text += _text_after
-                                _text_len += _text_after_len
-                            else:
-                                break
-                            _ans_sent_idx_after += 1
-                        if _ans_sent_idx_before < 0 and _ans_sent_idx_after >= len(para_context):
                             break
-                    zaloQAS['text'] = _text
-                else:
-                    # Keep adding text until the threshold is reached
-                    _text = para_context[0] if len(para_context) >= 1 else ""
-                    _text_len = get_word_count(_text)
-                    for idx in range(1, len(para_context)):
-                        _curr_text_len = get_word_count(para_context[idx])
-                        if _text_len + _question_len + _curr_text_len < int(args.size):
-                            _text += para_context[idx]
-                            _text_len += _curr_text_len
+                    if _end < len(sentences):
+                        if sentences.word_count(_start, _end + 1) + _question_len <= size:
+                            _end += 1
                         else:
                             break
-                    zaloQAS['text'] = _text
-
-                # Add data instance
-                convertedData.append(zaloQAS)
+                    if _start == 0 and _end >= len(sentences):
+                        break
+                zaloQAS['text'] = sentences.text(_start, _end)
+            else:
+                # Keep adding sentences until the threshold is reached (the first one is always added)
+                _end = bisect_left(sentences.prefix_counts, size - _question_len, 2, len(sentences) + 1) - 1
+                zaloQAS['text'] = sentences.text(0, _end) if len(sentences) >= 1 else ""
 
-    # Export converted data
-    with open(output_file, 'w', encoding=encoding) as stream:
-        stream.write(json.dumps(convertedData, ensure_ascii=False))
+            # Add data instance
+            converted_data.append(zaloQAS)
+    return converted_data
 
 
-def convert_mode_veryshort(input_file, output_file, encoding):
-    with open(input_file, 'r', encoding=encoding) as stream:
-        squad = json.load(stream)
-
-    convertedData = []
-
-    # Remove _ symbol in title
-    for data in squad['data']:
-        data['title'] = " ".join(data['title'].split('_'))
-
+def convert_mode_short(input_file, output_file, encoding, size, workers=1, flush_every=1000):
     # Format 2: Sentence as Text
-    for data in tqdm(squad['data']):
-        for paragraph in data['paragraphs']:
-            # Get paragraph split by sentences & determine its start index for easier processing
-            para_context = sent_tokenize(paragraph['context'])  # Context split into list of sentences
-            para_sent_startidxs = [paragraph['context'].index(sentence) for sentence in para_context]
-
-            # Process question-answer pairs
-            for qas in paragraph['qas']:
-                # Prepare data to save
-                zaloQAS = {
-                    'id': qas['id'],
-                    'question': qas['question'],
-                    'title': data['title'],
-                    'label': False if qas['is_impossible'] else True
-                }
-                _question_len = get_word_count(qas['question'])
-
-                # Loop & get answer text for each qa pair
-                if len(qas['answers']) != 0 and qas['is_impossible'] is False \
-                        and qas['answers'][0]['answer_start'] != -1:
-                    # Only 1 answer, but rephrased
-                    answer = qas['answers'][0]
-
-                    # Find the sentence & sentence index that contains the answer
-                    _text = None
-                    for idx in range(len(para_context)):
-                        if para_sent_startidxs[idx] > answer['answer_start']:
-                            continue
-                        elif para_sent_startidxs[idx] < answer['answer_start'] \
-                                < para_sent_startidxs[idx] + len(para_context[idx]):
-                            _text = para_context[idx]
-                            break
-                        else:
-                            break
-                    zaloQAS['text'] = "" if _text is None else _text
-                else:
-                    zaloQAS['text'] = para_context[random.randint(0, len(para_context)) - 1] if len(para_context) >= 1 \
-                        else ""
-
-                # Add data instance
-                convertedData.append(zaloQAS)
-
-    # Export converted data
-    with open(output_file, 'w', encoding=encoding) as stream:
-        stream.write(json.dumps(convertedData, ensure_ascii=False))
+    with RecordWriter(output_file, encoding, flush_every=flush_every) as writer:
+        writer.write_all(convert_articles(partial(convert_article_short, size=size),
+                                          iter_articles(input_file, encoding), workers))
+
+
+def convert_article_veryshort(article, seed):
+    """ Convert one SQuAD article (format 3: the answer sentence as text)
+        The random sentence choice is seeded per article, so any number of workers gives the same output
+    """
+    article_idx, data = article
+    rng = random.Random(seed + article_idx)
+    converted_data = []
+    for paragraph in data['paragraphs']:
+        # Get paragraph split by sentences & determine its start index for easier processing
+        para_context = sent_tokenize(paragraph['context'])  # Context split into list of sentences
+        para_sent_startidxs = sentence_starts(paragraph['context'], para_context)
+        sentences = SentenceIndex(para_context, para_sent_startidxs)
+
+        # Process question-answer pairs
+        for qas in paragraph['qas']:
+            # Prepare data to save
+            zaloQAS = {
+                'id': qas['id'],
+                'question': qas['question'],
+                'title': data['title'],
+                'label': False if qas['is_impossible'] else True
+            }
+            _question_len = get_word_count(qas['question'])
+
+            # Loop & get answer text for each qa pair
+            if len(qas['answers']) != 0 and qas['is_impossible'] is False \
+                    and qas['answers'][0]['answer_start'] != -1:
+                # Only 1 answer, but rephrased
+                answer = qas['answers'][0]
+
+                # Find the sentence that contains the answer
+                _ans_sent_idx = sentences.sentence_at(answer['answer_start'])
+                zaloQAS['text'] = "" if _ans_sent_idx is None else para_context[_ans_sent_idx]
+            else:
+                zaloQAS['text'] = para_context[rng.randint(0, len(para_context)) - 1] if len(para_context) >= 1 \
+                    else ""
+
+            # Add data instance
+            converted_data.append(zaloQAS)
+    return converted_data
+
+
+def convert_mode_veryshort(input_file, output_file, encoding, seed=0, workers=1, flush_every=1000):
+    # Format 3: Answer sentence as Text
+    with RecordWriter(output_file, encoding, flush_every=flush_every) as writer:
+        writer.write_all(convert_articles(partial(convert_article_veryshort, seed=seed),
+                                          iter_articles(input_file, encoding), workers))
 
 
 if __name__ == "__main__":
@@ -226,8 +257,10 @@ if __name__ == "__main__":
     assert args.mode.lower() in ['full', 'short', 'veryshort'], "The mode can either be 'full' or 'short'"
 
     if args.mode.lower() == 'full':
-        convert_mode_full(args.input_file, args.output_file, args.encoding)
+        convert_mode_full(args.input_file, args.output_file, args.encoding, args.flush_every)
     elif args.mode.lower() == 'short':
-        convert_mode_short(args.input_file, args.output_file, args.encoding)
+        convert_mode_short(args.input_file, args.output_file, args.encoding, args.size, args.workers,
+                           args.flush_every)
     elif args.mode.lower() == 'veryshort':
-        convert_mode_veryshort(args.input_file, args.output_file, args.encoding)
+        convert_mode_veryshort(args.input_file, args.output_file, args.encoding, args.seed, args.workers,
+                               args.flush_every)
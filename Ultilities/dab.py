@@ -1,135 +1,111 @@
-import json
-import time
-from selenium import webdriver
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.common.by import By
-from math import floor
-from multiprocessing.pool import ThreadPool
-import threading
 import argparse
+from record_io import OrderedRecordWriter, ProgressJournal, RecordWriter, iter_json_records
+from translation import ProgressCollector, TranslationCache, TranslationError, TranslationPipeline, make_translator, \
+    run_work_queue
 
 #passed arguments: input file path, output file path, intermediate_lang
 parser = argparse.ArgumentParser()
 parser.add_argument('-i', '--input_file', default=None,
-                    help='The input train file', required=True)
+                    help='The input train file (json, or jsonl with one record per line)', required=True)
 parser.add_argument('-o', '--output_file', default=None,
-                    help='The output result after back translation', required=True)
+                    help='The output result after back translation (one record per line if its name ends with '
+                         '.jsonl)', required=True)
 parser.add_argument('-l', '--inter_lang', default='en',
                     help='The intermediate language for back translation', required=False)
-parser.add_argument('-t', '--num_threads', default=1,
+parser.add_argument('-t', '--num_threads', default=1, type=int,
                     help='The number of threads used for translation', required=False)
+parser.add_argument('-c', '--chunk_size', default=8, type=int,
+                    help='The number of records a thread takes from the shared work queue at a time', required=False)
 parser.add_argument('-e', '--encoding', default="utf-8",
                     help='The default encoding of the input/output dataset', required=False)
+parser.add_argument('--flush_every', default=100, type=int,
+                    help='The number of paraphrased records between two flushes of the output file', required=False)
+parser.add_argument('--backend', default='selenium', choices=['google', 'selenium', 'stub'],
+                    help="The translation backend: 'google' (Cloud Translation API), 'selenium' (Google Translate "
+                         "web page) or 'stub' (local, returns the text unchanged, for benchmarking)", required=False)
+parser.add_argument('--workers', default=4, type=int,
+                    help='The maximum number of concurrent translation requests (browsers for selenium)',
+                    required=False)
+parser.add_argument('--cache_file', default='translation_cache.sqlite',
+                    help='The persistent translation cache', required=False)
+parser.add_argument('--chromedriver', default='chromedriver.exe',
+                    help="The path to chromedriver (backend 'selenium')", required=False)
+parser.add_argument('--stub_latency', default=0., type=float,
+                    help="The simulated request latency (seconds) of the 'stub' backend", required=False)
+parser.add_argument('--journal_file', default=None,
+                    help='The progress journal, replayed on restart (Default is <output_file>.journal)',
+                    required=False)
+parser.add_argument('--commit_every', default=100, type=int,
+                    help='The number of finished records between two commits of the journal', required=False)
 
 train_data = []
-div_data = []
-dab_res = []
-text_error = []
-count_item = 0
-count_error = 0
-num_item = 0
+pipeline = None     # Batches the strings of every thread into translation requests
+journal = None      # The paraphrased records (by id), committed as they are done
+collector = None    # Progress & errors
+writer = None       # The paraphrased records, written in input order as soon as they are done
 
 
-threadLocal = threading.local()
-# chromepath = "/usr/bin/chromedriver"
-chromepath = r"chromedriver.exe"
-# chromeOptions = webdriver.ChromeOptions()
-# chromeOptions.add_argument("--headless")
-# driver = webdriver.Chrome(chromepath, chrome_options=chromeOptions)
-# wait = WebDriverWait(driver,5)
+def record_id(idx, item):
+    """ The journal id of a record: its 'id', or its position in the input file """
+    return str(item.get('id', idx))
 
-def create_maindriver():
-    mainDriver = getattr(threadLocal, 'maindriver', None)
-    if mainDriver is None:
-        # chromeOptions = webdriver.ChromeOptions()
-        # chromeOptions.add_argument("--headless")
-        # mainDriver = webdriver.Chrome(chromepath, chrome_options=chromeOptions)
-        mainDriver = webdriver.Chrome(chromepath)
-        setattr(threadLocal, 'maindriver', mainDriver)
-    return mainDriver
 
 def load_data():
+    """ Load the input & return the (index, id, record) of every record """
     global train_data
-    with open(args.input_file, 'r', encoding="utf-8") as infile:
-        train_data = json.load(infile)
-        infile.close()
-    #divide input to x part
-    global div_data, num_item
-    num_item = len(train_data)
-    div = floor(len(train_data) / args.num_threads)
-    div_data.append([train_data[i] for i in range(div)])
-    for i in range(1, args.num_threads - 1):
-        div_data.append([train_data[j] for j in range(div*i, div*(i+1))])
-    div_data.append([train_data[i] for i in range(div*(args.num_threads - 1), num_item)])    
+    train_data = list(iter_json_records(args.input_file, args.encoding))
+    return [(idx, record_id(idx, item), item) for idx, item in enumerate(train_data)]
 
 
-def export_result():
-    with open(args.output_file, 'w', encoding=args.encoding) as outfile:
-        json.dump(dab_res, outfile, ensure_ascii=False)
-        outfile.close()
-def translate(text, driver, wait):
-    global count_error, text_error
+def translate(future, text):
+    """ The translation of a submitted text, or "error" if it failed """
     try:
-        input_area = driver.find_element_by_css_selector("#source")
-        input_area.clear()
-        time.sleep(0.8)
-        # driver.execute_script("arguments[0].value = '';", input_area)
-        # driver.execute_script("arguments[0].value = '"+text+"';", input_area)
-        # driver.execute_script("document.getElementById('source').setAttribute('value','"+text+"')")
-        input_area.send_keys(text)
-        translatedText = wait.until(EC.presence_of_element_located((By.CSS_SELECTOR,
-                                                                    'body > div.frame > '
-                                                                    'div.page.tlid-homepage.homepage.translate-text > '
-                                                                    'div.homepage-content-wrap > '
-                                                                    'div.tlid-source-target.main-header > '
-                                                                    'div.source-target-row > '
-                                                                    'div.tlid-results-container.results-container > '
-                                                                    'div.tlid-result.result-dict-wrapper > '
-                                                                    'div.result.tlid-copy-target > '
-                                                                    'div.text-wrap.tlid-copy-target > div > '
-                                                                    'span.tlid-translation.translation'))).text
-    except Exception as e:
-        print("Exception: ", e)
-        count_error = count_error + 1
-        text_error.append(text)
-        print("Count Error: ", count_error)
-        print("Text error", text_error)
+        return future.result()
+    except TranslationError as e:
+        collector.error(text, e)
         return "error"
-    return translatedText
+
 
 def DAB_run(data):
-    print("Thread Start!!!")
-    driver = create_maindriver()
-    vie2inter_link = "https://translate.google.com/#view=home&op=translate&sl=vi&tl={}".format(args.inter_lang)
-    inter2vie_link = "https://translate.google.com/#view=home&op=translate&sl={}&tl=vie".format(args.inter_lang)
-    driver.get(vie2inter_link)
-    wait = WebDriverWait(driver, 20)
-    #
-    global count_error, count_item
-    #vie - inter
-    print("---------- vie - {} ----------".format(args.inter_lang))
-    for item in data:
-        count_item = count_item + 1
-        print("Progress: {} / {}({} x 2) = {:.4f} %".format(count_item, num_item*2, num_item, (count_item/(num_item*2))*100 ))
-        item['question'] = translate(item['question'], driver, wait)
-        item['text'] = translate(item['text'], driver,wait)
-        
-    #inter - vie
-    driver.get(inter2vie_link)
-    print("---------- {} - vie ----------".format(args.inter_lang))
-    for item in data:
-        count_item = count_item + 1
-        print("Progress: {} / {}({} x 2) = {:.4f} %".format(count_item, num_item*2, num_item, (count_item/(num_item*2))*100 ))
-        item['question'] = translate(item['question'], driver, wait)
-        item['text'] = translate(item['text'], driver,wait)
-    global dab_res
-    dab_res.extend(data)
-    print("Thread Done!!!")
-    driver.quit()
+    """ Back-translate a chunk of (index, id, record) & write each paraphrased record: each string goes
+        vie - inter - vie, its second leg starting as soon as its first one is done
+        The records paraphrased by an earlier run are read back from the journal
+    """
+    languages = ['vi', args.inter_lang, 'vi']
+    todo = [(idx, unit_id, item) for idx, unit_id, item in data if unit_id not in journal]
+    futures = [(idx, unit_id, item, pipeline.submit_chain(item['question'], languages),
+                pipeline.submit_chain(item['text'], languages)) for idx, unit_id, item in todo]
+    done = [(idx, unit_id) for idx, unit_id, _ in data if unit_id in journal]
+    for (idx, _), item in zip(done, journal.read([unit_id for _, unit_id in done])):
+        writer.write(idx, item)
+    for idx, unit_id, item, question, text in futures:
+        item = dict(item, question=translate(question, item['question']), text=translate(text, item['text']))
+        # A record with a failed translation is written as it is, but not journaled so a rerun retries it
+        if "error" not in (item['question'], item['text']):
+            collector.add(unit_id, item)
+        writer.write(idx, item)
+        collector.update()
+
 
 if __name__ == "__main__":
     args = parser.parse_args()
-    load_data()
-    ThreadPool(args.num_threads).map(DAB_run, div_data)
-    print(div_data)
\ No newline at end of file
+    journal = ProgressJournal(args.journal_file or args.output_file + '.journal', args.encoding,
+                              commit_every=args.commit_every)
+    data = load_data()
+    num_todo = sum(1 for _, unit_id, _ in data if unit_id not in journal)
+    print("{} records already paraphrased, {} left".format(len(data) - num_todo, num_todo))
+    pipeline = TranslationPipeline(make_translator(args.backend, chromedriver_path=args.chromedriver,
+                                                   num_drivers=args.workers, stub_latency=args.stub_latency),
+                                   cache=TranslationCache(args.cache_file), max_concurrency=args.workers)
+    collector = ProgressCollector(num_todo, journal)
+    # Records finished out of order wait for the ones before them
+    with RecordWriter(args.output_file, args.encoding, flush_every=args.flush_every) as output:
+        writer = OrderedRecordWriter(output)
+        try:
+            run_work_queue(DAB_run, data, num_workers=args.num_threads, chunk_size=args.chunk_size)
+        finally:
+            journal.commit()
+    collector.close()
+    pipeline.close()
+    print("Translation stats: {} ({} errors)".format(pipeline.stats(), len(collector.errors)))
+    journal.close()
@@ -0,0 +1,314 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import unicodedata
+import zlib
+from collections import Counter, OrderedDict
+from os.path import basename, join
+import numpy as np
+from tqdm import tqdm
+from record_io import RecordWriter, iter_json_records
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-i', '--input_files', nargs='+', required=True,
+                    help='The files to clean, in order: Zalo-format datasets (json or jsonl), deduplicated by '
+                         '(question, text) pair, or pretrain data (one sentence per line, an empty line after '
+                         'each article), deduplicated by sentence')
+parser.add_argument('-v', '--val_files', nargs='*', default=[],
+                    help='Held-out Zalo-format datasets: never modified, every training record that duplicates '
+                         'one of their pairs or contexts is dropped & reported')
+parser.add_argument('-o', '--output_dir', required=True,
+                    help='The folder where the cleaned files (same names as the inputs) & the report are written')
+parser.add_argument('-e', '--encoding', default="utf-8",
+                    help='The default encoding of the input/output dataset', required=False)
+parser.add_argument('--threshold', default=0.8, type=float,
+                    help='The estimated Jaccard similarity (of word 3-grams) above which two texts are near-duplicates')
+parser.add_argument('--num_perm', default=64, type=int, help='The number of MinHash permutations')
+parser.add_argument('--bands', default=16, type=int, help='The number of LSH bands (must divide num_perm)')
+parser.add_argument('--shingle_size', default=3, type=int, help='The number of words in a shingle')
+parser.add_argument('--min_tokens', default=5, type=int,
+                    help='Shorter texts are only deduplicated exactly (a few shared words mean nothing)')
+parser.add_argument('--keep_leaks', action='store_true',
+                    help='Only report the training records overlapping the val files, keep them in the output')
+parser.add_argument('--index_file', default=None,
+                    help="The SQLite index (Default is a temporary file in output_dir, removed at the end; "
+                         "':memory:' keeps it in RAM, for small corpora)")
+parser.add_argument('--cache_mb', default=256, type=int,
+                    help='The memory (MB) SQLite may use to cache the index')
+parser.add_argument('--flush_every', default=1000, type=int,
+                    help='The number of records written between two flushes of a cleaned Zalo-format file')
+
+# A prime above 2^32, for the universal hashing (a * x + b) % prime of 32-bit shingle hashes
+_PRIME = (1 << 32) + 15
+
+
+def tokenize(text):
+    """ The lowercase words (syllables for Vietnamese) of a text, punctuation & spacing dropped """
+    return re.findall(r'\w+', unicodedata.normalize('NFC', text).lower())
+
+
+def hash64(data):
+    """ A 64-bit hash of some bytes, as a signed integer (a SQLite INTEGER) """
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little', signed=True)
+
+
+def fingerprint(text):
+    return hash64(text.encode('utf-8'))
+
+
+def open_index(path, cache_mb=256):
+    """ Open a SQLite database for DedupIndex tables; durability is not needed, the index is rebuilt on every run """
+    db = sqlite3.connect(path)
+    db.execute('PRAGMA journal_mode = OFF')
+    db.execute('PRAGMA synchronous = OFF')
+    db.execute('PRAGMA cache_size = {}'.format(-int(cache_mb) * 1024))
+    return db
+
+
+class DedupIndex(object):
+    """ Exact & near-duplicate index of texts
+        Exact duplicates share the hash of their normalized words; near-duplicates are found with MinHash
+        signatures of word shingles & LSH banding, then kept if their estimated Jaccard similarity reaches the
+        threshold. Everything lives in SQLite tables, so the memory use is bounded by the SQLite cache
+        Only the first text of a duplicate group is indexed, under a doc id counting from 0
+    """
+
+    def __init__(self, db, name, num_perm=64, bands=16, threshold=0.8, shingle_size=3, min_tokens=5, seed=1):
+        """ DedupIndex constructor
+            :parameter db: The sqlite3 connection (see open_index), which may hold several indexes
+            :parameter name: The prefix of the index tables, which are (re)created empty
+            :parameter threshold: The minimum estimated Jaccard similarity of two near-duplicates
+            :parameter min_tokens: The minimum number of words of a text to look for its near-duplicates
+        """
+        assert num_perm % bands == 0, "The number of bands must divide the number of permutations"
+        self.db = db
+        self.name = name
+        self.num_perm = num_perm
+        self.bands = bands
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.min_tokens = max(min_tokens, 1)
+        self.num_docs = 0
+        random = np.random.RandomState(seed)
+        self._a = random.randint(1, 1 << 32, size=num_perm, dtype=np.uint64)[:, None]
+        self._b = random.randint(0, 1 << 32, size=num_perm, dtype=np.uint64)[:, None]
+        # Random odd 64-bit multipliers of the rows of a band, & one salt per band (of each part)
+        self._band_mix = random.randint(0, 1 << 63, size=num_perm // bands, dtype=np.uint64) * np.uint64(2) + \
+            np.uint64(1)
+        self._band_salt = random.randint(0, 1 << 63, size=bands * 8, dtype=np.uint64)
+        for table, columns in [('exact', '(k INTEGER PRIMARY KEY, doc INTEGER)'),
+                               ('bucket', '(k INTEGER, doc INTEGER, PRIMARY KEY (k, doc)) WITHOUT ROWID'),
+                               ('signature', '(doc INTEGER PRIMARY KEY, sig BLOB)')]:
+            db.execute('DROP TABLE IF EXISTS {}_{}'.format(name, table))
+            db.execute('CREATE TABLE {}_{} {}'.format(name, table, columns))
+
+    def signature(self, tokens):
+        """ The MinHash signature (num_perm uint32) of the set of word shingles of a text """
+        size = self.shingle_size
+        shingles = {zlib.crc32(' '.join(tokens[i:i + size]).encode('utf-8'))
+                    for i in range(max(len(tokens) - size + 1, 1))}
+        hashes = np.fromiter(shingles, dtype=np.uint64, count=len(shingles))[None, :]
+        return ((self._a * hashes + self._b) % np.uint64(_PRIME)).min(axis=1).astype(np.uint32)
+
+    def band_keys(self, signature):
+        """ The LSH bucket of the signature in each band (of each of its parts), a wrapping multiply-sum of its
+            rows: a rare collision only costs a candidate check
+        """
+        rows = signature.reshape(-1, self.num_perm // self.bands).astype(np.uint64)
+        keys = (rows * self._band_mix).sum(axis=1, dtype=np.uint64) ^ self._band_salt[:len(rows)]
+        return keys.view(np.int64).tolist()
+
+    def similarity(self, signature, other):
+        """ The estimated Jaccard similarity of two signatures: the lowest one of their parts """
+        return (signature.reshape(-1, self.num_perm) == other.reshape(-1, self.num_perm)).mean(axis=1).min()
+
+    def _near(self, signature, keys):
+        """ The smallest doc id whose signature is similar enough among those sharing a bucket, or None """
+        rows = self.db.execute('SELECT DISTINCT s.doc, s.sig FROM {0}_bucket AS b JOIN {0}_signature AS s '
+                               'ON s.doc = b.doc WHERE b.k IN ({1})'.format(self.name, ','.join('?' * len(keys))),
+                               keys).fetchall()
+        matches = [doc for doc, sig in rows
+                   if self.similarity(np.frombuffer(sig, dtype=np.uint32), signature) >= self.threshold]
+        return min(matches) if matches else None
+
+    def check(self, *texts, add=True):
+        """ Look a text up & index it if it's new
+            A text made of several parts (e.g. a question & its paragraph) is a near-duplicate when each of its
+            parts is one of the matching part, so two questions on the same paragraph are not
+            :parameter texts: The parts of the text (always the same number of parts in an index)
+            :parameter add: Index a new text (False only queries the index)
+            :return: (doc id, 'exact' or 'near') of the indexed text it duplicates, or (None, None)
+        """
+        tokens = [tokenize(text) for text in texts]
+        key = fingerprint('\t'.join(' '.join(words) if words else text.strip() for words, text in zip(tokens, texts)))
+        row = self.db.execute('SELECT doc FROM {}_exact WHERE k = ?'.format(self.name), (key,)).fetchone()
+        if row is not None:
+            return row[0], 'exact'
+
+        signature = None
+        if all(tokens) and sum(len(words) for words in tokens) >= self.min_tokens:
+            signature = np.concatenate([self.signature(words) for words in tokens])
+            keys = self.band_keys(signature)
+            doc = self._near(signature, keys)
+            if doc is not None:
+                return doc, 'near'
+
+        if add:
+            doc = self.num_docs
+            self.num_docs += 1
+            self.db.execute('INSERT INTO {}_exact VALUES (?, ?)'.format(self.name), (key, doc))
+            if signature is not None:
+                self.db.executemany('INSERT OR IGNORE INTO {}_bucket VALUES (?, ?)'.format(self.name),
+                                    [(k, doc) for k in keys])
+                self.db.execute('INSERT INTO {}_signature VALUES (?, ?)'.format(self.name),
+                                (doc, signature.tobytes()))
+        return None, None
+
+
+def is_zalo_file(filepath):
+    return filepath.endswith('.json') or filepath.endswith('.jsonl')
+
+
+def iter_zalo_records(filepath, encoding='utf-8'):
+    """ Yield the records of a Zalo-format file, rejecting other JSON files (e.g. SQuAD-format {'data': [...]})
+        :raise ValueError: On the first item that is not a {'question', 'text', ...} record
+    """
+    for item in iter_json_records(filepath, encoding):
+        if not isinstance(item, dict) or 'question' not in item or 'text' not in item:
+            raise ValueError("{} is not a Zalo-format dataset (a list of {{'question', 'text', ...}} records); "
+                             "convert SQuAD-format files with convert_squad2zalo_format.py first".format(filepath))
+        yield item
+
+
+def pair_text(item):
+    """ The parts deduplicated for a Zalo-format record: its question & its text """
+    return item['question'], item['text']
+
+
+def index_val_files(val_files, pairs, contexts, encoding='utf-8'):
+    """ Index the pairs & contexts of the val files first, so their doc ids come before any training text
+        :return: The (file, record id) of each pair doc & the list of (file, record id) of each context doc
+    """
+    pair_refs, context_refs = [], {}
+    for val_file in val_files:
+        for idx, item in enumerate(tqdm(iter_zalo_records(val_file, encoding), desc=basename(val_file))):
+            ref = (basename(val_file), str(item.get('id', idx)))
+            if pairs.check(*pair_text(item))[0] is None:
+                pair_refs.append(ref)
+            doc = contexts.check(item['text'])[0]
+            context_refs.setdefault(len(context_refs) if doc is None else doc, []).append(ref)
+    pairs.db.commit()
+    return pair_refs, context_refs
+
+
+def clean_zalo_file(input_file, output_file, pairs, contexts, pair_refs, context_refs, leaked, args):
+    """ Write the records of a Zalo-format file whose pair is new & whose context is not a val one
+        :parameter pair_refs, context_refs: The val records of the val pair & context docs (see index_val_files)
+        :parameter leaked: The set of val (file, record id) hit so far, updated in place
+        :return: The counts of the file
+    """
+    counts = Counter()
+    with RecordWriter(output_file, args.encoding, flush_every=args.flush_every) as writer:
+        for item in tqdm(iter_zalo_records(input_file, args.encoding), desc=basename(input_file)):
+            counts['records'] += 1
+            doc, kind = contexts.check(item['text'], add=False)
+            if doc is not None:
+                counts['{}_context_leaks'.format(kind)] += 1
+                leaked.update(context_refs[doc])
+                if not args.keep_leaks:
+                    continue
+            doc, kind = pairs.check(*pair_text(item))
+            if doc is not None and doc < len(pair_refs):
+                counts['{}_pair_leaks'.format(kind)] += 1
+                leaked.add(pair_refs[doc])
+                if not args.keep_leaks:
+                    continue
+            elif doc is not None:
+                counts['{}_duplicates'.format(kind)] += 1
+                continue
+            writer.write(item)
+            counts['kept'] += 1
+    return counts
+
+
+def clean_text_file(input_file, output_file, sentences, encoding='utf-8'):
+    """ Write the pretrain data without its repeated sentences, dropping the articles left empty
+        :return: The counts of the file
+    """
+    counts = Counter()
+    article = []
+    with open(input_file, 'r', encoding=encoding) as file, open(output_file, 'w', encoding=encoding) as output:
+        for line in tqdm(file, desc=basename(input_file)):
+            sentence = line.rstrip('\n')
+            if not sentence.strip():
+                if article:
+                    output.write(''.join(article) + '\n')
+                    counts['articles'] += 1
+                article = []
+                continue
+            counts['sentences'] += 1
+            kind = sentences.check(sentence)[1]
+            if kind is not None:
+                counts['{}_duplicates'.format(kind)] += 1
+            else:
+                article.append(sentence + '\n')
+                counts['kept'] += 1
+        if article:
+            output.write(''.join(article) + '\n')
+            counts['articles'] += 1
+    return counts
+
+
+def main():
+    args = parser.parse_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+    index_file = args.index_file
+    if index_file is None:
+        handle, index_file = tempfile.mkstemp(suffix='.sqlite', dir=args.output_dir)
+        os.close(handle)
+
+    db = open_index(index_file, args.cache_mb)
+    settings = dict(num_perm=args.num_perm, bands=args.bands, threshold=args.threshold,
+                    shingle_size=args.shingle_size, min_tokens=args.min_tokens)
+    pairs, contexts, sentences = [DedupIndex(db, name, **settings) for name in ['pairs', 'contexts', 'sentences']]
+    try:
+        pair_refs, context_refs = index_val_files(args.val_files, pairs, contexts, args.encoding)
+        leaked = set()
+
+        report = OrderedDict([('settings', settings), ('files', OrderedDict()), ('overlap', OrderedDict())])
+        for input_file in args.input_files:
+            output_file = join(args.output_dir, basename(input_file))
+            assert os.path.abspath(output_file) != os.path.abspath(input_file), \
+                "The output folder must not contain the input files"
+            if is_zalo_file(input_file):
+                counts = clean_zalo_file(input_file, output_file, pairs, contexts, pair_refs, context_refs, leaked,
+                                         args)
+            else:
+                counts = clean_text_file(input_file, output_file, sentences, args.encoding)
+            db.commit()
+            report['files'][basename(input_file)] = OrderedDict(sorted(counts.items()))
+            print("{}: {}".format(input_file, dict(counts)))
+    finally:
+        db.close()
+        if args.index_file is None:
+            os.remove(index_file)
+
+    # Train/val overlap: the val records whose pair or context was found in the training files
+    val_records = Counter(val_file for val_file, _ in pair_refs)
+    for val_file in args.val_files:
+        name = basename(val_file)
+        leaked_ids = sorted(record_id for leaked_file, record_id in leaked if leaked_file == name)
+        report['overlap'][name] = OrderedDict([('unique_pairs', val_records[name]),
+                                               ('leaked_records', len(leaked_ids)), ('leaked_ids', leaked_ids)])
+        print("{}: {} of its records overlap the training files".format(val_file, len(leaked_ids)))
+
+    with open(join(args.output_dir, 'dedup_report.json'), 'w', encoding=args.encoding) as file:
+        json.dump(report, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
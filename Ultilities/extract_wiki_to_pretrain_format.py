@@ -1,33 +1,75 @@
+import bz2
+import gzip
 import json
 import argparse
+from multiprocessing import Pool
+from os.path import splitext
 from underthesea import sent_tokenize
 from tqdm import tqdm
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-i', '--input_file', default=None,
-                    help='The input wikipedia file (each article is a json string in a line)', required=True)
+                    help='The input wikipedia file (each article is a json string in a line), '
+                         'optionally compressed (.gz or .bz2)', required=True)
 parser.add_argument('-o', '--output_file', default="./pretrain_data.txt",
                     help='The desired output file (BERT pretrained data (unprocessed))', required=False)
 parser.add_argument('-e', '--encoding', default="utf-8",
                     help='The default encoding of the input/output dataset', required=False)
+parser.add_argument('-w', '--workers', default=1, type=int, required=False,
+                    help="The number of worker processes used for sentence splitting (output is identical to 1)")
+parser.add_argument('-n', '--num_shards', default=1, type=int, required=False,
+                    help="The number of output files; the articles are dealt round-robin between them")
 
 
-if __name__ == "__main__":
-    args = parser.parse_args()
+def open_input(input_file, encoding='utf-8'):
+    """ Open a text file for reading, decompressing .gz & .bz2 files on the fly """
+    if input_file.endswith('.gz'):
+        return gzip.open(input_file, 'rt', encoding=encoding)
+    if input_file.endswith('.bz2'):
+        return bz2.open(input_file, 'rt', encoding=encoding)
+    return open(input_file, 'r', encoding=encoding)
+
+
+def shard_paths(output_file, num_shards):
+    """ The output file itself for a single shard, else <name>-<shard>-of-<num_shards><ext> """
+    if num_shards <= 1:
+        return [output_file]
+    name, ext = splitext(output_file)
+    return ['{}-{:05d}-of-{:05d}{}'.format(name, shard, num_shards, ext) for shard in range(num_shards)]
+
 
-    # Read file line by line & convert json string to python dict
-    with open(args.input_file, 'r', encoding=args.encoding) as input_file:
-        articles = input_file.readlines()
+def article_to_pretrain(line):
+    """ Convert one article (a json string) to pretrain data: one sentence per line, followed by an empty line """
+    article = json.loads(line)
+    article_text = article["text"].replace("\r\n", ".").replace("\r", ".").replace("\n", ".")
+    return "".join(text + "\n" for text in sent_tokenize(article_text)) + "\n"
 
-    articles = [json.loads(article, encoding=args.encoding) for article in tqdm(articles)]
 
-    # Write to output file line by line (for each sentences), each article is split by an empty line
-    with open(args.output_file, 'w', encoding=args.encoding) as output_file:
-        for article in tqdm(articles):
-            article_text = article["text"].replace("\r\n", ".").replace("\r", ".").replace("\n", ".")
-            article_texts = sent_tokenize(article_text)
-            for text in article_texts:
-                output_file.write(text + "\n")
-            output_file.write("\n")
+def convert_articles(lines, workers=1):
+    """ Convert article lines lazily & in order, across a process pool when workers > 1 """
+    if workers <= 1:
+        for line in lines:
+            yield article_to_pretrain(line)
+        return
+    with Pool(workers) as pool:
+        for block in pool.imap(article_to_pretrain, lines, chunksize=16):
+            yield block
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    output_files = [open(path, 'w', encoding=args.encoding) for path in shard_paths(args.output_file,
+                                                                                   args.num_shards)]
+    try:
+        # Stream the file line by line (one json article per line) & write each article as soon as it's split,
+        # one sentence per line, each article followed by an empty line
+        with open_input(args.input_file, args.encoding) as input_file:
+            lines = (line for line in input_file if line.strip())
+            for idx, block in enumerate(tqdm(convert_articles(lines, args.workers))):
+                output_files[idx % len(output_files)].write(block)
+    finally:
+        for output_file in output_files:
+            output_file.close()
 
     print("Completed")
@@ -1,6 +1,8 @@
 import json
+import numpy as np
 import pandas as pd
 import argparse
+from record_io import RecordWriter, is_json_lines, iter_json_lines
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-train', '--train_file', default="", help='Zalo-format file that need to be filtered',
@@ -12,41 +14,62 @@ parser.add_argument('-output', '--output_file', default='./out.json', help='The
 parser.add_argument('-b', '--balance', default=True, help='The output contains the same number of data for each label')
 parser.add_argument('-e', '--encoding', default="utf-8",
                     help='The default encoding of the input/output dataset', required=False)
+parser.add_argument('--stream', action='store_true',
+                    help='Filter a JSON Lines (jsonl) train file line by line instead of loading all of it')
+
+
+def top_k_indices(values, k):
+    """ The indices of the k largest values (in no particular order), by partial selection instead of a full sort """
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    if k >= len(values):
+        return np.arange(len(values))
+    return np.argpartition(-values, k - 1)[:k]
+
+
+def select_best_ids(scores, top_percentage, balance=True):
+    """ The set of guids of the top_percentage most confident score rows
+        :parameter scores: The score frame ('guid', 'label', 'prediction', 'probabilities')
+        :parameter balance: Take the same number of rows (top_percentage / 2 of all rows) for each label
+    """
+    # Confidence in the gold label
+    probabilities = scores['probabilities'].values.astype(np.float64)
+    confidence = np.where(scores['label'].values != scores['prediction'].values, 1 - probabilities, probabilities)
+    guids = scores['guid'].values
+
+    if balance:
+        k = int(len(scores) * float(top_percentage) / 2)
+        best_ids = set()
+        for label in (0, 1):
+            label_indices = np.flatnonzero(scores['label'].values == label)
+            best_ids.update(guids[label_indices[top_k_indices(confidence[label_indices], k)]])
+        return best_ids
+
+    # Get top x% best results
+    return set(guids[top_k_indices(confidence, int(len(scores) * float(top_percentage)))])
 
 
 def main():
     args = parser.parse_args()
     original_file = args.train_file
     score_file = args.score_file
-
-    with open(original_file, "r", encoding=args.encoding) as data_file:
-        data = json.load(data_file)
+    assert not args.stream or is_json_lines(original_file), "The --stream mode needs a JSON Lines (.jsonl) train file"
 
     # Filter & sort by confidence
-    scores = pd.read_csv(score_file)
-    scores.loc[scores['label'] != scores['prediction'], 'probabilities'] = 1 - scores['probabilities']
-
-    # scores = scores[scores['label'] == scores['prediction']]
-    scores = scores.sort_values(by=['probabilities'], ascending=False)
-
-    best_ids = []
-    if args.balance:
-        scores_false = scores[scores['label'] == 0]
-        scores_true = scores[scores['label'] == 1]
-        scores_false = scores_false.head(int(len(scores) * float(args.get_top_percentage) / 2))
-        scores_true = scores_true.head(int(len(scores) * float(args.get_top_percentage) / 2))
-        best_ids.extend(scores_false['guid'].tolist())
-        best_ids.extend(scores_true['guid'].tolist())
+    scores = pd.read_csv(score_file, usecols=['guid', 'label', 'prediction', 'probabilities'], dtype={'guid': str})
+    best_ids = select_best_ids(scores, args.get_top_percentage, args.balance)
+
+    if args.stream:
+        data = iter_json_lines(original_file, args.encoding)
+    elif is_json_lines(original_file):
+        data = list(iter_json_lines(original_file, args.encoding))
     else:
-        # Get top x% best results
-        scores = scores.head(int(len(scores) * float(args.get_top_percentage)))
-        best_ids.extend(scores['guid'].tolist())
+        with open(original_file, "r", encoding=args.encoding) as data_file:
+            data = json.load(data_file)
 
     # Filter training file, store only best result
-    filtered_data = list(filter(lambda item: item['id'] in best_ids, data))
-
-    with open(args.output_file, "w", encoding=args.encoding) as json_file:
-        json.dump(filtered_data, json_file, ensure_ascii=False)
+    with RecordWriter(args.output_file, args.encoding, flush_every=1000) as writer:
+        writer.write_all(item for item in data if item['id'] in best_ids)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,160 @@
+import argparse
+import json
+import os
+from collections import Counter
+from os.path import join
+import numpy as np
+import tensorflow as tf
+from bert import tokenization
+from tqdm import tqdm
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-i', '--input_files', nargs='+', required=True,
+                    help='The corpora to scan: Zalo-format (json), SQuAD-format (json), '
+                         'Wikipedia extracts (one json article per line) or plain text files')
+parser.add_argument('-m', '--bert_model_path', required=True,
+                    help='The pretrained BERT folder (vocab.txt, bert_config.json, bert_model.ckpt)')
+parser.add_argument('-o', '--output_path', required=True,
+                    help='The folder where the pruned vocab, config & checkpoint are written')
+parser.add_argument('-c', '--checkpoint_name', default='bert_model.ckpt',
+                    help='The checkpoint prefix inside bert_model_path', required=False)
+parser.add_argument('-l', '--do_lowercase', action='store_true',
+                    help='Lowercase the input text (must match the pretrained model)')
+parser.add_argument('--min_count', default=1, type=int,
+                    help='The minimum number of occurrences for a wordpiece to be kept')
+parser.add_argument('--keep_single_chars', action='store_true',
+                    help='Also keep every single-character wordpiece, so unseen words fall back to characters '
+                         'instead of [UNK]')
+parser.add_argument('-e', '--encoding', default="utf-8",
+                    help='The default encoding of the input dataset', required=False)
+
+# Embedding-sized variables of a BERT checkpoint, indexed by vocab id along their first axis
+VOCAB_VARIABLES = ['bert/embeddings/word_embeddings', 'cls/predictions/output_bias']
+
+
+def load_vocab(vocab_file, encoding='utf-8'):
+    with open(vocab_file, 'r', encoding=encoding) as file:
+        return [line.rstrip('\n') for line in file]
+
+
+def iter_texts(input_file, encoding='utf-8'):
+    """ Yield every text of a corpus file: questions/texts/paragraphs of Zalo & SQuAD files,
+        the 'text' of Wikipedia json lines, or the lines of a plain text file
+    """
+    with open(input_file, 'r', encoding=encoding) as file:
+        first_char = file.read(1)
+        file.seek(0)
+        if input_file.endswith('.json') and first_char in '[{':
+            try:
+                data = json.load(file)
+            except ValueError:
+                # One json document per line (Wikipedia extracts)
+                data = None
+            if isinstance(data, dict) and 'data' in data:
+                for article in data['data']:
+                    for paragraph in article['paragraphs']:
+                        yield paragraph['context']
+                        for qas in paragraph['qas']:
+                            yield qas['question']
+                return
+            if isinstance(data, list):
+                for instance in data:
+                    yield instance['question']
+                    if 'paragraphs' in instance:
+                        for paragraph in instance['paragraphs']:
+                            yield paragraph['text']
+                    else:
+                        yield instance['text']
+                return
+            file.seek(0)
+
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('{'):
+                try:
+                    yield json.loads(line).get('text', '')
+                    continue
+                except ValueError:
+                    pass
+            yield line
+
+
+def count_wordpieces(input_files, tokenizer, encoding='utf-8'):
+    counts = Counter()
+    for input_file in input_files:
+        print("Scanning {}...".format(input_file))
+        for text in tqdm(iter_texts(input_file, encoding)):
+            counts.update(tokenizer.tokenize(text))
+    return counts
+
+
+def select_vocab(vocab, counts, min_count=1, keep_single_chars=False):
+    """ The old ids of the kept wordpieces, in their original order
+        Special tokens ([PAD], [UNK], [CLS], [SEP], [MASK], [unused...]) are always kept
+        Because WordPiece matches greedily (longest piece first), any text whose pieces are all kept is tokenized
+        exactly as with the full vocab
+    """
+    kept = []
+    for idx, token in enumerate(vocab):
+        is_special = token.startswith('[') and token.endswith(']')
+        is_single_char = len(token) == 1 or (token.startswith('##') and len(token) == 3)
+        if is_special or counts[token] >= min_count or (keep_single_chars and is_single_char):
+            kept.append(idx)
+    return kept
+
+
+def prune_checkpoint(checkpoint_path, output_checkpoint_path, kept_ids):
+    """ Copy a BERT checkpoint, keeping only the rows of the vocab-sized variables for kept_ids """
+    reader = tf.compat.v1.train.load_checkpoint(checkpoint_path)
+    kept_ids = np.asarray(kept_ids, dtype=np.int64)
+    graph = tf.Graph()
+    with graph.as_default():
+        variables = []
+        for name in sorted(reader.get_variable_to_shape_map()):
+            value = reader.get_tensor(name)
+            if name in VOCAB_VARIABLES:
+                value = value[kept_ids]
+            variables.append(tf.compat.v1.Variable(value, name=name))
+        saver = tf.compat.v1.train.Saver(variables)
+        with tf.compat.v1.Session() as session:
+            session.run(tf.compat.v1.global_variables_initializer())
+            saver.save(session, output_checkpoint_path, write_meta_graph=False)
+
+
+def main():
+    args = parser.parse_args()
+    vocab_file = join(args.bert_model_path, 'vocab.txt')
+    vocab = load_vocab(vocab_file, args.encoding)
+    tokenizer = tokenization.FullTokenizer(vocab_file=vocab_file, do_lower_case=args.do_lowercase)
+
+    counts = count_wordpieces(args.input_files, tokenizer, args.encoding)
+    kept_ids = select_vocab(vocab, counts, args.min_count, args.keep_single_chars)
+    print("Keeping {} of {} wordpieces ({:.1f}%)".format(len(kept_ids), len(vocab),
+                                                       len(kept_ids) * 100. / len(vocab)))
+
+    os.makedirs(args.output_path, exist_ok=True)
+    with open(join(args.output_path, 'vocab.txt'), 'w', encoding=args.encoding) as file:
+        for idx in kept_ids:
+            file.write(vocab[idx] + '\n')
+    # Old vocab id of every new id, to remap other artifacts (e.g. cached features) if needed
+    with open(join(args.output_path, 'vocab_mapping.json'), 'w', encoding=args.encoding) as file:
+        json.dump(kept_ids, file)
+
+    with open(join(args.bert_model_path, 'bert_config.json'), 'r', encoding=args.encoding) as file:
+        config = json.load(file)
+    old_vocab_size = config['vocab_size']
+    config['vocab_size'] = len(kept_ids)
+    with open(join(args.output_path, 'bert_config.json'), 'w', encoding=args.encoding) as file:
+        json.dump(config, file, indent=2)
+
+    prune_checkpoint(join(args.bert_model_path, args.checkpoint_name), join(args.output_path, args.checkpoint_name),
+                     kept_ids)
+    removed_params = (old_vocab_size - len(kept_ids)) * config['hidden_size']
+    print("Removed {:.1f}M embedding parameters".format(removed_params / 1e6))
+    print("Completed")
+
+
+if __name__ == "__main__":
+    main()
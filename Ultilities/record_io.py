@@ -0,0 +1,238 @@
+import json
+import os
+import threading
+
+
+def is_json_lines(filepath):
+    """ JSON Lines (one record per line) is used for every *.jsonl file, a single JSON document otherwise """
+    return filepath.endswith('.jsonl')
+
+
+def iter_json_lines(filepath, encoding='utf-8'):
+    """ Yield the record of every non-empty line of a JSON Lines file """
+    with open(filepath, 'r', encoding=encoding) as file:
+        for line in file:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def iter_json_records(filepath, encoding='utf-8'):
+    """ Yield the records of a Zalo-format dataset: a JSON array, or a JSON Lines file (one record per line) """
+    if is_json_lines(filepath):
+        return iter_json_lines(filepath, encoding)
+    with open(filepath, 'r', encoding=encoding) as file:
+        return iter(json.load(file))
+
+
+def iter_squad_articles(filepath, encoding='utf-8'):
+    """ Yield the articles of a SQuAD-format dataset: {'data': [...]} (or a bare list of articles),
+        or a JSON Lines file (one article per line)
+    """
+    if is_json_lines(filepath):
+        return iter_json_lines(filepath, encoding)
+    with open(filepath, 'r', encoding=encoding) as file:
+        data = json.load(file)
+    return iter(data['data'] if isinstance(data, dict) else data)
+
+
+class RecordWriter(object):
+    """ Write records to disk as they are produced, flushing every `flush_every` records
+        JSON Lines files (*.jsonl) get one record per line & can be appended to when resuming a run,
+        other files get a JSON array, byte-identical to json.dump(records, file, ensure_ascii=False)
+        (or to json.dump({key: records}, ...) when `key` is set)
+        Safe to share between threads
+    """
+
+    def __init__(self, filepath, encoding='utf-8', flush_every=100, append=False, key=None):
+        """ RecordWriter constructor
+            :parameter filepath: The output file path
+            :parameter flush_every: The number of records written between two flushes to disk
+            :parameter append: Append to an existing JSON Lines file instead of overwriting it
+            :parameter key: Wrap the JSON array into an object under this key (ignored for JSON Lines files)
+        """
+        self.json_lines = is_json_lines(filepath)
+        assert self.json_lines or not append, "Only JSON Lines (*.jsonl) outputs can be appended to"
+        self.file = open(filepath, 'a' if append else 'w', encoding=encoding)
+        self.flush_every = max(int(flush_every), 1)
+        self.num_records = 0
+        self._pending = 0
+        self._lock = threading.Lock()
+        self.key = key
+        if not self.json_lines:
+            self.file.write('[' if key is None else '{' + json.dumps(key, ensure_ascii=False) + ': [')
+
+    def write(self, record):
+        with self._lock:
+            if self.json_lines:
+                self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            else:
+                self.file.write((', ' if self.num_records else '') + json.dumps(record, ensure_ascii=False))
+            self.num_records += 1
+            self._pending += 1
+            if self._pending >= self.flush_every:
+                self._flush()
+
+    def write_all(self, records):
+        for record in records:
+            self.write(record)
+
+    def _flush(self):
+        self.file.flush()
+        self._pending = 0
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            if self.file.closed:
+                return
+            if not self.json_lines:
+                self.file.write(']' if self.key is None else ']}')
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class OrderedRecordWriter(object):
+    """ Write records finished out of order (e.g. by a pool of workers) in input order through a RecordWriter
+        A record is only buffered until every record before it is written
+        Safe to share between threads
+    """
+
+    def __init__(self, writer, start=0):
+        """ OrderedRecordWriter constructor
+            :parameter writer: The RecordWriter
+            :parameter start: The index of the first record
+        """
+        self.writer = writer
+        self.next_index = start
+        self.buffer = {}
+        self._lock = threading.Lock()
+
+    def write(self, index, record):
+        """ Write the record at this input index, & every buffered record it was holding back """
+        with self._lock:
+            self.buffer[index] = record
+            while self.next_index in self.buffer:
+                self.writer.write(self.buffer.pop(self.next_index))
+                self.next_index += 1
+
+
+class ProgressJournal(object):
+    """ Append-only journal of finished work units (one {"id", "value"} JSON line each), committed to disk every
+        `commit_every` units. Reopening a journal replays it, so a restarted job skips every committed unit
+        Only the ids of the units (& the offset of their line) are kept in memory, their values are read back from
+        the file when needed
+        Safe to share between threads
+    """
+
+    def __init__(self, filepath, encoding='utf-8', commit_every=100):
+        """ ProgressJournal constructor
+            :parameter filepath: The journal file (created if needed, replayed if it exists)
+            :parameter commit_every: The number of recorded units between two commits (flush & fsync)
+        """
+        self.filepath = filepath
+        self.encoding = encoding
+        self.offsets = self.replay(filepath, encoding)
+        self.num_replayed = len(self.offsets)
+        self.file = open(filepath, 'ab')
+        self.size = self.file.tell()   # The offset of the next recorded line, pending ones included
+        self.commit_every = max(int(commit_every), 1)
+        self._pending = []
+        self._reader = None
+        self._lock = threading.RLock()  # Reentrant, so a signal handler can commit
+
+    @staticmethod
+    def replay(filepath, encoding='utf-8'):
+        """ The {id: line offset} of the committed units of a journal file; a line cut by a crash is dropped from
+            the file. The file is read one line at a time
+        """
+        offsets = {}
+        if not os.path.exists(filepath):
+            return offsets
+        offset = 0
+        with open(filepath, 'rb') as file:
+            for line in file:
+                if not line.endswith(b'\n'):
+                    break
+                if line.strip():
+                    offsets[json.loads(line.decode(encoding))['id']] = offset
+                offset += len(line)
+        if offset != os.path.getsize(filepath):
+            with open(filepath, 'r+b') as file:
+                file.truncate(offset)
+        return offsets
+
+    def __contains__(self, unit_id):
+        with self._lock:
+            return unit_id in self.offsets
+
+    def __len__(self):
+        with self._lock:
+            return len(self.offsets)
+
+    def read(self, unit_ids, default=None):
+        """ The recorded values of units, read back from the journal file, as a list (default for unknown ids) """
+        with self._lock:
+            if self._pending:
+                self._write_pending()
+                self.file.flush()
+            if self._reader is None:
+                self._reader = open(self.filepath, 'rb')
+            values = []
+            for unit_id in unit_ids:
+                if unit_id not in self.offsets:
+                    values.append(default)
+                    continue
+                self._reader.seek(self.offsets[unit_id])
+                values.append(json.loads(self._reader.readline().decode(self.encoding))['value'])
+            return values
+
+    def get(self, unit_id, default=None):
+        return self.read([unit_id], default)[0]
+
+    def record(self, unit_id, value):
+        """ Record a finished unit, committing the journal every commit_every units """
+        line = (json.dumps({'id': unit_id, 'value': value}, ensure_ascii=False) + '\n').encode(self.encoding)
+        with self._lock:
+            self.offsets[unit_id] = self.size
+            self.size += len(line)
+            self._pending.append(line)
+            if len(self._pending) >= self.commit_every:
+                self._commit()
+
+    def _write_pending(self):
+        self.file.write(b''.join(self._pending))
+        self._pending = []
+
+    def _commit(self):
+        if self._pending:
+            self._write_pending()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def commit(self):
+        with self._lock:
+            self._commit()
+
+    def close(self):
+        with self._lock:
+            if self.file.closed:
+                return
+            self._commit()
+            self.file.close()
+            if self._reader is not None:
+                self._reader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
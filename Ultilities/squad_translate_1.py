@@ -4,27 +4,50 @@
 import json
 import copy
 import re
-from google.cloud import translate  # Imports the Google Cloud client library
-import time
-import html
 import sys
 import signal
 from tqdm import tqdm
 import argparse
+from record_io import ProgressJournal, RecordWriter, iter_squad_articles
+from translation import TranslationCache, TranslationEngine, TranslationError, make_translator
 
 # region Configuration
 # Configuration
 
 parser = argparse.ArgumentParser()
-parser.add_argument('-in', '--input_file', default="", help='SQuAD-format file that need to be translated',
+parser.add_argument('-in', '--input_file', default="", help='SQuAD-format file that need to be translated '
+                                                            '(or a jsonl file with one article per line)',
                     required=True)
-parser.add_argument('-out', '--output_file', default="", help='Output file', required=True)
+parser.add_argument('-out', '--output_file', default="", help='Output file (one translated paragraph per line if '
+                                                              'its name ends with .jsonl)', required=True)
 parser.add_argument('-e', '--encoding', default="utf-8",
                     help='The default encoding of the input/output dataset', required=False)
+parser.add_argument('--flush_every', default=100, type=int,
+                    help='The number of paragraphs between two flushes of the jsonl output', required=False)
+parser.add_argument('--journal_file', default=None,
+                    help='The progress journal, replayed on restart (Default is <output_file>.journal)',
+                    required=False)
+parser.add_argument('--commit_every', default=100, type=int,
+                    help='The number of translated questions/contexts between two commits of the journal',
+                    required=False)
+parser.add_argument('--backend', default='google', choices=['google', 'stub'],
+                    help="The translation backend: 'google' (Cloud Translation API) or 'stub' (local, returns the text "
+                         "unchanged, for testing)", required=False)
+parser.add_argument('--model', default='base', help="The Cloud Translation model ('base' or 'nmt')", required=False)
+parser.add_argument('--cache_file', default='translation_cache.sqlite',
+                    help='The persistent translation cache, so no text is ever paid for twice', required=False)
+parser.add_argument('--workers', default=4, type=int, help='The maximum number of concurrent requests',
+                    required=False)
+parser.add_argument('--chars_per_second', default=10000, type=float,
+                    help='The character rate allowed by the quota (0 for no limit)', required=False)
+parser.add_argument('--batch_paragraphs', default=16, type=int,
+                    help='The number of paragraphs whose questions & contexts are translated together',
+                    required=False)
+parser.add_argument('--stub_latency', default=0., type=float,
+                    help="The simulated request latency (seconds) of the 'stub' backend", required=False)
 args = parser.parse_args()
 
 error_file = 'error.txt'
-progress_file = 'progress.json'
 encode = args.encoding
 total_case = 0
 succeed_case = 0
@@ -34,10 +57,8 @@ answer_indicator = "$$$"
 answer_splitter = "##"
 pattern = r'\$\$\$.*?\$\$\$'
 
-article_progress_idx = 0
-paragraph_progress_idx = 0
-
-translated_data = {'paragraphs': []}
+journal = None  # Every translated question (by qas id) & context, committed as they are done
+writer = None   # The translated paragraphs, written in input order as their article is done
 
 
 # endregion
@@ -52,30 +73,26 @@ def signal_handler(sig, frame):
 
 
 def save():
-    with open(file_output, "w", encoding=encode) as json_file:
-        json.dump(translated_data, json_file, ensure_ascii=False)
+    # Everything translated so far is in the journal: a restart replays it & only translates the rest
+    journal.commit()
+    if writer is not None:
+        writer.flush()
+
 
-    with open(progress_file, "w", encoding=encode) as json_file:
-        json.dump({'article_progress': article_progress_idx, 'paragraph_progress': paragraph_progress_idx}, json_file)
+def context_id(article_idx, paragraph_idx):
+    """ The journal id of a translated paragraph context """
+    return 'context/{}/{}'.format(article_idx, paragraph_idx)
 
 
-def translate_func(client, text, target_lang='vi'):
+def translate_texts(engine, texts):
+    """ Translate a list of texts (in order), saving & terminating when the quota is exhausted """
     try:
-        text = client.translate(text, target_language=target_lang, model='base')['translatedText']
-    except KeyboardInterrupt:
-        return ""
-    except Exception as e:
+        return engine.translate(texts)
+    except TranslationError as e:
         print('Exception: {}'.format(str(e)))
-        print('Possible quota exceed. Wait for 100 + 2 seconds...')
-        time.sleep(102)
-        print('Sleep for 100 + 2 seconds. Continue process...')
-        try:
-            text = client.translate(text, target_language=target_lang, model='nmt')['translatedText']
-        except:
-            print('Possible daily limit exceed. Terminate the program')
-            save()
-            sys.exit(0)
-    return html.unescape(text)
+        print('Possible daily limit exceed. Terminate the program')
+        save()
+        sys.exit(0)
 
 
 def add_info(context, ans_list):
@@ -165,24 +182,46 @@ def add_info(context, ans_list):
     return new_cotext
 
 
-def load_progress():
-    global article_progress_idx
-    global paragraph_progress_idx
-    global translated_data
+def rebuild_paragraph(article_idx, paragraph_idx, paragraph):
+    """ Build a translated paragraph from the journal: restore the answers marked in its translated context """
+    # The translated questions, in a dictionary for future use
+    question_ids = [pair['id'] for pair in paragraph['qas']]
+    questions = dict(zip(question_ids, journal.read(question_ids, "")))
 
-    try:
-        with open(progress_file, 'r', encoding=encode) as file:
-            progress = json.load(file)
-            article_progress_idx = progress['article_progress']
-            paragraph_progress_idx = progress['paragraph_progress']
-    except FileNotFoundError:
-        pass
+    qas = []
+    context = journal.get(context_id(article_idx, paragraph_idx), "")
 
-    try:
-        with open(file_output, "r", encoding=encode) as json_file:
-            translated_data = json.load(json_file)
-    except FileNotFoundError:
-        pass
+    translated_answerlist = re.findall(pattern, context)
+
+    # Preprocess translated paragraph and retrieve original answer
+    for answer_info in translated_answerlist:
+
+        context_idx = context.find(answer_info)  # Get answer_start position in paragraph
+        _answer_info = answer_info  # Temp variable for later use
+        answer_info = answer_info[
+                      len(answer_indicator):-len(answer_indicator)]  # Remove the answer start and end indicator
+        answer_info = answer_info.split(answer_splitter)
+        real_answer = answer_info.pop().strip()  # Get answer
+
+        for question_id in answer_info:
+            new_qdict = {'id': question_id.strip()}
+
+            try:
+                new_qdict['question'] = questions[new_qdict['id']]
+            except:
+                with open(error_file, "a+", encoding=encode) as err_file:
+                    err_file.write(
+                        'At article {}, paragarph {}: Cant find question id {}\n'.format(article_idx,
+                                                                                         paragraph_idx,
+                                                                                         new_qdict['id']))
+                continue
+
+            new_qdict['answers'] = [{'text': real_answer, 'answer_start': context_idx}]
+            qas.append(new_qdict)
+
+        context = context.replace(_answer_info, real_answer)
+
+    return {'context': context, 'qas': qas}
 
 
 # endregion
@@ -193,78 +232,62 @@ if __name__ == "__main__":
     file_input = args.input_file
     file_output = args.output_file
     # Instantiates a client
-    translate_client = translate.Client()
+    translator = make_translator(args.backend, model=args.model, stub_latency=args.stub_latency)
+    translation_engine = TranslationEngine(translator, source='en', target='vi', model=args.model,
+                                           cache=TranslationCache(args.cache_file), max_workers=args.workers,
+                                           chars_per_second=args.chars_per_second or None)
 
     # Start translating
     print('Begin translating...')
     print('Opening file...')
-    with open(file_input, encoding=encode) as data_file:
-        data = json.load(data_file)
+    data = {'data': list(iter_squad_articles(file_input, encode))}
 
     print('Load previous progress')
-    load_progress()
+    journal = ProgressJournal(args.journal_file or file_output + '.journal', encode, commit_every=args.commit_every)
+    print('{} questions & contexts already translated'.format(journal.num_replayed))
 
     print('Process file and begin translate...')
     signal.signal(signal.SIGINT, signal_handler)
 
-    for article_progress_idx in tqdm(range(article_progress_idx, len(data['data']))):
-        article = data['data'][article_progress_idx]
-        paragraph_progress_idx = 0
-        for paragraph_progress_idx in tqdm(range(paragraph_progress_idx, len(article['paragraphs']))):
-            paragraph = article['paragraphs'][paragraph_progress_idx]
-
-            context = paragraph['context']
-            answer_list = []
-            questions = {}
-
-            # Loop for each qa pairs
-            for pair in paragraph['qas']:
-                # Get answer and id
-                answer = pair['answers'][0]['text']
-                id = pair['id']
-                ans_start = pair['answers'][0]['answer_start']
-
-                # Translate the question, add to new dictionary for future use
-                questions[id] = translate_func(translate_client, pair['question'])
-                answer_list.append({'ques_id': id, 'ans_start': ans_start, 'ans_end': ans_start + len(answer)})
-
-            context = add_info(context, answer_list)
-
-            qas = []
-            context = translate_func(translate_client, context)
-
-            translated_answerlist = re.findall(pattern, context)
-
-            # Preprocess translated paragraph and retrieve original answer
-            for answer_info in translated_answerlist:
-
-                context_idx = context.find(answer_info)  # Get answer_start position in paragraph
-                _answer_info = answer_info  # Temp variable for later use
-                answer_info = answer_info[
-                              len(answer_indicator):-len(answer_indicator)]  # Remove the answer start and end indicator
-                answer_info = answer_info.split(answer_splitter)
-                real_answer = answer_info.pop().strip()  # Get answer
-
-                for question_id in answer_info:
-                    new_qdict = {'id': question_id.strip()}
-
-                    try:
-                        new_qdict['question'] = questions[new_qdict['id']]
-                    except:
-                        with open(error_file, "a+", encoding=encode) as err_file:
-                            err_file.write(
-                                'At article {}, paragarph {}: Cant find question id {}\n'.format(article_progress_idx,
-                                                                                                 paragraph_progress_idx,
-                                                                                                 new_qdict['id']))
-                        continue
-
-                    new_qdict['answers'] = [{'text': real_answer, 'answer_start': context_idx}]
-                    qas.append(new_qdict)
-
-                context = context.replace(_answer_info, real_answer)
-
-            translated_data['paragraphs'].append({'context': context, 'qas': qas})
-
+    # Every paragraph is rebuilt from the journal & written as soon as its article is translated, in input order
+    writer = RecordWriter(file_output, encode, flush_every=args.flush_every, key='paragraphs')
+    for article_idx, article in enumerate(tqdm(data['data'])):
+        # The paragraphs with a question or the context left to translate
+        paragraphs = [(paragraph_idx, paragraph) for paragraph_idx, paragraph in enumerate(article['paragraphs'])
+                      if context_id(article_idx, paragraph_idx) not in journal
+                      or any(pair['id'] not in journal for pair in paragraph['qas'])]
+        for batch_start_idx in range(0, len(paragraphs), args.batch_paragraphs):
+            # Mark the answers in the contexts, then translate the questions & contexts of the batch together
+            batch_ids = []
+            batch_texts = []
+            for paragraph_idx, paragraph in paragraphs[batch_start_idx:batch_start_idx + args.batch_paragraphs]:
+                answer_list = []
+
+                # Loop for each qa pairs
+                for pair in paragraph['qas']:
+                    # Get answer and id
+                    answer = pair['answers'][0]['text']
+                    id = pair['id']
+                    ans_start = pair['answers'][0]['answer_start']
+
+                    if id not in journal:
+                        batch_ids.append(id)
+                        batch_texts.append(pair['question'])
+                    answer_list.append({'ques_id': id, 'ans_start': ans_start, 'ans_end': ans_start + len(answer)})
+
+                if context_id(article_idx, paragraph_idx) not in journal:
+                    batch_ids.append(context_id(article_idx, paragraph_idx))
+                    batch_texts.append(add_info(paragraph['context'], answer_list))
+
+            for unit_id, translation in zip(batch_ids, translate_texts(translation_engine, batch_texts)):
+                journal.record(unit_id, translation)
+
+        writer.write_all(rebuild_paragraph(article_idx, paragraph_idx, paragraph)
+                         for paragraph_idx, paragraph in enumerate(article['paragraphs']))
     save()
+    writer.close()
+    journal.close()
+    translation_engine.close()
+    print('Translation stats: {}'.format(translation_engine.stats))
     print('Translate complete!')
 # endregion
@@ -1,125 +1,105 @@
-import json
-import time
-from selenium import webdriver
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.common.by import By
-from math import floor
-from multiprocessing.pool import ThreadPool
-import threading
 import argparse
+from record_io import OrderedRecordWriter, ProgressJournal, RecordWriter, iter_squad_articles
+from translation import ProgressCollector, TranslationCache, TranslationError, TranslationPipeline, make_translator, \
+    run_work_queue
 
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-i', '--input_file', default=None,
-                    help='The input English SQuAD file', required=True)
+                    help='The input English SQuAD file (or a jsonl file with one article per line)', required=True)
 parser.add_argument('-o', '--output_file', default=None,
-                    help='The output SQuAD file that have been translated into Vietnamese', required=True)
+                    help='The output SQuAD file that have been translated into Vietnamese (one article per line if '
+                         'its name ends with .jsonl)', required=True)
 parser.add_argument('-e', '--encoding', default="utf-8",
                     help='The default encoding of the input/output dataset', required=False)
-parser.add_argument('-t', '--num_threads', default=4,
+parser.add_argument('-t', '--num_threads', default=4, type=int,
                     help='The number of threads used for translation', required=False)
-
-
-threadLocal = threading.local()
-# chromepath = "/usr/bin/chromedriver"
-chromepath = r"chromedriver.exe"
-# chromeOptions = webdriver.ChromeOptions()
-# chromeOptions.add_argument("--headless")
-# driver = webdriver.Chrome(chromepath, chrome_options=chromeOptions)
-# wait = WebDriverWait(driver,5)
-
-json_result = []
-count_para = 0
-count_ques = 0
-count_error = 0
-text_error = []
-
-
-def create_maindriver():
-    mainDriver = getattr(threadLocal, 'maindriver', None)
-    if mainDriver is None:
-        chromeOptions = webdriver.ChromeOptions()
-        chromeOptions.add_argument("--headless")
-        mainDriver = webdriver.Chrome(chromepath, chrome_options=chromeOptions)
-        # mainDriver = webdriver.Chrome(chromepath)
-        setattr(threadLocal, 'maindriver', mainDriver)
-    return mainDriver
-
-
-def EnVieTranslationAPI(text, driver, wait):
-    global count_error, text_error
+parser.add_argument('-c', '--chunk_size', default=1, type=int,
+                    help='The number of articles a thread takes from the shared work queue at a time', required=False)
+parser.add_argument('--flush_every', default=10, type=int,
+                    help='The number of translated articles between two flushes of the output file', required=False)
+parser.add_argument('--backend', default='selenium', choices=['google', 'selenium', 'stub'],
+                    help="The translation backend: 'google' (Cloud Translation API), 'selenium' (Google Translate "
+                         "web page) or 'stub' (local, returns the text unchanged, for benchmarking)", required=False)
+parser.add_argument('--workers', default=4, type=int,
+                    help='The maximum number of concurrent translation requests (browsers for selenium)',
+                    required=False)
+parser.add_argument('--cache_file', default='translation_cache.sqlite',
+                    help='The persistent translation cache', required=False)
+parser.add_argument('--chromedriver', default='chromedriver.exe',
+                    help="The path to chromedriver (backend 'selenium')", required=False)
+parser.add_argument('--stub_latency', default=0., type=float,
+                    help="The simulated request latency (seconds) of the 'stub' backend", required=False)
+parser.add_argument('--journal_file', default=None,
+                    help='The progress journal, replayed on restart (Default is <output_file>.journal)',
+                    required=False)
+parser.add_argument('--commit_every', default=100, type=int,
+                    help='The number of finished questions/contexts between two commits of the journal', required=False)
+
+pipeline = None     # Batches the strings of every thread into translation requests
+journal = None      # Every translated question (by qas id) & context, committed as they are done
+collector = None    # Progress & errors
+writer = None       # The translated articles, written in input order as soon as they are done
+
+
+def context_id(article_idx, paragraph_idx):
+    """ The journal id of a translated paragraph context """
+    return 'context/{}/{}'.format(article_idx, paragraph_idx)
+
+
+def collect_translation(unit_id, future, text):
+    """ Journal & return the translation of a submitted text (a failed one is left out & empty, so a rerun
+        retries it)
+    """
     try:
-        input_area = driver.find_element_by_css_selector("#source")
-        input_area.clear()
-        time.sleep(0.8)
-        # driver.execute_script("arguments[0].value = '';", input_area)
-        # driver.execute_script("arguments[0].value = '"+text+"';", input_area)
-        # driver.execute_script("document.getElementById('source').setAttribute('value','"+text+"')")
-        input_area.send_keys(text)
-        translatedText = wait.until(EC.presence_of_element_located((By.CSS_SELECTOR,
-                                                                    'body > div.frame > '
-                                                                    'div.page.tlid-homepage.homepage.translate-text > '
-                                                                    'div.homepage-content-wrap > '
-                                                                    'div.tlid-source-target.main-header > '
-                                                                    'div.source-target-row > '
-                                                                    'div.tlid-results-container.results-container > '
-                                                                    'div.tlid-result.result-dict-wrapper > '
-                                                                    'div.result.tlid-copy-target > '
-                                                                    'div.text-wrap.tlid-copy-target > div > '
-                                                                    'span.tlid-translation.translation'))).text
-    except Exception as e:
-        print("Exception: ", e)
-        count_error = count_error + 1
-        text_error.append(text_error)
+        translation = future.result()
+    except TranslationError as e:
+        collector.error(text, e)
         return ""
-    return translatedText
-
-
-def load_data():
-    with open(args.input_file, 'r', encoding=args.encoding) as infile:
-        squad_json = json.load(infile)
-        squad_json = squad_json['data']
-
-    # divide data into x parts
-    div = floor(len(squad_json) / args.num_threads)
-    divided_squad_json = [[squad_json[i] for i in range(div)]]
-    for i in range(1, args.num_threads - 1):
-        divided_squad_json.append([squad_json[j] for j in range(div * i, div * (i + 1))])
-    divided_squad_json.append([squad_json[i] for i in range(div * (args.num_threads - 1), len(squad_json))])
-    return divided_squad_json
-
-
-def export_data(json_input):
-    with open(args.output_file, 'w', encoding=args.encoding) as outfile:
-        json.dump(json_input, outfile, ensure_ascii=False)
-        outfile.close()
+    collector.add(unit_id, translation)
+    return translation
 
 
 def translate_squad_vie(squad_json):
-    driver = create_maindriver()
-    driver.get("https://translate.google.com/?hl=vi#view=home&op=translate&sl=en&tl=vi")
-    wait = WebDriverWait(driver, 20)
-    print("Thread job's start!!!")
-    global count_para, count_ques
-    for item in squad_json:
-        paragraphs = item['paragraphs']
-        for para in paragraphs:
-            para['context'] = EnVieTranslationAPI(para['context'], driver, wait)
-            count_para = count_para + 1
-            print("para: ", count_para)
-            qas_list = para['qas']
-            for qas in qas_list:
-                count_ques = count_ques + 1
-                print("ques: ", count_ques)
-                qas['question'] = EnVieTranslationAPI(qas['question'], driver, wait)
-    global json_result
-    json_result.extend(squad_json)
-    driver.quit()
-    print("Thread job's done!!!")
+    """ Translate a chunk of (index, article) & write each translated article """
+    for article_idx, item in squad_json:
+        # Submit every context & question of the article left to translate, then collect their translations
+        units = []
+        for paragraph_idx, para in enumerate(item['paragraphs']):
+            units.append((context_id(article_idx, paragraph_idx), para['context']))
+            units.extend((qas['id'], qas['question']) for qas in para['qas'])
+        futures = [(unit_id, pipeline.submit(text, 'en', 'vi'), text)
+                   for unit_id, text in units if unit_id not in journal]
+        translations = {unit_id: collect_translation(unit_id, future, text) for unit_id, future, text in futures}
+        # The units translated by an earlier run are read back from the journal
+        replayed = [unit_id for unit_id, _ in units if unit_id not in translations]
+        translations.update(zip(replayed, journal.read(replayed, "")))
+        writer.write(article_idx, dict(item, paragraphs=[
+            dict(para, context=translations[context_id(article_idx, paragraph_idx)],
+                 qas=[dict(qas, question=translations[qas['id']]) for qas in para['qas']])
+            for paragraph_idx, para in enumerate(item['paragraphs'])]))
+        collector.update()
 
 
 if __name__ == "__main__":
     args = parser.parse_args()
-    ThreadPool(args.num_threads).map(translate_squad_vie, load_data())
-    export_data(json_result)
+    squad_json = list(iter_squad_articles(args.input_file, args.encoding))
+    journal = ProgressJournal(args.journal_file or args.output_file + '.journal', args.encoding,
+                              commit_every=args.commit_every)
+    print("{} questions & contexts already translated".format(journal.num_replayed))
+    pipeline = TranslationPipeline(make_translator(args.backend, chromedriver_path=args.chromedriver,
+                                                   num_drivers=args.workers, stub_latency=args.stub_latency),
+                                   cache=TranslationCache(args.cache_file), max_concurrency=args.workers)
+    collector = ProgressCollector(len(squad_json), journal)
+    # Articles finished out of order wait for the ones before them (a failed translation is left empty)
+    with RecordWriter(args.output_file, args.encoding, flush_every=args.flush_every) as output:
+        writer = OrderedRecordWriter(output)
+        try:
+            run_work_queue(translate_squad_vie, list(enumerate(squad_json)), num_workers=args.num_threads,
+                           chunk_size=args.chunk_size)
+        finally:
+            journal.commit()
+    collector.close()
+    pipeline.close()
+    print("Translation stats: {} ({} errors)".format(pipeline.stats(), len(collector.errors)))
+    journal.close()
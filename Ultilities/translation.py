@@ -0,0 +1,479 @@
+import asyncio
+import hashlib
+import html
+import json
+import queue
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+
+# Google Cloud Translation (v2) limits: segments per request & recommended characters per request
+MAX_BATCH_SEGMENTS = 128
+MAX_BATCH_CHARS = 30000
+
+
+class TranslationError(Exception):
+    """ A batch could still not be translated after every retry (e.g. the daily quota is exhausted) """
+    pass
+
+
+class Translator(object):
+    """ A translation backend: translate_batch(texts, source, target) -> the translations, in order
+        `name` identifies the backend in the translation cache
+    """
+    name = 'translator'
+
+    def translate_batch(self, texts, source, target):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class GoogleCloudTranslator(Translator):
+    """ Google Cloud Translation API (v2) backend
+        Authentication: set GOOGLE_APPLICATION_CREDENTIALS=[PATH]
+    """
+
+    name = 'google'
+
+    def __init__(self, model='base'):
+        from google.cloud import translate  # Imports the Google Cloud client library
+        self.client = translate.Client()
+        self.model = model
+
+    def translate_batch(self, texts, source, target):
+        results = self.client.translate(list(texts), target_language=target, source_language=source,
+                                        model=self.model)
+        return [html.unescape(result['translatedText']) for result in results]
+
+
+class StubTranslator(Translator):
+    """ Local stand-in backend for tests & benchmarks: returns every text unchanged (or with a prefix)
+        after a simulated request latency, optionally failing a share of the requests to exercise the retries
+    """
+
+    def __init__(self, latency=0., failure_rate=0., prefix='', seed=0):
+        self.name = 'stub' + prefix
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.prefix = prefix
+        self.rng = random.Random(seed)
+        self.num_requests = 0
+        self._lock = threading.Lock()
+
+    def translate_batch(self, texts, source, target):
+        with self._lock:
+            self.num_requests += 1
+            fail = self.rng.random() < self.failure_rate
+        time.sleep(self.latency)
+        if fail:
+            raise IOError("Simulated translation failure")
+        return [self.prefix + text for text in texts]
+
+
+class SeleniumTranslator(Translator):
+    """ Google Translate web page backend, driven by a pool of (headless) Chrome instances
+        Each text is typed into the page one at a time, so this backend is slow: prefer 'google' or 'stub'
+    """
+    TRANSLATE_URL = "https://translate.google.com/#view=home&op=translate&sl={}&tl={}"
+    RESULT_SELECTOR = ('body > div.frame > div.page.tlid-homepage.homepage.translate-text > '
+                       'div.homepage-content-wrap > div.tlid-source-target.main-header > div.source-target-row > '
+                       'div.tlid-results-container.results-container > div.tlid-result.result-dict-wrapper > '
+                       'div.result.tlid-copy-target > div.text-wrap.tlid-copy-target > div > '
+                       'span.tlid-translation.translation')
+    name = 'google-web'
+
+    def __init__(self, chromedriver_path='chromedriver.exe', num_drivers=1, headless=True, timeout=20):
+        from selenium import webdriver
+        self.drivers = queue.Queue()
+        for _ in range(num_drivers):
+            chrome_options = webdriver.ChromeOptions()
+            if headless:
+                chrome_options.add_argument("--headless")
+            driver = webdriver.Chrome(chromedriver_path, chrome_options=chrome_options)
+            driver.language_pair = None
+            self.drivers.put(driver)
+        self.num_drivers = num_drivers
+        self.timeout = timeout
+
+    def translate_batch(self, texts, source, target):
+        from selenium.webdriver.support import expected_conditions as EC
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.webdriver.common.by import By
+        driver = self.drivers.get()
+        try:
+            if driver.language_pair != (source, target):
+                driver.get(self.TRANSLATE_URL.format(source, target))
+                driver.language_pair = (source, target)
+            translations = []
+            for text in texts:
+                input_area = driver.find_element_by_css_selector("#source")
+                input_area.clear()
+                time.sleep(0.8)
+                input_area.send_keys(text)
+                translations.append(WebDriverWait(driver, self.timeout).until(
+                    EC.presence_of_element_located((By.CSS_SELECTOR, self.RESULT_SELECTOR))).text)
+            return translations
+        finally:
+            self.drivers.put(driver)
+
+    def close(self):
+        for _ in range(self.num_drivers):
+            self.drivers.get().quit()
+
+
+def make_translator(backend, model='base', chromedriver_path='chromedriver.exe', num_drivers=1, stub_latency=0.):
+    """ Create a translation backend: 'google' (Cloud Translation API), 'selenium' (Google Translate web page)
+        or 'stub' (local, returns the texts unchanged)
+    """
+    if backend == 'google':
+        return GoogleCloudTranslator(model=model)
+    if backend == 'selenium':
+        return SeleniumTranslator(chromedriver_path, num_drivers=num_drivers)
+    if backend == 'stub':
+        return StubTranslator(latency=stub_latency)
+    raise ValueError("Unknown translation backend '{}'".format(backend))
+
+
+class TokenBucket(object):
+    """ Thread-safe token bucket: acquire(cost) blocks until `cost` tokens are available
+        Tokens refill continuously at `rate` per second, up to `capacity`
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.timestamp = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self, cost=1.):
+        # A cost larger than the capacity waits for a full bucket (& leaves it in debt)
+        needed = min(cost, self.capacity)
+        while True:
+            with self._lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+                self.timestamp = now
+                if self.tokens >= needed:
+                    self.tokens -= cost
+                    return
+                wait = (needed - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class TranslationCache(object):
+    """ Persistent translation cache (SQLite), keyed by (text, source, target, model)
+        Every stored batch is committed, so an interrupted run keeps all the translations it paid for
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS translations (key TEXT PRIMARY KEY, translation TEXT)')
+        self.connection.commit()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(text, source, target, model):
+        return hashlib.sha256(json.dumps([text, source, target, model], ensure_ascii=False)
+                              .encode('utf-8')).hexdigest()
+
+    def get_many(self, keys, chunk_size=500):
+        """ The cached translations of the keys that are in the cache, as a {key: translation} dict """
+        keys = list(keys)
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), chunk_size):
+                chunk = keys[start:start + chunk_size]
+                rows = self.connection.execute('SELECT key, translation FROM translations WHERE key IN ({})'
+                                               .format(','.join('?' * len(chunk))), chunk)
+                found.update(rows)
+        return found
+
+    def put_many(self, items):
+        """ Store (key, translation) pairs """
+        with self._lock:
+            self.connection.executemany('INSERT OR REPLACE INTO translations (key, translation) VALUES (?, ?)',
+                                        list(items))
+            self.connection.commit()
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+
+class TranslationEngine(object):
+    """ Translate many segments through a Translator backend
+        The segments are deduplicated & looked up in the cache, the rest is packed into batches within the API
+        limits, which are sent by a bounded pool of workers. Requests are rate limited by a token bucket on
+        characters & failed requests are retried with exponential backoff
+    """
+
+    def __init__(self, translator, source='en', target='vi', model='base', cache=None, max_workers=4,
+                 chars_per_second=None, max_batch_segments=MAX_BATCH_SEGMENTS, max_batch_chars=MAX_BATCH_CHARS,
+                 max_retries=6, backoff=1., max_backoff=120., bucket=None):
+        """ TranslationEngine constructor
+            :parameter translator: The Translator backend
+            :parameter model: The translation model, part of the cache key (with the backend name)
+            :parameter cache: A TranslationCache (None disables caching)
+            :parameter max_workers: The maximum number of concurrent requests
+            :parameter chars_per_second: The sustained character rate allowed by the quota (None for no limit)
+            :parameter max_retries: The number of retries of a failed request before a TranslationError is raised
+            :parameter backoff: The delay before the first retry (seconds), doubled on every retry up to max_backoff
+            :parameter bucket: A TokenBucket shared with other engines (replaces chars_per_second)
+        """
+        self.translator = translator
+        self.source = source
+        self.target = target
+        self.model = model
+        self.cache = cache
+        self.bucket = bucket if bucket is not None else TokenBucket(chars_per_second) if chars_per_second else None
+        self.max_batch_segments = max_batch_segments
+        self.max_batch_chars = max_batch_chars
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.stats = {'segments': 0, 'cache_hits': 0, 'requests': 0, 'retries': 0, 'characters': 0}
+        self._lock = threading.Lock()
+
+    def _count(self, **counts):
+        with self._lock:
+            for name, count in counts.items():
+                self.stats[name] += count
+
+    def batches(self, items):
+        """ Pack (key, text) pairs into consecutive batches of at most max_batch_segments segments &
+            max_batch_chars characters (a longer text gets a batch of its own)
+        """
+        batch, batch_chars = [], 0
+        for key, text in items:
+            if batch and (len(batch) >= self.max_batch_segments or batch_chars + len(text) > self.max_batch_chars):
+                yield batch
+                batch, batch_chars = [], 0
+            batch.append((key, text))
+            batch_chars += len(text)
+        if batch:
+            yield batch
+
+    def _request(self, texts):
+        num_chars = sum(len(text) for text in texts)
+        for attempt in range(self.max_retries + 1):
+            if self.bucket is not None:
+                self.bucket.acquire(num_chars)
+            try:
+                self._count(requests=1, characters=num_chars)
+                translations = self.translator.translate_batch(texts, self.source, self.target)
+                if len(translations) != len(texts):
+                    raise IOError("Got {} translations for {} segments".format(len(translations), len(texts)))
+                return translations
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise TranslationError("Translation failed after {} retries: {}".format(attempt, e))
+                delay = min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.)
+                print('Exception: {}. Retry in {:.1f} seconds...'.format(e, delay))
+                self._count(retries=1)
+                time.sleep(delay)
+
+    def _translate_batch(self, batch):
+        """ Translate a batch of (key, text) pairs & cache the result right away """
+        translated = list(zip([key for key, _ in batch], self._request([text for _, text in batch])))
+        if self.cache is not None:
+            self.cache.put_many(translated)
+        return translated
+
+    def translate(self, texts):
+        """ Translate a list of texts, returning the translations in the same order
+            :raises TranslationError: When a batch still fails after every retry
+        """
+        texts = list(texts)
+        model = '{}/{}'.format(self.translator.name, self.model)
+        keys = [TranslationCache.key(text, self.source, self.target, model) for text in texts]
+        translations = self.cache.get_many(set(keys)) if self.cache is not None else {}
+        # Blank segments are kept as they are
+        translations.update((key, text) for key, text in zip(keys, texts) if not text.strip())
+        self._count(segments=len(texts), cache_hits=sum(1 for key in keys if key in translations))
+
+        missing = OrderedDict((key, text) for key, text in zip(keys, texts) if key not in translations)
+        futures = [self.executor.submit(self._translate_batch, batch) for batch in self.batches(missing.items())]
+        for future in futures:
+            translations.update(future.result())
+        return [translations[key] for key in keys]
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class TranslationPipeline(object):
+    """ Asynchronous translation front-end shared by many producers (threads or coroutines)
+        Single strings are queued per language pair on an asyncio event loop (running on its own thread) &
+        coalesced into batches, sent as soon as max_batch_segments strings are waiting or max_wait_ms after the
+        first one. Each batch goes through the TranslationEngine of its language pair (cache, API limits, rate
+        limiting & retries), at most max_concurrency batches at a time
+    """
+
+    def __init__(self, translator, model='base', cache=None, max_concurrency=4, chars_per_second=None,
+                 max_batch_segments=MAX_BATCH_SEGMENTS, max_wait_ms=50, **engine_kwargs):
+        """ TranslationPipeline constructor
+            :parameter translator: The Translator backend
+            :parameter cache: A TranslationCache (None disables caching)
+            :parameter max_concurrency: The maximum number of batches translated at the same time
+            :parameter chars_per_second: The character rate allowed for all language pairs together (None for no limit)
+            :parameter engine_kwargs: Other TranslationEngine parameters (max_batch_chars, max_retries, backoff...)
+        """
+        self.translator = translator
+        self.model = model
+        self.cache = cache
+        self.bucket = TokenBucket(chars_per_second) if chars_per_second else None
+        self.max_batch_segments = max_batch_segments
+        self.max_wait = max_wait_ms / 1000.
+        self.engine_kwargs = engine_kwargs
+        self.engines = {}
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self._pending = {}
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name='TranslationPipeline')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _engine(self, source, target):
+        if (source, target) not in self.engines:
+            self.engines[(source, target)] = TranslationEngine(
+                self.translator, source, target, self.model, cache=self.cache, max_workers=1, bucket=self.bucket,
+                max_batch_segments=self.max_batch_segments, **self.engine_kwargs)
+        return self.engines[(source, target)]
+
+    async def translate(self, text, source, target):
+        """ Translate one text (a coroutine, to be run on the pipeline loop) """
+        future = self.loop.create_future()
+        batch = self._pending.setdefault((source, target), [])
+        batch.append((text, future))
+        if len(batch) >= self.max_batch_segments:
+            self._flush((source, target), batch)
+        elif len(batch) == 1:
+            self.loop.call_later(self.max_wait, self._flush, (source, target), batch)
+        return await future
+
+    def _flush(self, language_pair, batch):
+        if self._pending.get(language_pair) is batch:
+            del self._pending[language_pair]
+            self.loop.create_task(self._run_batch(language_pair, batch))
+
+    async def _run_batch(self, language_pair, batch):
+        try:
+            translations = await self.loop.run_in_executor(self.executor, self._engine(*language_pair).translate,
+                                                           [text for text, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), translation in zip(batch, translations):
+            future.set_result(translation)
+
+    async def translate_chain(self, text, languages):
+        """ Translate a text through a chain of languages, each leg starting as soon as the previous one is done
+            (e.g. ['vi', 'en', 'vi'] for back-translation)
+        """
+        for source, target in zip(languages[:-1], languages[1:]):
+            text = await self.translate(text, source, target)
+        return text
+
+    def submit(self, text, source, target):
+        """ Queue a text from any thread & return a (concurrent.futures) Future of its translation """
+        return asyncio.run_coroutine_threadsafe(self.translate(text, source, target), self.loop)
+
+    def submit_chain(self, text, languages):
+        """ Queue a text from any thread for translate_chain & return a (concurrent.futures) Future of the result """
+        return asyncio.run_coroutine_threadsafe(self.translate_chain(text, languages), self.loop)
+
+    def translate_many(self, texts, source, target):
+        """ Translate texts from any thread, blocking until all of them are done
+            :raises TranslationError: When a batch still fails after every retry
+        """
+        futures = [self.submit(text, source, target) for text in texts]
+        return [future.result() for future in futures]
+
+    def stats(self):
+        """ The counters of every engine, summed """
+        stats = {}
+        for engine in list(self.engines.values()):
+            for name, count in engine.stats.items():
+                stats[name] = stats.get(name, 0) + count
+        return stats
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.executor.shutdown()
+        for engine in self.engines.values():
+            engine.close()
+        self.translator.close()
+
+
+def run_work_queue(process_chunk, items, num_workers=4, chunk_size=8):
+    """ Process items in small chunks, pulled from a shared queue by num_workers threads
+        An idle worker takes the next chunk, so a slow chunk (e.g. long contexts) doesn't hold back the others.
+        On an error (or Ctrl+C) the workers stop after their current chunk & the error is raised
+        :parameter process_chunk: A function process_chunk(list of items)
+    """
+    chunks = queue.Queue()
+    for start in range(0, len(items), chunk_size):
+        chunks.put(items[start:start + chunk_size])
+    stop = threading.Event()
+
+    def work():
+        while not stop.is_set():
+            try:
+                chunk = chunks.get_nowait()
+            except queue.Empty:
+                return
+            process_chunk(chunk)
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        workers = [executor.submit(work) for _ in range(num_workers)]
+        try:
+            for worker in workers:
+                worker.result()
+        finally:
+            stop.set()
+
+
+class ProgressCollector(object):
+    """ Thread-safe progress bar, error list & result sink shared by the translation workers """
+
+    def __init__(self, total, journal=None, desc=None):
+        """ ProgressCollector constructor
+            :parameter total: The total number of progress steps
+            :parameter journal: A ProgressJournal receiving the finished units (None to only count them)
+        """
+        self.progress = tqdm(total=total, desc=desc)
+        self.journal = journal
+        self.num_steps = 0
+        self.num_units = 0
+        self.errors = []
+        self._lock = threading.Lock()
+
+    def update(self, steps=1):
+        with self._lock:
+            self.num_steps += steps
+            self.progress.update(steps)
+
+    def add(self, unit_id, value):
+        """ Store a finished unit """
+        if self.journal is not None:
+            self.journal.record(unit_id, value)
+        with self._lock:
+            self.num_units += 1
+
+    def error(self, text, exception=None):
+        with self._lock:
+            self.errors.append(text)
+            self.progress.write("Exception: {} ({} errors)".format(exception, len(self.errors)))
+
+    def close(self):
+        self.progress.close()